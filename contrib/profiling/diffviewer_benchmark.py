@@ -0,0 +1,545 @@
+#!/usr/bin/env python
+#
+# Benchmark suite for the diff viewer.
+#
+# Builds reproducible diff corpora and times each stage of showing them in
+# the diff viewer on its own: parsing the diff, fetching the original files
+# through LocalFileTool, patching, diffing, move detection, syntax
+# highlighting, chunk generation and rendering. The time, throughput and
+# peak memory of each stage are written out as JSON, so that runs against
+# different commits can be compared.
+#
+# The synthetic corpora are:
+#
+#   small-edits          Lots of small files with a few scattered edits.
+#   huge-generated       One huge generated file with edits throughout.
+#   mass-renames         Hundreds of renamed files with one changed line.
+#   whitespace-reformat  Files that were reindented and nothing else.
+#   moved-blocks         Files with blocks of code moved around.
+#   multi-file           A multi-megabyte diff spanning many files.
+#
+# Recorded diffs can be benchmarked too, with --recorded. Each is a
+# directory containing the diff as patch.diff, and the files it applies to
+# under orig/. Use --save-corpora to see the synthetic corpora in that form.
+#
+# Each corpus is benchmarked in its own process, so that the peak memory
+# used by one doesn't hide that of the next. The benchmark runs against a
+# scratch test database and an in-memory cache, so it needs a working
+# settings_local.py, but doesn't touch the site's data.
+#
+# Usage: diffviewer_benchmark.py [options] [corpus ...]
+
+import difflib
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime
+from optparse import OptionParser
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reviewboard.settings')
+
+from django.conf import settings
+
+# This must be set before anything loads the cache.
+settings.CACHE_BACKEND = 'locmem://'
+
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils import simplejson
+
+from reviewboard.diffviewer.diffutils import DEFAULT_DIFF_COMPAT_VERSION, \
+                                             Differ, find_moved_lines, \
+                                             get_chunks, get_diff_files, \
+                                             get_file_markup, patch, \
+                                             split_file_lines
+from reviewboard.diffviewer.models import DiffSet, FileDiff
+from reviewboard.scmtools.models import Repository, Tool
+from reviewboard.test import RBTestRunner
+
+
+STAGES = ['parse', 'fetch', 'patch', 'diff', 'moves', 'highlight', 'chunks',
+          'render']
+
+EXTENSIONS = ['py', 'c', 'h', 'java', 'js', 'txt']
+
+COMMON_LINES = ['\n', '    }\n', '    return value\n', '    # TODO\n']
+
+
+def generated_file(rand, num_lines):
+    """Returns lines resembling generated code.
+
+    Most lines are unique, with a few common lines, such as blank lines and
+    closing braces, mixed in.
+    """
+    lines = []
+
+    for i in xrange(num_lines):
+        if i % 20 == 0:
+            lines.append('def func_%d(self):\n' % i)
+        elif rand.randint(0, 3) == 0:
+            lines.append(rand.choice(COMMON_LINES))
+        else:
+            lines.append('    value = self.lookup(%d, %d)\n'
+                         % (i, rand.randint(0, 1000)))
+
+    return lines
+
+
+def scattered_edits(rand, lines, num_edits):
+    """Returns a copy of the lines with small edits scattered throughout."""
+    new_lines = list(lines)
+
+    for i in xrange(num_edits):
+        pos = rand.randint(0, len(new_lines) - 1)
+        op = rand.randint(0, 2)
+
+        if op == 0:
+            new_lines.insert(pos, '    added = %d\n' % i)
+        elif op == 1:
+            del new_lines[pos]
+        else:
+            new_lines[pos] = '    changed = %d\n' % i
+
+    return new_lines
+
+
+def moved_blocks(rand, lines, num_blocks, block_size):
+    """Returns a copy of the lines with blocks moved elsewhere."""
+    new_lines = list(lines)
+
+    for i in xrange(num_blocks):
+        start = rand.randint(0, len(new_lines) - block_size)
+        block = new_lines[start:start + block_size]
+        del new_lines[start:start + block_size]
+        pos = rand.randint(0, len(new_lines))
+        new_lines[pos:pos] = block
+
+    return new_lines
+
+
+def reindented(lines):
+    """Returns a copy of the lines indented with tabs instead of spaces."""
+    new_lines = []
+
+    for line in lines:
+        stripped = line.lstrip(' ')
+        new_lines.append('\t' * ((len(line) - len(stripped)) / 4) + stripped)
+
+    return new_lines
+
+
+def get_filename(i, prefix='src'):
+    """Returns a file name with one of a mix of extensions."""
+    return '%s/module%d/file%d.%s' % (prefix, i / 50, i,
+                                      EXTENSIONS[i % len(EXTENSIONS)])
+
+
+def build_small_edits(rand, scale):
+    files = []
+
+    for i in xrange(int(100 * scale)):
+        lines = generated_file(rand, 200)
+        filename = get_filename(i)
+        files.append((filename, filename, lines,
+                      scattered_edits(rand, lines, 3)))
+
+    return files
+
+
+def build_huge_generated(rand, scale):
+    num_lines = int(50000 * scale)
+    lines = generated_file(rand, num_lines)
+
+    return [('generated/tables.c', 'generated/tables.c', lines,
+             scattered_edits(rand, lines, num_lines / 100))]
+
+
+def build_mass_renames(rand, scale):
+    files = []
+
+    for i in xrange(int(500 * scale)):
+        lines = generated_file(rand, 50)
+        files.append((get_filename(i), get_filename(i, 'lib'), lines,
+                      scattered_edits(rand, lines, 1)))
+
+    return files
+
+
+def build_whitespace_reformat(rand, scale):
+    files = []
+
+    for i in xrange(int(20 * scale)):
+        lines = generated_file(rand, 500)
+        filename = get_filename(i)
+        files.append((filename, filename, lines, reindented(lines)))
+
+    return files
+
+
+def build_moved_blocks(rand, scale):
+    files = []
+
+    for i in xrange(int(10 * scale)):
+        lines = generated_file(rand, 2000)
+        filename = get_filename(i)
+        files.append((filename, filename, lines,
+                      moved_blocks(rand, lines, 5, 30)))
+
+    return files
+
+
+def build_multi_file(rand, scale):
+    files = []
+
+    for i in xrange(int(100 * scale)):
+        lines = generated_file(rand, 2000)
+        filename = get_filename(i)
+        files.append((filename, filename, lines,
+                      scattered_edits(rand, lines, 200)))
+
+    return files
+
+
+SYNTHETIC_CORPORA = [
+    ('small-edits', build_small_edits),
+    ('huge-generated', build_huge_generated),
+    ('mass-renames', build_mass_renames),
+    ('whitespace-reformat', build_whitespace_reformat),
+    ('moved-blocks', build_moved_blocks),
+    ('multi-file', build_multi_file),
+]
+
+
+def write_corpus(path, files):
+    """Writes a synthetic corpus in the same layout as recorded corpora.
+
+    files is a list of (old filename, new filename, old lines, new lines).
+    """
+    diff_fp = open(os.path.join(path, 'patch.diff'), 'w')
+
+    for old_filename, new_filename, old_lines, new_lines in files:
+        orig_path = os.path.join(path, 'orig', old_filename)
+
+        if not os.path.exists(os.path.dirname(orig_path)):
+            os.makedirs(os.path.dirname(orig_path))
+
+        fp = open(orig_path, 'w')
+        fp.write(''.join(old_lines))
+        fp.close()
+
+        diff_fp.writelines(difflib.unified_diff(old_lines, new_lines,
+                                                old_filename, new_filename,
+                                                'HEAD', '(working copy)'))
+
+    diff_fp.close()
+
+
+def get_peak_memory():
+    """Returns the peak memory used by the process so far, in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def time_stage(func, iterations):
+    """Runs a stage, returning the best time and the peak memory growth.
+
+    The memory figure is how much the process's peak memory grew during
+    the first run.
+    """
+    best = None
+    memory = 0
+
+    for i in xrange(iterations):
+        base_memory = get_peak_memory()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+
+        if i == 0:
+            memory = get_peak_memory() - base_memory
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, memory
+
+
+def run_corpus(name, path, iterations):
+    """Benchmarks each stage for a corpus, returning a dictionary of results.
+
+    The results include the best time and the peak memory growth for each
+    stage, along with its throughput in MB of file content per second. For
+    the parse stage, throughput is based on the size of the diff instead.
+    """
+    base_memory = get_peak_memory()
+
+    fp = open(os.path.join(path, 'patch.diff'), 'r')
+    diff_data = fp.read()
+    fp.close()
+
+    tool, created = Tool.objects.get_or_create(
+        name='Local File',
+        class_name='reviewboard.scmtools.localfile.LocalFileTool')
+    repository = Repository.objects.create(
+        name=name,
+        path=os.path.join(path, 'orig'),
+        tool=tool)
+    scmtool = repository.get_scmtool()
+    state = {}
+
+    def parse_stage():
+        state['files'] = [f for f in scmtool.get_parser(diff_data).parse()
+                          if not f.binary and not f.deleted]
+
+    def fetch_stage():
+        state['originals'] = [
+            scmtool.get_file(*scmtool.parse_diff_revision(f.origFile,
+                                                          f.origInfo))
+            for f in state['files']
+        ]
+
+    def patch_stage():
+        state['patched'] = [patch(f.data, old, f.newFile)
+                            for f, old in zip(state['files'],
+                                              state['originals'])]
+
+    def diff_stage():
+        state['differs'] = []
+
+        for old, new in zip(state['originals'], state['patched']):
+            differ = Differ(split_file_lines(old), split_file_lines(new),
+                            ignore_space=True,
+                            compat_version=DEFAULT_DIFF_COMPAT_VERSION)
+            state['differs'].append((differ, list(differ.get_opcodes())))
+
+    def moves_stage():
+        for differ, opcodes in state['differs']:
+            groups = [opcode + ({},) for opcode in opcodes]
+            removes = [group for group in groups if group[0] == 'delete']
+            inserts = [group for group in groups if group[0] == 'insert']
+
+            if removes and inserts:
+                find_moved_lines(differ, removes, inserts)
+
+    def highlight_stage():
+        for filediff, old, new in zip(filediffs, state['originals'],
+                                      state['patched']):
+            get_file_markup(filediff, old, new, True)
+
+    def chunks_stage():
+        # The original files are cached by the diff viewer, so they're
+        # cleared to measure a diff that's viewed for the first time.
+        cache.clear()
+
+        for filediff in filediffs:
+            list(get_chunks(diffset, filediff, None, False, True))
+
+    def render_stage():
+        for file in state['diff_files']:
+            render_to_string('diffviewer/diff_file_fragment.html', {
+                'file': file,
+                'standalone': False,
+                'base_url': '/r/1/',
+            })
+
+    # Store the diff the way an upload would, for the stages that need it.
+    parse_stage()
+    diffset = DiffSet.objects.create(name=name, revision=1,
+                                     repository=repository,
+                                     diffcompat=DEFAULT_DIFF_COMPAT_VERSION)
+    filediffs = [
+        FileDiff.objects.create(diffset=diffset,
+                                source_file=f.origFile,
+                                dest_file=f.newFile,
+                                source_revision=f.origInfo,
+                                dest_detail=f.newInfo,
+                                diff=f.data,
+                                status=FileDiff.MODIFIED)
+        for f in state['files']
+    ]
+
+    stage_funcs = {
+        'parse': parse_stage,
+        'fetch': fetch_stage,
+        'patch': patch_stage,
+        'diff': diff_stage,
+        'moves': moves_stage,
+        'highlight': highlight_stage,
+        'chunks': chunks_stage,
+        'render': render_stage,
+    }
+    stages = {}
+
+    for stage in STAGES:
+        if stage == 'render':
+            state['diff_files'] = get_diff_files(
+                diffset, enable_syntax_highlighting=True)
+
+        elapsed, memory = time_stage(stage_funcs[stage], iterations)
+        stages[stage] = {
+            'seconds': elapsed,
+            'peak_memory_kb': memory,
+        }
+
+    diff_bytes = len(diff_data)
+    file_bytes = sum([len(data)
+                      for data in state['originals'] + state['patched']])
+    num_lines = sum([len(differ.a) + len(differ.b)
+                     for differ, opcodes in state['differs']])
+
+    for stage, result in stages.iteritems():
+        if stage == 'parse':
+            size = diff_bytes
+        else:
+            size = file_bytes
+
+        if result['seconds']:
+            result['mb_per_second'] = size / result['seconds'] / 1048576
+            result['lines_per_second'] = num_lines / result['seconds']
+        else:
+            result['mb_per_second'] = result['lines_per_second'] = None
+
+    return {
+        'files': len(filediffs),
+        'diff_bytes': diff_bytes,
+        'file_bytes': file_bytes,
+        'lines': num_lines,
+        'peak_memory_kb': get_peak_memory() - base_memory,
+        'stages': stages,
+    }
+
+
+def run_corpus_in_process(name, path, iterations):
+    """Runs run_corpus in a forked process, returning its results."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read_fd)
+        fp = os.fdopen(write_fd, 'w')
+
+        try:
+            fp.write(simplejson.dumps(run_corpus(name, path, iterations)))
+            fp.close()
+        except:
+            traceback.print_exc()
+
+        os._exit(0)
+
+    os.close(write_fd)
+    fp = os.fdopen(read_fd, 'r')
+    data = fp.read()
+    fp.close()
+    os.waitpid(pid, 0)
+
+    if not data:
+        raise RuntimeError('Benchmarking the %s corpus failed' % name)
+
+    return simplejson.loads(data)
+
+
+def get_git_revision():
+    """Returns the commit being benchmarked, or None if it's unknown."""
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        revision = p.communicate()[0].strip()
+    except OSError:
+        return None
+
+    return revision or None
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [corpus ...]')
+    parser.add_option('--iterations', type='int', default=3,
+                      help='the number of times to run each stage, keeping '
+                           'the best time (default: 3)')
+    parser.add_option('--scale', type='float', default=1.0,
+                      help='multiplies the size of the synthetic corpora '
+                           '(default: 1.0)')
+    parser.add_option('--recorded', action='append', default=[],
+                      metavar='DIR',
+                      help='a recorded corpus to benchmark; may be given '
+                           'more than once')
+    parser.add_option('--save-corpora', metavar='DIR',
+                      help='writes the synthetic corpora to DIR instead of '
+                           'a temporary directory')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='writes the JSON results to FILE instead of '
+                           'standard output')
+    options, args = parser.parse_args()
+
+    synthetic_names = [name for name, builder in SYNTHETIC_CORPORA]
+
+    for name in args:
+        if name not in synthetic_names:
+            parser.error('Unknown corpus "%s". Valid corpora are: %s'
+                         % (name, ', '.join(synthetic_names)))
+
+    if options.save_corpora:
+        corpora_dir = options.save_corpora
+    else:
+        corpora_dir = tempfile.mkdtemp(prefix='rb-benchmark-')
+
+    corpora = []
+
+    for name, builder in SYNTHETIC_CORPORA:
+        if (args and name in args) or (not args and not options.recorded):
+            path = os.path.join(corpora_dir, name)
+
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+            # Each corpus has its own seed, so it's the same on every run.
+            write_corpus(path, builder(random.Random(name), options.scale))
+            corpora.append((name, path))
+
+    for path in options.recorded:
+        corpora.append((os.path.basename(os.path.normpath(path)), path))
+
+    runner = RBTestRunner(verbosity=0)
+    runner.setup_test_environment()
+    old_config = runner.setup_databases()
+
+    results = {}
+
+    try:
+        for name, path in corpora:
+            sys.stderr.write('Benchmarking %s...\n' % name)
+            results[name] = run_corpus_in_process(name, path,
+                                                  options.iterations)
+    finally:
+        runner.teardown_databases(old_config)
+        runner.teardown_test_environment()
+
+        if not options.save_corpora:
+            shutil.rmtree(corpora_dir)
+
+    data = simplejson.dumps({
+        'revision': get_git_revision(),
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'iterations': options.iterations,
+        'scale': options.scale,
+        'corpora': results,
+    }, indent=2, sort_keys=True)
+
+    if options.output:
+        fp = open(options.output, 'w')
+        fp.write(data + '\n')
+        fp.close()
+    else:
+        print data
+
+
+if __name__ == '__main__':
+    main()
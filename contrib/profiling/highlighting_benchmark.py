@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Benchmark for syntax highlighting many small files.
+#
+# Highlights both sides of a synthetic diff of many small files, first the
+# way the diff viewer used to (looking up the lexer for each side and
+# creating a new formatter every time) and then through LexerCache, and
+# reports the time spent on each.
+#
+# Usage: highlighting_benchmark.py [num_files] [iterations]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..', '..')))
+
+import pygments
+from pygments.lexers import get_lexer_for_filename
+
+from reviewboard.diffviewer.highlighting import LexerCache, \
+                                                NoWrapperHtmlFormatter, \
+                                                highlight
+
+
+EXTENSIONS = ['py', 'c', 'h', 'cpp', 'java', 'js', 'rb', 'pl', 'php', 'cs',
+              'html', 'css', 'sh', 'txt', 'xml']
+
+FILE_CONTENT = ''.join(['def func_%d(value):\n'
+                        '    return value + %d\n'
+                        '\n' % (i, i)
+                        for i in xrange(5)])
+
+
+def get_filenames(num_files):
+    """Returns a list of file names with a mix of extensions."""
+    return ['src/module%d/file%d.%s' % (i / 50, i,
+                                        EXTENSIONS[i % len(EXTENSIONS)])
+            for i in xrange(num_files)]
+
+
+def highlight_uncached(filenames):
+    """Highlights the files the way the diff viewer used to."""
+    for filename in filenames:
+        for i in xrange(2):
+            lexer = get_lexer_for_filename(filename, stripnl=False,
+                                           encoding='utf-8')
+            lexer.add_filter('codetagify')
+            pygments.highlight(FILE_CONTENT, lexer,
+                               NoWrapperHtmlFormatter()).splitlines()
+
+
+def highlight_cached(filenames):
+    """Highlights the files with a LexerCache and a shared formatter."""
+    lexer_cache = LexerCache()
+
+    for filename in filenames:
+        lexer = lexer_cache.get_lexer(filename)
+
+        for i in xrange(2):
+            highlight(FILE_CONTENT, lexer)
+
+
+def main():
+    if len(sys.argv) > 1:
+        num_files = int(sys.argv[1])
+    else:
+        num_files = 500
+
+    if len(sys.argv) > 2:
+        iterations = int(sys.argv[2])
+    else:
+        iterations = 3
+
+    filenames = get_filenames(num_files)
+
+    print 'Highlighting benchmark, %d files, best of %d' % (num_files,
+                                                            iterations)
+    print '%-20s %10s %14s' % ('method', 'seconds', 'ms per file')
+
+    for name, func in (('uncached', highlight_uncached),
+                       ('cached', highlight_cached)):
+        best = None
+
+        for i in xrange(iterations):
+            start = time.time()
+            func(filenames)
+            elapsed = time.time() - start
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        print '%-20s %10.3f %14.3f' % (name, best, best * 1000 / num_files)
+
+
+if __name__ == '__main__':
+    main()
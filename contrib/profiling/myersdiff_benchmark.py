@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Microbenchmark for MyersDiffer.
+#
+# Generates a set of synthetic old/new file pairs, diffs each of them in a
+# separate process and reports the time spent and the peak memory used.
+#
+# Usage: myersdiff_benchmark.py [num_lines] [iterations]
+
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..', '..')))
+
+from reviewboard.diffviewer.myersdiff import MyersDiffer
+
+
+def generated_file(rand, num_lines):
+    """Returns lines resembling generated code with few distinct lines."""
+    lines = []
+
+    for i in xrange(num_lines):
+        if i % 10 == 0:
+            lines.append('def func_%d(self):\n' % (i / 10))
+        elif i % 10 == 9:
+            lines.append('\n')
+        else:
+            lines.append('    value = self.lookup(%d)\n' % rand.randint(0, 50))
+
+    return lines
+
+
+def scattered_edits(rand, lines, num_edits):
+    """Returns a copy of the lines with small edits scattered throughout."""
+    new_lines = list(lines)
+
+    for i in xrange(num_edits):
+        pos = rand.randint(0, len(new_lines) - 1)
+        op = rand.randint(0, 2)
+
+        if op == 0:
+            new_lines.insert(pos, '    added = %d\n' % i)
+        elif op == 1:
+            del new_lines[pos]
+        else:
+            new_lines[pos] = '    changed = %d\n' % i
+
+    return new_lines
+
+
+def moved_block(rand, lines, block_size):
+    """Returns a copy of the lines with a block moved elsewhere."""
+    new_lines = list(lines)
+    start = rand.randint(0, len(lines) - block_size)
+    block = new_lines[start:start + block_size]
+    del new_lines[start:start + block_size]
+    pos = rand.randint(0, len(new_lines))
+    new_lines[pos:pos] = block
+
+    return new_lines
+
+
+CASES = ['identical', 'scattered edits', 'many edits', 'moved block']
+
+
+def get_case(name, num_lines):
+    """Returns the old and new lines for a benchmark case."""
+    rand = random.Random(num_lines)
+    orig = generated_file(rand, num_lines)
+
+    if name == 'identical':
+        new = list(orig)
+    elif name == 'scattered edits':
+        new = scattered_edits(rand, orig, num_lines / 100)
+    elif name == 'many edits':
+        new = scattered_edits(rand, orig, num_lines / 20)
+    elif name == 'moved block':
+        new = moved_block(rand, orig, num_lines / 10)
+
+    return orig, new
+
+
+def run_case(a, b, iterations):
+    """Diffs a against b, returning the best time and the memory used in KB.
+
+    The memory figure is the growth of the process's peak memory while
+    diffing, so it only makes sense in a freshly forked process.
+    """
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+
+    for i in xrange(iterations):
+        start = time.time()
+        differ = MyersDiffer(a, b)
+        opcodes = list(differ.get_opcodes())
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, len(opcodes), \
+           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+
+
+def main():
+    if len(sys.argv) > 1:
+        num_lines = int(sys.argv[1])
+    else:
+        num_lines = 20000
+
+    if len(sys.argv) > 2:
+        iterations = int(sys.argv[2])
+    else:
+        iterations = 3
+
+    print 'MyersDiffer benchmark, %d lines, best of %d' % (num_lines,
+                                                           iterations)
+    print '%-20s %10s %10s %12s' % ('case', 'seconds', 'opcodes',
+                                    'memory KB')
+
+    for name in CASES:
+        # Each case runs in its own process so peak memory usage from one
+        # case doesn't hide that of the next.
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(read_fd)
+            a, b = get_case(name, num_lines)
+            os.write(write_fd, '%f %d %d' % run_case(a, b, iterations))
+            os._exit(0)
+
+        os.close(write_fd)
+        elapsed, num_opcodes, rss = os.read(read_fd, 128).split()
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+
+        print '%-20s %10.3f %10s %12s' % (name, float(elapsed), num_opcodes,
+                                          rss)
+
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,12 @@ from djblets.log import restart_logging
 from djblets.siteconfig.forms import SiteSettingsForm
 import pytz
 
+try:
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+except ImportError:
+    get_lexer_by_name = None
+
 from reviewboard.accounts.forms import LegacyAuthModuleSettingsForm
 from reviewboard.admin.checks import get_can_enable_search, \
                                      get_can_enable_syntax_highlighting, \
@@ -368,6 +374,15 @@ class DiffSettingsForm(SiteSettingsForm):
                     "whitespace changes should be shown. "
                     "(e.g., \"*.py, *.txt\")"))
 
+    lexer_overrides = forms.CharField(
+        label=_("Syntax highlighting overrides"),
+        required=False,
+        help_text=_("A comma-separated list of file patterns and the "
+                    "Pygments lexer used to highlight them, overriding the "
+                    "one picked by default. "
+                    "(e.g., \"*.tmpl=html+django, SConstruct=python\")"),
+        widget=forms.TextInput(attrs={'size': '60'}))
+
     diffviewer_context_num_lines = forms.IntegerField(
         label=_("Lines of Context"),
         help_text=_("The number of unchanged lines shown above and below "
@@ -386,6 +401,119 @@ class DiffSettingsForm(SiteSettingsForm):
                     "page to the diff viewer."),
         initial=10)
 
+    diffviewer_patch_engine = forms.ChoiceField(
+        label=_("Patch engine"),
+        choices=(
+            ('builtin', _("Built-in")),
+            ('external', _("External patch command")),
+        ),
+        help_text=_("The method used to apply diffs to files. The built-in "
+                    "engine avoids running a separate process for every "
+                    "file. The external engine uses the patch command."),
+        initial='builtin')
+
+    diffviewer_histogram_diff_threshold = forms.IntegerField(
+        label=_("Histogram diff threshold"),
+        help_text=_("Files with at least this many lines are diffed with "
+                    "the histogram diff algorithm, which is much faster on "
+                    "large, heavily reordered files. Changing this "
+                    "regenerates all cached diffs. "
+                    "Enter 0 to never use it."),
+        initial=5000)
+
+    diffviewer_move_detection_min_lines = forms.IntegerField(
+        label=_("Minimum moved block size"),
+        help_text=_("The smallest number of lines that will be shown as "
+                    "moved from one part of a file to another."),
+        min_value=1,
+        initial=1)
+
+    diffviewer_move_detection_timeout = forms.FloatField(
+        label=_("Move detection time limit"),
+        help_text=_("The number of seconds spent looking for moved lines in "
+                    "a file before giving up. Moves are not shown for files "
+                    "that take longer. Enter 0 for no limit."),
+        min_value=0,
+        initial=2.0)
+
+    diffviewer_large_file_lines = forms.IntegerField(
+        label=_("Large file line limit"),
+        help_text=_("Files with more lines than this are diffed with the "
+                    "histogram diff algorithm, without moved lines or "
+                    "changes within lines. Enter 0 for no limit."),
+        min_value=0,
+        initial=20000)
+
+    diffviewer_large_file_bytes = forms.IntegerField(
+        label=_("Large file size limit"),
+        help_text=_("Files larger than this many bytes are diffed the same "
+                    "way as files past the large file line limit. Enter 0 "
+                    "for no limit."),
+        min_value=0,
+        initial=1048576)
+
+    diffviewer_max_file_lines = forms.IntegerField(
+        label=_("Maximum file lines"),
+        help_text=_("Files with more lines than this aren't shown in the "
+                    "diff viewer. A link to download the diff is shown "
+                    "instead. Enter 0 for no limit."),
+        min_value=0,
+        initial=200000)
+
+    diffviewer_max_file_bytes = forms.IntegerField(
+        label=_("Maximum file size"),
+        help_text=_("Files larger than this many bytes aren't shown in the "
+                    "diff viewer. Enter 0 for no limit."),
+        min_value=0,
+        initial=20971520)
+
+    diffviewer_file_time_budget = forms.FloatField(
+        label=_("File time limit"),
+        help_text=_("The number of seconds spent finding moved lines and "
+                    "changes within lines for a file. Once this is used up, "
+                    "the rest of the file is shown without them. Enter 0 "
+                    "for no limit."),
+        min_value=0,
+        initial=10.0)
+
+    diffviewer_chunk_store_backend = forms.ChoiceField(
+        label=_("Diff chunk storage"),
+        choices=(
+            ('none', _("Memory cache only")),
+            ('disk', _("Local disk")),
+        ),
+        help_text=_("Where generated diffs are stored in addition to the "
+                    "memory cache. Storing them on disk lets large diffs "
+                    "survive cache evictions and restarts."),
+        initial='none')
+
+    diffviewer_chunk_store_path = forms.CharField(
+        label=_("Diff chunk storage path"),
+        help_text=_("The directory where generated diffs are stored when "
+                    "using local disk storage. This must be writable by "
+                    "the web server."),
+        required=False,
+        widget=forms.TextInput(attrs={'size': '60'}))
+
+    diffviewer_chunk_store_max_size = forms.IntegerField(
+        label=_("Diff chunk storage size"),
+        help_text=_("The maximum size, in megabytes, of the diff chunk "
+                    "storage. The least recently viewed diffs are removed "
+                    "when it's full."),
+        initial=1024)
+
+    diffviewer_chunk_generation = forms.ChoiceField(
+        label=_("Diff generation on upload"),
+        choices=(
+            ('none', _("When first viewed")),
+            ('queue', _("In the background")),
+            ('sync', _("While uploading")),
+        ),
+        help_text=_("When to generate diffs for newly uploaded files. "
+                    "Generating them in the background requires running "
+                    "the generate_diff_chunks management command."),
+        initial='none')
+
     def load(self):
         # TODO: Move this check into a dependencies module so we can catch it
         #       when the user starts up Review Board.
@@ -399,19 +527,71 @@ class DiffSettingsForm(SiteSettingsForm):
 
         self.fields['include_space_patterns'].initial = \
             ', '.join(self.siteconfig.get('diffviewer_include_space_patterns'))
+        self.fields['lexer_overrides'].initial = \
+            ', '.join(['%s=%s' % (pattern, name) for pattern, name in
+                       self.siteconfig.get('diffviewer_lexer_overrides')])
 
         super(DiffSettingsForm, self).load()
 
     def save(self):
         self.siteconfig.set('diffviewer_include_space_patterns',
             re.split(r",\s*", self.cleaned_data['include_space_patterns']))
+        self.siteconfig.set('diffviewer_lexer_overrides',
+                            self.cleaned_data['lexer_overrides'])
 
         super(DiffSettingsForm, self).save()
 
+    def clean_lexer_overrides(self):
+        """
+        Validates the syntax highlighting overrides, returning them as a
+        list of (pattern, lexer name) pairs.
+        """
+        overrides = []
+
+        for override in re.split(r",\s*",
+                                 self.cleaned_data['lexer_overrides'].strip()):
+            if not override:
+                continue
+
+            try:
+                pattern, name = [part.strip() for part in override.split('=')]
+            except ValueError:
+                raise forms.ValidationError(
+                    _('"%s" must be in the form "pattern=lexer".') % override)
+
+            if get_lexer_by_name:
+                try:
+                    get_lexer_by_name(name)
+                except ClassNotFound:
+                    raise forms.ValidationError(
+                        _('"%s" is not a known Pygments lexer.') % name)
+
+            overrides.append((pattern, name))
+
+        return overrides
+
+    def clean_diffviewer_chunk_store_path(self):
+        """Validates that the chunk storage path is valid."""
+        path = self.cleaned_data['diffviewer_chunk_store_path'].strip()
+
+        if path:
+            if not os.path.isabs(path):
+                raise forms.ValidationError(
+                    _("The diff chunk storage path must be absolute."))
+
+            if os.path.exists(path) and not os.access(path, os.W_OK):
+                raise forms.ValidationError(
+                    _("This path is not writable by the web server."))
+        elif self.cleaned_data.get('diffviewer_chunk_store_backend') == 'disk':
+            raise forms.ValidationError(
+                _("A path is required when storing diffs on local disk."))
+
+        return path
+
 
     class Meta:
         title = _("Diff Viewer Settings")
-        save_blacklist = ('include_space_patterns',)
+        save_blacklist = ('include_space_patterns', 'lexer_overrides')
         fieldsets = (
             {
                 'title': _("General"),
@@ -419,7 +599,8 @@ class DiffSettingsForm(SiteSettingsForm):
                 'fields': ('diffviewer_syntax_highlighting',
                            'diffviewer_syntax_highlighting_threshold',
                            'diffviewer_show_trailing_whitespace',
-                           'include_space_patterns'),
+                           'include_space_patterns',
+                           'lexer_overrides'),
             },
             {
                 'title': _("Advanced"),
@@ -431,7 +612,20 @@ class DiffSettingsForm(SiteSettingsForm):
                 'classes': ('wide',),
                 'fields': ('diffviewer_context_num_lines',
                            'diffviewer_paginate_by',
-                           'diffviewer_paginate_orphans')
+                           'diffviewer_paginate_orphans',
+                           'diffviewer_patch_engine',
+                           'diffviewer_histogram_diff_threshold',
+                           'diffviewer_move_detection_min_lines',
+                           'diffviewer_move_detection_timeout',
+                           'diffviewer_large_file_lines',
+                           'diffviewer_large_file_bytes',
+                           'diffviewer_max_file_lines',
+                           'diffviewer_max_file_bytes',
+                           'diffviewer_file_time_budget',
+                           'diffviewer_chunk_store_backend',
+                           'diffviewer_chunk_store_path',
+                           'diffviewer_chunk_store_max_size',
+                           'diffviewer_chunk_generation')
             }
         )
 
@@ -3,6 +3,8 @@ import os
 
 from django.conf import settings
 from django.contrib import auth
+from django.middleware import gzip, http
+from django.utils.http import http_date
 
 try:
     from django.core.handlers.modpython import ModPythonRequest
@@ -22,6 +24,50 @@ from reviewboard.admin.siteconfig import load_site_config
 from reviewboard.admin.views import manual_updates_required
 
 
+class GZipMiddleware(gzip.GZipMiddleware):
+    """
+    Middleware that compresses responses, except for streaming responses.
+
+    Django's GZipMiddleware reads the whole content of the response, which
+    would load all of a streaming response into memory.
+    """
+    def process_response(self, request, response):
+        if getattr(response, 'streaming', False):
+            return response
+
+        return super(GZipMiddleware, self).process_response(request,
+                                                            response)
+
+
+class ConditionalGetMiddleware(http.ConditionalGetMiddleware):
+    """
+    Middleware that handles conditional GET requests, including for
+    streaming responses.
+
+    Django's ConditionalGetMiddleware reads the whole content of the
+    response to set its Content-Length, which would load all of a
+    streaming response into memory. Streaming responses are sent without
+    a Content-Length, but still get a 304 when the ETag or Last-Modified
+    headers match the request.
+    """
+    def process_response(self, request, response):
+        if not getattr(response, 'streaming', False):
+            return super(ConditionalGetMiddleware, self).process_response(
+                request, response)
+
+        response['Date'] = http_date()
+
+        if (response.has_header('ETag') and
+            request.META.get('HTTP_IF_NONE_MATCH') == response['ETag']):
+            response.status_code = 304
+        elif (response.has_header('Last-Modified') and
+              request.META.get('HTTP_IF_MODIFIED_SINCE') ==
+              response['Last-Modified']):
+            response.status_code = 304
+
+        return response
+
+
 class LoadSettingsMiddleware(object):
     """
     Middleware that loads the settings on each request.
@@ -113,10 +113,24 @@ defaults.update({
     'auth_x509_username_field':            'SSL_CLIENT_S_DN_CN',
     'auth_x509_username_regex':            '',
     'auth_x509_autocreate_users':          False,
+    'diffviewer_chunk_generation':         'none',
+    'diffviewer_chunk_store_backend':      'none',
+    'diffviewer_chunk_store_max_size':     1024,
+    'diffviewer_chunk_store_path':         '',
     'diffviewer_context_num_lines':        5,
+    'diffviewer_file_time_budget':         10.0,
+    'diffviewer_histogram_diff_threshold': 5000,
     'diffviewer_include_space_patterns':   [],
+    'diffviewer_large_file_bytes':         1048576,
+    'diffviewer_large_file_lines':         20000,
+    'diffviewer_lexer_overrides':          [],
+    'diffviewer_max_file_bytes':           20971520,
+    'diffviewer_max_file_lines':           200000,
+    'diffviewer_move_detection_min_lines': 1,
+    'diffviewer_move_detection_timeout':   2.0,
     'diffviewer_paginate_by':              20,
     'diffviewer_paginate_orphans':         10,
+    'diffviewer_patch_engine':             'builtin',
     'diffviewer_syntax_highlighting':      True,
     'diffviewer_syntax_highlighting_threshold': 0,
     'diffviewer_show_trailing_whitespace': True,
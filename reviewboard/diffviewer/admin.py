@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from reviewboard.diffviewer.models import FileDiff, DiffSet, DiffSetHistory
+from reviewboard.diffviewer.models import ChunkGenerationTask, FileDiff, \
+                                         DiffSet, DiffSetHistory
 
 
 class FileDiffAdmin(admin.ModelAdmin):
@@ -21,6 +22,8 @@ class FileDiffAdmin(admin.ModelAdmin):
 class FileDiffInline(admin.StackedInline):
     model = FileDiff
     extra = 0
+    exclude = ('legacy_diff', 'legacy_parent_diff')
+    raw_id_fields = ('diff_blob', 'parent_diff_blob')
 
 
 class DiffSetAdmin(admin.ModelAdmin):
@@ -41,6 +44,14 @@ class DiffSetHistoryAdmin(admin.ModelAdmin):
     ordering = ('-timestamp',)
 
 
+class ChunkGenerationTaskAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'queued', 'started', 'duration')
+    list_filter = ('queued',)
+    raw_id_fields = ('filediff', 'interdiffset')
+    ordering = ('-queued',)
+
+
+admin.site.register(ChunkGenerationTask, ChunkGenerationTaskAdmin)
 admin.site.register(FileDiff, FileDiffAdmin)
 admin.site.register(DiffSet, DiffSetAdmin)
 admin.site.register(DiffSetHistory, DiffSetHistoryAdmin)
@@ -0,0 +1,181 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+from django.db.models import F, Q
+from djblets.siteconfig.models import SiteConfiguration
+
+from reviewboard.admin.checks import get_can_enable_syntax_highlighting
+from reviewboard.diffviewer.diffutils import get_cached_chunks
+from reviewboard.diffviewer.models import ChunkGenerationTask
+
+
+# Tasks that were started more than this many seconds ago and haven't
+# finished are assumed to belong to a worker that died, and are claimed
+# again.
+STALE_TASK_TIMEOUT = 30 * 60
+
+# The most times a task is claimed before it's given up on, so that a file
+# that kills its worker doesn't take down every worker in turn.
+MAX_TASK_ATTEMPTS = 3
+
+
+def queue_chunk_generation(diffset, previous_diffset=None):
+    """
+    Queues the generation of diff chunks for a newly uploaded DiffSet.
+
+    The chunks are generated for each of the diffset's files and, if
+    previous_diffset is given, for the interdiff between previous_diffset
+    and diffset.
+
+    What happens depends on the diffviewer_chunk_generation setting. If it's
+    "queue", tasks are queued for the generate_diff_chunks management
+    command. If it's "sync", the chunks are generated before returning.
+    Otherwise, nothing is generated until the diff is first viewed.
+
+    Returns the list of tasks created.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    mode = siteconfig.get('diffviewer_chunk_generation')
+
+    if mode not in ('queue', 'sync'):
+        return []
+
+    tasks = []
+
+    for filediff in diffset.files.all():
+        if not filediff.binary and not filediff.deleted:
+            tasks.append(ChunkGenerationTask.objects.create(
+                filediff=filediff))
+
+    if previous_diffset:
+        # The diff viewer shows interdiffs from the older diffset's
+        # point of view, so the tasks are queued for its files. Files that
+        # only exist in the new diffset are shown the same way as in the
+        # plain diff, which we've queued above.
+        for filediff in previous_diffset.files.all():
+            if not filediff.binary and not filediff.deleted:
+                tasks.append(ChunkGenerationTask.objects.create(
+                    filediff=filediff,
+                    interdiffset=diffset))
+
+    if mode == 'sync':
+        for task in tasks:
+            run_task(task)
+
+    return tasks
+
+
+def get_stale_tasks(stale_timeout=STALE_TASK_TIMEOUT):
+    """
+    Returns the tasks that were started more than stale_timeout seconds ago
+    and never finished.
+    """
+    return ChunkGenerationTask.objects.filter(
+        started__lt=datetime.now() - timedelta(seconds=stale_timeout),
+        duration__isnull=True)
+
+
+def claim_next_task(stale_timeout=STALE_TASK_TIMEOUT):
+    """
+    Claims the oldest task that no worker has started.
+
+    Tasks whose worker died (see get_stale_tasks) are claimed again, up to
+    MAX_TASK_ATTEMPTS times in total.
+
+    Returns None if the queue is empty. The task is marked as started in a
+    single UPDATE, so that two workers never claim the same task.
+    """
+    while True:
+        stale_tasks = get_stale_tasks(stale_timeout).filter(
+            attempts__lt=MAX_TASK_ATTEMPTS)
+
+        try:
+            task = ChunkGenerationTask.objects.filter(
+                Q(started__isnull=True) |
+                Q(pk__in=stale_tasks.values_list('pk', flat=True))
+            ).order_by('queued', 'pk')[0]
+        except IndexError:
+            return None
+
+        # Only claim the task if nobody else has since claimed it.
+        tasks = ChunkGenerationTask.objects.filter(pk=task.pk,
+                                                   attempts=task.attempts)
+
+        if task.started:
+            tasks = tasks.filter(started=task.started, duration__isnull=True)
+        else:
+            tasks = tasks.filter(started__isnull=True)
+
+        task.started = datetime.now()
+        task.attempts += 1
+
+        if tasks.update(started=task.started, attempts=F('attempts') + 1):
+            return task
+
+
+def run_task(task):
+    """
+    Generates the chunks for a task and stores them in the cache.
+
+    The chunks go through the same cache and chunk store as the diff
+    viewer, with syntax highlighting if it's enabled for the site. The time
+    spent and any error are recorded on the task.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    enable_syntax_highlighting = \
+        (siteconfig.get('diffviewer_syntax_highlighting') and
+         get_can_enable_syntax_highlighting()[0])
+
+    if not task.started:
+        task.started = datetime.now()
+
+    filediff = task.filediff
+    start_time = time.time()
+
+    try:
+        if task.interdiffset:
+            try:
+                interfilediff = task.interdiffset.files.filter(
+                    source_file=filediff.source_file)[0]
+            except IndexError:
+                interfilediff = None
+
+            # The diff viewer skips files that didn't change between the
+            # two diffsets.
+            if (not interfilediff or
+                not interfilediff.has_same_diff(filediff)):
+                get_cached_chunks(filediff, interfilediff, True,
+                                  enable_syntax_highlighting)
+        else:
+            get_cached_chunks(filediff, None, False,
+                              enable_syntax_highlighting)
+
+        task.error = ''
+    except Exception, e:
+        logging.error("Unable to generate diff chunks for %s: %s"
+                      % (task, e), exc_info=1)
+        task.error = str(e)
+
+    task.duration = time.time() - start_time
+    task.save()
+
+
+def run_worker(poll_interval=5, exit_when_empty=False,
+               stale_timeout=STALE_TASK_TIMEOUT):
+    """
+    Processes queued tasks until the queue is empty.
+
+    If exit_when_empty is False, this keeps polling for new tasks every
+    poll_interval seconds instead of returning. Tasks whose worker died
+    are picked up again after stale_timeout seconds.
+    """
+    while True:
+        task = claim_next_task(stale_timeout)
+
+        if task:
+            run_task(task)
+        elif exit_when_empty:
+            return
+        else:
+            time.sleep(poll_interval)
@@ -0,0 +1,230 @@
+import bisect
+
+from django.utils.safestring import mark_safe
+
+
+class ChunkLines(object):
+    """
+    A compact, read-only list of the lines in a diff chunk.
+
+    Chunks used to store each line as a list of line numbers, markup,
+    changed regions and flags. Those lists were pickled into the cache and
+    unpickled on every request, even if the lines were never shown.
+
+    This stores the same information in a few values per chunk instead:
+
+    * The line numbers, which are consecutive, as a start and a count.
+    * The markup for each side, packed into one string with a line per
+      line of markup. Changed regions and extra whitespace are already
+      marked up (see render_line_markup).
+    * Changed regions, whitespace-only lines and moved lines, keyed by the
+      index of the line in the chunk. These are only stored for the lines
+      that have them.
+
+    Lines are built when they're accessed, in the same format that
+    get_chunks has always returned (see get_file_chunks_in_range), so this
+    can be used anywhere a list of lines was used before. Slicing returns
+    another ChunkLines.
+    """
+    __slots__ = ('vlinenum', 'numlines', 'old_start', 'old_count',
+                 'new_start', 'new_count', 'old_markup', 'new_markup',
+                 'regions', 'whitespace_lines', 'moved',
+                 '_old_lines', '_new_lines')
+
+    def __init__(self, vlinenum, numlines, old_start, old_count, new_start,
+                 new_count, old_markup, new_markup, regions=None,
+                 whitespace_lines=None, moved=None):
+        self.vlinenum = vlinenum
+        self.numlines = numlines
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        self.old_markup = old_markup
+        self.new_markup = new_markup
+        self.regions = regions or {}
+        self.whitespace_lines = whitespace_lines or frozenset()
+        self.moved = moved or {}
+        self._old_lines = None
+        self._new_lines = None
+
+    @classmethod
+    def pack_markup(cls, lines):
+        """
+        Packs a list of lines of markup into a string.
+
+        Markup never contains newlines, since it's split on them, so they
+        can be used to separate the lines.
+        """
+        return '\n'.join(lines)
+
+    def __len__(self):
+        return self.numlines
+
+    def __iter__(self):
+        for i in xrange(self.numlines):
+            yield self._get_line(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.numlines)
+            assert step == 1, 'ChunkLines only supports contiguous slices'
+
+            return self._get_range(start, max(start, stop))
+
+        if not isinstance(index, (int, long)):
+            # Templates look up attributes with item lookups first, and
+            # only fall back on attributes for TypeErrors and KeyErrors.
+            raise TypeError('ChunkLines indices must be integers')
+
+        if index < 0:
+            index += self.numlines
+
+        if not 0 <= index < self.numlines:
+            raise IndexError('line index out of range')
+
+        return self._get_line(index)
+
+    def __reduce__(self):
+        return (ChunkLines,
+                (self.vlinenum, self.numlines, self.old_start, self.old_count,
+                 self.new_start, self.new_count, self.old_markup,
+                 self.new_markup, self.regions, self.whitespace_lines,
+                 self.moved))
+
+    def __repr__(self):
+        return '<ChunkLines %s-%s>' % (self.vlinenum,
+                                       self.vlinenum + self.numlines - 1)
+
+    def _get_old_lines(self):
+        if self._old_lines is None:
+            self._old_lines = self._unpack_markup(self.old_markup,
+                                                  self.old_count)
+
+        return self._old_lines
+
+    def _get_new_lines(self):
+        if self._new_lines is None:
+            self._new_lines = self._unpack_markup(self.new_markup,
+                                                  self.new_count)
+
+        return self._new_lines
+
+    def _unpack_markup(self, markup, count):
+        if count == 0:
+            return []
+
+        return markup.split('\n')
+
+    def _get_line(self, i):
+        if i < self.old_count:
+            oldlinenum = self.old_start + i
+            oldmarkup = self._get_old_lines()[i]
+        else:
+            oldlinenum = oldmarkup = ''
+
+        if i < self.new_count:
+            newlinenum = self.new_start + i
+            newmarkup = self._get_new_lines()[i]
+        else:
+            newlinenum = newmarkup = ''
+
+        if i in self.regions:
+            oldregion, newregion = self.regions[i]
+        else:
+            oldregion, newregion = [], []
+
+        line = [self.vlinenum + i,
+                oldlinenum, mark_safe(oldmarkup), oldregion,
+                newlinenum, mark_safe(newmarkup), newregion,
+                i in self.whitespace_lines]
+
+        if i in self.moved:
+            line.append(self.moved[i])
+
+        return line
+
+    def _get_range(self, start, stop):
+        def subset(d):
+            return dict([(i - start, value)
+                         for i, value in d.iteritems()
+                         if start <= i < stop])
+
+        old_end = min(self.old_count, stop)
+        new_end = min(self.new_count, stop)
+
+        return ChunkLines(
+            self.vlinenum + start,
+            stop - start,
+            self.old_start + start,
+            max(0, old_end - start),
+            self.new_start + start,
+            max(0, new_end - start),
+            self.pack_markup(self._get_old_lines()[start:old_end]),
+            self.pack_markup(self._get_new_lines()[start:new_end]),
+            subset(self.regions),
+            frozenset([i - start for i in self.whitespace_lines
+                       if start <= i < stop]),
+            subset(self.moved))
+
+
+class ChunkIndex(object):
+    """
+    An index of a file's chunks by virtual line number.
+
+    This is built once for a file's list of chunks, and is used to find the
+    chunk containing a line with a binary search, rather than looking at
+    every chunk before it.
+
+    It also keeps track of the last function/class header shown in any
+    chunk up to and including each chunk, which is what's shown for ranges
+    of lines that don't have a header of their own.
+    """
+    def __init__(self, chunks):
+        self.starts = []
+        self.headers = []
+
+        last_header = (None, None)
+        vlinenum = 1
+
+        for chunk in chunks:
+            meta = chunk.get('meta', {})
+            headers = meta.get('headers')
+
+            if headers and (headers[0] or headers[1]):
+                last_header = headers
+
+            lines = chunk['lines']
+
+            if isinstance(lines, ChunkLines):
+                vlinenum = lines.vlinenum
+            elif lines:
+                vlinenum = lines[0][0]
+
+            self.starts.append(vlinenum)
+            self.headers.append(last_header)
+            vlinenum += len(lines)
+
+        self.end = vlinenum
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find_chunk(self, linenum):
+        """
+        Returns the index of the chunk containing a virtual line number.
+
+        Returns None if the line is outside the file.
+        """
+        if not self.starts or not self.starts[0] <= linenum < self.end:
+            return None
+
+        return bisect.bisect_right(self.starts, linenum) - 1
+
+    def get_last_header(self, chunk_index):
+        """
+        Returns the last header found at or before the given chunk.
+
+        The header is a (left, right) pair, either of which may be None.
+        """
+        return self.headers[chunk_index]
@@ -0,0 +1,388 @@
+import cPickle as pickle
+import errno
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import zlib
+
+from djblets.siteconfig.models import SiteConfiguration
+
+from reviewboard import VERSION
+
+
+class ChunkStore(object):
+    """
+    A persistent store for generated diff chunks.
+
+    This sits underneath memcached as a second tier, so that chunks for
+    large diffs survive memcached evictions and restarts.
+
+    Entries are keyed by a (filediff_id, name) tuple, as returned by
+    make_key. The name covers the interfilediff, the syntax highlighting
+    flag, the diffset's diff compatibility version and the version of the
+    chunks (see get_chunks_version).
+
+    Subclasses must implement get, set and invalidate.
+    """
+    def make_key(self, filediff, interfilediff, force_interdiff,
+                 enable_syntax_highlighting, version=''):
+        """Returns the key for the chunks of a filediff or interdiff."""
+        name = 'c%s' % filediff.diffset.diffcompat
+
+        if version:
+            name = '%s-%s' % (version, name)
+
+        if enable_syntax_highlighting:
+            name = 'hl-' + name
+
+        if interfilediff:
+            name += '-interdiff-%s' % interfilediff.id
+        elif force_interdiff:
+            name += '-interdiff-none'
+
+        return (filediff.id, name)
+
+    def get(self, key):
+        """Returns the stored chunks for a key, or None if not stored."""
+        raise NotImplementedError
+
+    def set(self, key, chunks):
+        """Stores the chunks for a key."""
+        raise NotImplementedError
+
+    def invalidate(self, filediff_ids):
+        """
+        Removes all stored chunks for the given filediffs, including
+        interdiffs against them.
+        """
+        raise NotImplementedError
+
+
+class DiskChunkStore(ChunkStore):
+    """
+    A chunk store that keeps compressed chunks in files on local disk.
+
+    The total size of the store is kept under max_size bytes. When the
+    store grows past that, the least recently used entries are removed,
+    along with the references to them. Reading an entry bumps its
+    modification time, which is used to determine how recently it was used.
+    """
+    FILE_EXT = '.chunks'
+
+    # Entries for interdiffs are stored with the filediff's entries. A
+    # reference to them is kept with the interfilediff's entries, so that
+    # they can be found when invalidating the interfilediff.
+    REF_EXT = '.ref'
+    INTERDIFF_RE = re.compile(r'-interdiff-(\d+)$')
+
+    # The file recording when the store was last checked for eviction, and
+    # its size at the time.
+    EVICTION_FILENAME = 'last-eviction'
+
+    # Processes use the size recorded by another process's eviction check,
+    # if it was done within this many seconds, instead of walking the whole
+    # store when they first write to it.
+    EVICTION_INTERVAL = 300
+
+    # When evicting entries, the store is shrunk to this fraction of the
+    # maximum size, so that eviction doesn't run on every write.
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+        # The size of the store, as last computed by this process plus
+        # anything this process has written since. This is recomputed
+        # whenever entries are evicted.
+        self._size = None
+
+    def get(self, key):
+        filename = self._get_filename(key)
+
+        try:
+            f = open(filename, 'rb')
+
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return None
+
+        try:
+            version, chunks = pickle.loads(zlib.decompress(data))
+        except Exception, e:
+            logging.warning("Unable to load stored diff chunks from %s: %s"
+                            % (filename, e))
+            self._remove(filename)
+            return None
+
+        if version != VERSION:
+            # This was stored by a different version of Review Board, which
+            # may have generated the chunks differently.
+            self._remove(filename)
+            return None
+
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        return chunks
+
+    def set(self, key, chunks):
+        data = zlib.compress(pickle.dumps((VERSION, chunks),
+                                          pickle.HIGHEST_PROTOCOL))
+
+        if len(data) > self.max_size * self.EVICTION_TARGET:
+            return
+
+        filename = self._get_filename(key)
+        dirname = os.path.dirname(filename)
+
+        try:
+            try:
+                os.makedirs(dirname)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            # Write to a temporary file first, so that other processes
+            # never see a partially written entry.
+            fd, temp_filename = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+            os.rename(temp_filename, filename)
+            self._add_ref(key)
+        except (IOError, OSError), e:
+            logging.error("Unable to store diff chunks in %s: %s"
+                          % (filename, e))
+            return
+
+        if self._size is None:
+            self._size = self._get_recorded_size()
+
+        if self._size is None:
+            self.evict()
+        else:
+            self._size += len(data)
+
+            if self._size > self.max_size:
+                self.evict()
+
+    def invalidate(self, filediff_ids):
+        for filediff_id in filediff_ids:
+            dirname = os.path.join(self.path, str(filediff_id))
+
+            try:
+                filenames = os.listdir(dirname)
+            except OSError:
+                continue
+
+            # Remove the interdiffs against this filediff, which are stored
+            # with the other filediffs.
+            for filename in filenames:
+                if filename.endswith(self.REF_EXT):
+                    other_id, name = \
+                        filename[:-len(self.REF_EXT)].split('-', 1)
+                    self._remove(self._get_filename((other_id, name)))
+
+            shutil.rmtree(dirname, ignore_errors=True)
+
+    def evict(self):
+        """
+        Removes the least recently used entries if the store is over its
+        size budget.
+        """
+        entries = []
+        total_size = 0
+
+        for path, size, mtime in self._get_entries():
+            entries.append((mtime, size, path))
+            total_size += size
+
+        if total_size > self.max_size:
+            target_size = self.max_size * self.EVICTION_TARGET
+            entries.sort()
+
+            for mtime, size, path in entries:
+                if total_size <= target_size:
+                    break
+
+                self._remove_entry(path)
+                total_size -= size
+
+        self._size = total_size
+        self._record_size(total_size)
+
+    def _get_filename(self, key):
+        filediff_id, name = key
+
+        return os.path.join(self.path, str(filediff_id), name + self.FILE_EXT)
+
+    def _get_ref_filename(self, key):
+        """
+        Returns the filename of the reference to an interdiff entry, or None
+        if the key isn't for an interdiff against another filediff.
+        """
+        filediff_id, name = key
+        m = self.INTERDIFF_RE.search(name)
+
+        if m:
+            return os.path.join(self.path, m.group(1),
+                                '%s-%s%s' % (filediff_id, name, self.REF_EXT))
+
+        return None
+
+    def _add_ref(self, key):
+        ref_filename = self._get_ref_filename(key)
+
+        if ref_filename:
+            try:
+                os.makedirs(os.path.dirname(ref_filename))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            open(ref_filename, 'wb').close()
+
+    def _remove_entry(self, path):
+        """Removes an entry and the reference to it, if any."""
+        self._remove(path)
+
+        key = (os.path.basename(os.path.dirname(path)),
+               os.path.basename(path)[:-len(self.FILE_EXT)])
+        ref_filename = self._get_ref_filename(key)
+
+        if ref_filename:
+            self._remove(ref_filename)
+
+    def _is_dangling_ref(self, filename):
+        """Returns whether the entry a reference points to is gone."""
+        key = filename[:-len(self.REF_EXT)].split('-', 1)
+
+        return not os.path.exists(self._get_filename(key))
+
+    def _get_recorded_size(self):
+        """
+        Returns the size recorded by the last eviction check, or None if
+        there wasn't one recently.
+        """
+        filename = os.path.join(self.path, self.EVICTION_FILENAME)
+
+        try:
+            if time.time() - os.path.getmtime(filename) > \
+               self.EVICTION_INTERVAL:
+                return None
+
+            f = open(filename, 'rb')
+
+            try:
+                return int(f.read())
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _record_size(self, size):
+        try:
+            fd, temp_filename = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+
+            try:
+                os.write(fd, str(size))
+            finally:
+                os.close(fd)
+
+            os.rename(temp_filename,
+                      os.path.join(self.path, self.EVICTION_FILENAME))
+        except (IOError, OSError), e:
+            logging.warning("Unable to record the size of the chunk store "
+                            "in %s: %s" % (self.path, e))
+
+    def _get_entries(self):
+        """
+        Yields the path, size and modification time of every entry.
+
+        References to entries that are gone are removed along the way, as
+        are directories left empty by evictions.
+        """
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            num_files = len(filenames)
+
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+
+                if filename.endswith(self.FILE_EXT):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        # It was removed by another process.
+                        continue
+
+                    yield path, stat.st_size, stat.st_mtime
+                elif (filename.endswith(self.REF_EXT) and
+                      self._is_dangling_ref(filename)):
+                    self._remove(path)
+                    num_files -= 1
+
+            if dirpath != self.path and not num_files and not dirnames:
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+# A mapping of chunk store backend names to classes.
+chunk_store_backend_map = {
+    'disk': DiskChunkStore,
+}
+
+_chunk_store = None
+_chunk_store_settings = None
+
+
+def get_chunk_store():
+    """
+    Returns the chunk store configured for the site, or None if chunks
+    should only be stored in memcached.
+    """
+    global _chunk_store
+    global _chunk_store_settings
+
+    siteconfig = SiteConfiguration.objects.get_current()
+    backend = siteconfig.get('diffviewer_chunk_store_backend')
+    path = siteconfig.get('diffviewer_chunk_store_path')
+    max_size = siteconfig.get('diffviewer_chunk_store_max_size') * 1024 * 1024
+
+    if backend not in chunk_store_backend_map or not path or max_size <= 0:
+        return None
+
+    settings = (backend, path, max_size)
+
+    if settings != _chunk_store_settings:
+        _chunk_store = chunk_store_backend_map[backend](path, max_size)
+        _chunk_store_settings = settings
+
+    return _chunk_store
+
+
+def diffset_deleted_cb(sender, instance, **kwargs):
+    """Invalidates the stored chunks for a DiffSet that's being deleted."""
+    store = get_chunk_store()
+
+    if store:
+        store.invalidate(instance.files.values_list('id', flat=True))
@@ -3,15 +3,10 @@ import os
 import re
 import subprocess
 import tempfile
+import time
+import zlib
 from difflib import SequenceMatcher
-
-try:
-    import pygments
-    from pygments.lexers import get_lexer_for_filename
-    # from pygments.lexers import guess_lexer_for_filename
-    from pygments.formatters import HtmlFormatter
-except ImportError:
-    pass
+from multiprocessing.pool import ThreadPool
 
 from django.utils.html import escape
 from django.utils.http import urlquote
@@ -24,12 +19,21 @@ from djblets.util.misc import cache_memoize
 
 from reviewboard.accounts.models import Profile
 from reviewboard.admin.checks import get_can_enable_syntax_highlighting
+from reviewboard.diffviewer.chunklines import ChunkIndex, ChunkLines
+from reviewboard.diffviewer.chunkstore import get_chunk_store
+from reviewboard.diffviewer.headers import HeaderMatcher
+from reviewboard.diffviewer.highlighting import LexerCache, highlight
+from reviewboard.diffviewer.histogramdiff import HistogramDiffer
+from reviewboard.diffviewer.models import FileDiff, get_file_list_version
 from reviewboard.diffviewer.myersdiff import MyersDiffer
+from reviewboard.diffviewer.patcher import PatchError, \
+                                           UnsupportedPatchError, \
+                                           apply_patch
 from reviewboard.diffviewer.smdiff import SMDiffer
 from reviewboard.scmtools.core import PRE_CREATION, HEAD
 
 
-DEFAULT_DIFF_COMPAT_VERSION = 1
+DEFAULT_DIFF_COMPAT_VERSION = 2
 
 NEW_FILE_STR = _("New File")
 NEW_CHANGE_STR = _("New Change")
@@ -39,6 +43,23 @@ NEWLINE_CONVERSION_RE = re.compile(r'\r(\r?\n)?')
 
 ALPHANUM_RE = re.compile(r'\w')
 WHITESPACE_RE = re.compile(r'\s')
+EXTRA_WHITESPACE_RE = re.compile(r'(\s+(</span>)?$| +\t)')
+
+# The version of the format of generated chunks. This must be bumped
+# whenever the markup generated for lines, the ChunkLines layout or the
+# chunks' metadata changes, so that chunks in the old format, in memcached
+# or the chunk store, aren't used. See get_chunks_version.
+CHUNK_FORMAT_VERSION = 3
+
+# The most places a line can have been deleted from and still start a run
+# of moved lines. See find_moved_lines.
+MAX_MOVE_CANDIDATES = 50
+
+# How much of the diff viewer's work is done for a file, depending on its
+# size. This is stored in the "large_file_tier" metadata of each chunk.
+LARGE_FILE_FULL = 'full'
+LARGE_FILE_REDUCED = 'reduced'
+LARGE_FILE_TOO_LARGE = 'too-large'
 
 
 # A list of regular expressions for headers in the source code that we can
@@ -141,32 +162,50 @@ class DiffCompatError(Exception):
     pass
 
 
-class NoWrapperHtmlFormatter(HtmlFormatter):
-    """An HTML Formatter for Pygments that don't wrap items in a div."""
-    def __init__(self, *args, **kwargs):
-        super(NoWrapperHtmlFormatter, self).__init__(*args, **kwargs)
+_lexer_cache = None
 
-    def _wrap_div(self, inner):
-        """
-        Method called by the formatter to wrap the contents of inner.
-        Inner is a list of tuples containing formatted code. If the first item
-        in the tuple is zero, then it's a wrapper, so we should ignore it.
-        """
-        for tup in inner:
-            if tup[0]:
-                yield tup
+
+def get_lexer_for_file(filename):
+    """
+    Returns the Pygments lexer for a file, or None if there isn't one.
+
+    Lexers are cached by filename. The diffviewer_lexer_overrides setting
+    can be used to pick the lexer for certain filename patterns.
+    """
+    global _lexer_cache
+
+    siteconfig = SiteConfiguration.objects.get_current()
+    overrides = [tuple(override)
+                 for override in siteconfig.get('diffviewer_lexer_overrides')]
+
+    if _lexer_cache is None or _lexer_cache.overrides != overrides:
+        _lexer_cache = LexerCache(overrides)
+
+    return _lexer_cache.get_lexer(filename)
 
 
 def Differ(a, b, ignore_space=False,
-           compat_version=DEFAULT_DIFF_COMPAT_VERSION):
+           compat_version=DEFAULT_DIFF_COMPAT_VERSION, large_file=False):
     """
     Factory wrapper for returning a differ class based on the compat version
     and flags specified.
+
+    Starting with compat version 2, files with at least as many lines as
+    the diffviewer_histogram_diff_threshold setting, or any files if
+    large_file is True, are diffed using the histogram diff algorithm.
     """
     if compat_version == 0:
         return SMDiffer(a, b)
     elif compat_version == 1:
         return MyersDiffer(a, b, ignore_space)
+    elif compat_version == 2:
+        siteconfig = SiteConfiguration.objects.get_current()
+        threshold = siteconfig.get('diffviewer_histogram_diff_threshold')
+
+        if large_file or (threshold and max(len(a), len(b)) >= threshold):
+            return HistogramDiffer(a, b, ignore_space)
+        else:
+            return MyersDiffer(a, b, ignore_space)
     else:
         raise DiffCompatError(
             "Invalid diff compatibility version (%s) passed to Differ" %
@@ -195,16 +234,50 @@ def convert_line_endings(data):
     return NEWLINE_CONVERSION_RE.sub('\n', data)
 
 
-def patch(diff, file, filename):
-    """Apply a diff to a file.  Delegates out to `patch` because noone
-       except Larry Wall knows how to patch."""
+def patch(diff, file, filename, engine=None):
+    """Apply a diff to a file.
 
-    log_timer = log_timed("Patching file %s" % filename)
+    By default, this uses the in-process patcher (see
+    reviewboard.diffviewer.patcher), which produces the same results as
+    GNU patch without the cost of spawning a process and writing temporary
+    files. The ``diffviewer_patch_engine`` site configuration setting (or
+    the ``engine`` parameter) can be set to ``"external"`` to delegate out
+    to `patch` instead, because noone except Larry Wall knows how to patch.
 
+    Diffs that the in-process patcher doesn't understand (such as context
+    diffs) are always handed off to `patch`.
+    """
     if diff.strip() == "":
         # Someone uploaded an unchanged file. Return the one we're patching.
         return file
 
+    if engine is None:
+        siteconfig = SiteConfiguration.objects.get_current()
+        engine = siteconfig.get('diffviewer_patch_engine')
+
+    if engine == 'builtin':
+        log_timer = log_timed("Patching file %s in-process" % filename)
+
+        try:
+            data = apply_patch(convert_line_endings(diff),
+                               convert_line_endings(file),
+                               filename)
+            log_timer.done()
+
+            return data
+        except UnsupportedPatchError:
+            log_timer.done()
+        except PatchError:
+            log_timer.done()
+            raise
+
+    return _patch_external(diff, file, filename)
+
+
+def _patch_external(diff, file, filename):
+    """Apply a diff to a file by delegating out to `patch`."""
+    log_timer = log_timed("Patching file %s" % filename)
+
     # Prepare the temporary directory if none is available
     tempdir = tempfile.mkdtemp(prefix='reviewboard.')
 
@@ -255,13 +328,74 @@ def patch(diff, file, filename):
 
 
 def get_line_changed_regions(oldline, newline):
-    if oldline is None or newline is None:
-        return (None, None)
+    """
+    Returns the changed regions of the old and new versions of a line.
+
+    The regions are lists of (start, end) character ranges. If the lines are
+    too different for the regions to be useful, (None, None) is returned.
+    """
+    return get_lines_changed_regions([(oldline, newline)])[0]
+
+
+def get_lines_changed_regions(pairs, cache=None):
+    """
+    Returns the changed regions for a list of (old line, new line) pairs.
+
+    This gives the same results as calling get_line_changed_regions on each
+    pair, but is much faster on large numbers of pairs, like the lines of a
+    reformatted file:
+
+    * Pairs whose lengths alone are too different to reach the similarity
+      threshold are skipped without comparing any characters, followed by
+      pairs that don't have enough characters in common.
+    * Results are stored in cache, if it's given, so that pairs that are
+      repeated in a file are only compared once.
+    * One SequenceMatcher is reused for all the pairs.
+    """
+    if cache is None:
+        cache = {}
 
     # Use the SequenceMatcher directly. It seems to give us better results
     # for this. We should investigate steps to move to the new differ.
-    differ = SequenceMatcher(None, oldline, newline)
+    differ = SequenceMatcher(None, '', '')
+    results = []
+
+    for pair in pairs:
+        try:
+            results.append(cache[pair])
+            continue
+        except KeyError:
+            pass
 
+        oldline, newline = pair
+
+        if oldline is None or newline is None:
+            regions = (None, None)
+        elif oldline == newline:
+            regions = ([], [])
+        else:
+            # This is the same upper bound as real_quick_ratio(), without
+            # having SequenceMatcher index the new line first.
+            total_len = len(oldline) + len(newline)
+
+            if 2.0 * min(len(oldline), len(newline)) / total_len < 0.6:
+                regions = (None, None)
+            else:
+                differ.set_seqs(oldline, newline)
+
+                if differ.quick_ratio() < 0.6:
+                    regions = (None, None)
+                else:
+                    regions = _get_matcher_changed_regions(differ, oldline,
+                                                           newline)
+
+        cache[pair] = regions
+        results.append(regions)
+
+    return results
+
+
+def _get_matcher_changed_regions(differ, oldline, newline):
     # This thresholds our results -- we don't want to show inter-line diffs if
     # most of the line has changed, unless those lines are very short.
 
@@ -365,13 +499,74 @@ def get_original_file(filediff):
 
     # If there's a parent diff set, apply it to the buffer.
     if filediff.parent_diff:
-        data = patch(filediff.parent_diff, data, filediff.source_file)
+        data = get_cached_file_data(
+            "diff-orig-file-%s" % filediff.get_content_key(),
+            lambda: patch(filediff.parent_diff, data, filediff.source_file))
 
     return data
 
 
 def get_patched_file(buffer, filediff):
-    return patch(filediff.diff, buffer, filediff.dest_file)
+    """
+    Returns the file with the filediff's diff applied to it.
+
+    The buffer is the original file, as returned by get_original_file. It
+    can be None, in which case the original file is only looked up if the
+    patched file isn't already cached.
+    """
+    def do_patch():
+        data = buffer
+
+        if data is None:
+            data = get_original_file(filediff)
+
+        return patch(filediff.diff, data, filediff.dest_file)
+
+    return get_cached_file_data(
+        "diff-patched-file-%s" % filediff.get_content_key(), do_patch)
+
+
+def get_cached_file_data(key, func):
+    """
+    Returns file data from the cache, generating it with func if needed.
+
+    The data is stored compressed. It's wrapped in a list in the cache for
+    the same reason as in get_original_file.
+    """
+    return zlib.decompress(
+        cache_memoize(key, lambda: [zlib.compress(func())],
+                      large_data=True)[0])
+
+
+_header_matchers = {}
+
+
+def get_header_matcher(filename):
+    """
+    Returns the HeaderMatcher for a file's language, or None if there isn't
+    one.
+
+    The language is found from the file's basename or extension. Each
+    language's matcher is compiled once and shared by all differs.
+    """
+    basename = os.path.basename(filename)
+
+    if basename in HEADER_REGEX_ALIASES:
+        language = HEADER_REGEX_ALIASES[basename]
+    else:
+        ext = os.path.splitext(basename)[1]
+        language = HEADER_REGEX_ALIASES.get(ext, ext)
+
+    if language not in HEADER_REGEXES:
+        return None
+
+    try:
+        return _header_matchers[language]
+    except KeyError:
+        matcher = HeaderMatcher(HEADER_REGEXES[language])
+        _header_matchers[language] = matcher
+
+        return matcher
 
 
 def register_interesting_lines_for_filename(differ, filename):
@@ -380,46 +575,464 @@ def register_interesting_lines_for_filename(differ, filename):
     This will add watches for headers (functions, classes, etc.) to the diff
     viewer. The regular expressions used are based on the filename provided.
     """
-    # Add any interesting lines we may want to show.
-    regexes = []
+    matcher = get_header_matcher(filename)
+
+    if matcher:
+        differ.add_interesting_line_regex('header', matcher)
+
+
+def get_diff_file_contents(diffset, filediff, interfilediff,
+                           force_interdiff):
+    """
+    Returns the old and new versions of a file shown in a diff.
 
-    if file in HEADER_REGEX_ALIASES:
-        regexes = HEADER_REGEXES[HEADER_REGEX_ALIASES[filename]]
+    See get_chunks for the ways a file can be shown. Both versions are
+    converted to UTF-8 and end with a newline, unless they're empty.
+    """
+    if interfilediff:
+        # The patched files are usually cached, in which case we don't need
+        # the original files at all.
+        old = get_patched_file(None, filediff)
+        new = get_patched_file(None, interfilediff)
     else:
-        basename, ext = os.path.splitext(filename)
+        old = get_original_file(filediff)
+        new = get_patched_file(old, filediff)
+
+        if force_interdiff:
+            # Basically, revert the change.
+            old, new = new, old
+
+    encoding = diffset.repository.encoding or 'iso-8859-15'
+    old = convert_to_utf8(old, encoding)
+    new = convert_to_utf8(new, encoding)
+
+    # Normalize the input so that if there isn't a trailing newline, we add
+    # it.
+    if old and old[-1] != '\n':
+        old += '\n'
 
-        if ext in HEADER_REGEXES:
-            regexes = HEADER_REGEXES[ext]
-        elif ext in HEADER_REGEX_ALIASES:
-            regexes = HEADER_REGEXES[HEADER_REGEX_ALIASES[ext]]
+    if new and new[-1] != '\n':
+        new += '\n'
 
-    for regex in regexes:
-        differ.add_interesting_line_regex('header', regex)
+    return old, new
 
 
-def get_chunks(diffset, filediff, interfilediff, force_interdiff,
-               enable_syntax_highlighting):
-    def diff_line(vlinenum, oldlinenum, newlinenum, oldline, newline,
-                  oldmarkup, newmarkup):
-        # This function accesses the variable meta, defined in an outer context.
-        if oldline and newline and oldline != newline:
-            oldregion, newregion = get_line_changed_regions(oldline, newline)
+def split_file_lines(data):
+    """Splits file contents from get_diff_file_contents into lines."""
+    lines = NEWLINES_RE.split(data or '')
+
+    # Remove the trailing newline, now that we've split this. This will
+    # prevent a duplicate line number at the end of the diff.
+    del(lines[-1])
+
+    return lines
+
+
+def can_highlight_file(a_num_lines, b_num_lines):
+    """
+    Returns whether a file is small enough to be syntax highlighted.
+
+    This is controlled by the diffviewer_syntax_highlighting_threshold
+    setting.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    threshold = siteconfig.get('diffviewer_syntax_highlighting_threshold')
+
+    return not threshold or (a_num_lines <= threshold and
+                             b_num_lines <= threshold)
+
+
+def get_file_markup(filediff, old, new, enable_syntax_highlighting):
+    """
+    Returns the lines of markup for the old and new text of a file.
+
+    The text can be all or part of each version of the file. It's
+    highlighted based on the filediff's file names, if highlighting is
+    enabled and there's a lexer for the file, and escaped otherwise.
+    """
+    markup_a = markup_b = None
+
+    if enable_syntax_highlighting:
+        repository = filediff.diffset.repository
+        tool = repository.get_scmtool()
+        source_file = tool.normalize_path_for_display(filediff.source_file)
+        dest_file = tool.normalize_path_for_display(filediff.dest_file)
+        source_lexer = get_lexer_for_file(source_file)
+
+        if dest_file == source_file:
+            dest_lexer = source_lexer
         else:
-            oldregion = newregion = []
+            dest_lexer = get_lexer_for_file(dest_file)
+
+        try:
+            if source_lexer:
+                markup_a = highlight(old or '', source_lexer)
+
+            if dest_lexer:
+                markup_b = highlight(new or '', dest_lexer)
+        except:
+            pass
+
+    if not markup_a:
+        markup_a = NEWLINES_RE.split(escape(old))
+
+    if not markup_b:
+        markup_b = NEWLINES_RE.split(escape(new))
+
+    return markup_a, markup_b
+
+
+def highlight_regions(markup, regions):
+    """
+    Highlights the specified regions of a line of markup.
+
+    This is used to insert ``<span class="hl">...</span>`` tags in the
+    markup as specified by the ``regions`` list of (start, end) ranges.
+    """
+    if not regions:
+        return markup
+
+    s = ""
+
+    # We need to insert span tags into a string already consisting
+    # of span tags. We have a list of ranges that our span tags should
+    # go into, but those ranges are in the markup-less string.
+    #
+    # We go through the string and keep track of the location in the
+    # markup and in the markup-less string. We make sure to insert our
+    # span tag any time that we're within the current region, so long
+    # as we haven't already created one. We close the span tag whenever
+    # we're done with the region or when we're about to enter a tag in
+    # the markup string.
+    #
+    # This code makes the assumption that the list of regions is sorted.
+    # This is safe to assume in practice, but if we ever at some point
+    # had reason to doubt it, we could always sort the regions up-front.
+    in_tag = in_entity = in_hl = False
+    i = j = r = 0
+    region = regions[r]
+
+    for i in xrange(len(markup)):
+        if markup[i] == "<":
+            in_tag = True
+
+            if in_hl:
+                s += "</span>"
+                in_hl = False
+        elif markup[i] == ">":
+            in_tag = False
+        elif markup[i] == ';' and in_entity:
+            in_entity = False
+            j += 1
+        elif not in_tag and not in_entity:
+            if not in_hl and region[0] <= j < region[1]:
+                s += '<span class="hl">'
+                in_hl = True
+
+            if markup[i] == '&':
+                in_entity = True
+            else:
+                j += 1
+
+        s += markup[i]
+
+        if j == region[1]:
+            r += 1
+
+            if in_hl:
+                s += '</span>'
+                in_hl = False
+
+            if r == len(regions):
+                break
 
-        result = [vlinenum,
-                  oldlinenum or '', mark_safe(oldmarkup or ''), oldregion,
-                  newlinenum or '', mark_safe(newmarkup or ''), newregion,
-                  (oldlinenum, newlinenum) in meta['whitespace_lines']]
+            region = regions[r]
 
-        if oldlinenum and oldlinenum in meta.get('moved', {}):
-            destination = meta["moved"][oldlinenum]
-            result.append(destination)
-        elif newlinenum and newlinenum in meta.get('moved', {}):
-            destination = meta["moved"][newlinenum]
-            result.append(destination)
+    if i + 1 < len(markup):
+        s += markup[i + 1:]
 
-        return result
+    return s
+
+
+def mark_extra_whitespace(markup):
+    """
+    Marks up any extra whitespace in a line of markup.
+
+    Any trailing whitespace or tabs following one or more spaces are
+    marked up by inserted ``<span class="ew">...</span>`` tags.
+    """
+    return EXTRA_WHITESPACE_RE.sub(r'<span class="ew">\1</span>', markup)
+
+
+def render_line_markup(markup, regions=None):
+    """
+    Returns the final markup for a line in a chunk.
+
+    The changed regions, if any, and extra whitespace are marked up here,
+    when the chunks are generated, so that the markup stored in the cached
+    chunks can be shown as-is.
+    """
+    if regions:
+        markup = highlight_regions(markup, regions)
+
+    return mark_extra_whitespace(markup)
+
+
+def get_ignore_space(filename, compat_version):
+    """
+    Returns whether the differ ignores leading whitespace for a file.
+
+    Leading whitespace is ignored unless the file matches one of the
+    diffviewer_include_space_patterns settings. The oldest differ never
+    ignores it.
+    """
+    if compat_version == 0:
+        return False
+
+    siteconfig = SiteConfiguration.objects.get_current()
+
+    for pattern in siteconfig.get("diffviewer_include_space_patterns"):
+        if fnmatch.fnmatch(filename, pattern):
+            return False
+
+    return True
+
+
+def normalize_line_space(line):
+    """
+    Returns a line as the differ compares it when ignoring whitespace.
+
+    Leading whitespace is removed, except from lines with nothing else.
+    """
+    return line.lstrip() or line
+
+
+def get_context_chunk(filediff, interfilediff, force_interdiff, first_line,
+                      old_line, new_line, num_lines,
+                      enable_syntax_highlighting):
+    """
+    Returns an "equal" chunk of lines, without generating the whole diff.
+
+    This is used to expand collapsed context in the diff viewer. Unchanged
+    lines line up one to one, so given the virtual line number of the first
+    line and its line numbers in the old and new files, the chunk can be
+    built from the old and new files directly. Those are usually cached,
+    and only the requested lines are highlighted.
+
+    Lines are highlighted without the code around them, which can differ
+    from the full diff for lines inside multi-line strings or comments.
+
+    The line numbers come from the client, so they're checked against the
+    file's chunks if those are cached. Otherwise, the lines must be the same
+    in both files, as the differ would compare them. The diff is never
+    generated here.
+
+    Raises UserVisibleError if the lines aren't all in one equal chunk at
+    the given line numbers.
+    """
+    def invalid_range():
+        return UserVisibleError(
+            _(u"Invalid line range %s-%s specified.") %
+            (first_line, first_line + num_lines - 1))
+
+    chunks = get_chunks_from_cache(filediff, interfilediff, force_interdiff,
+                                   enable_syntax_highlighting)
+
+    if chunks is not None:
+        chunk_index = ChunkIndex(chunks)
+        i = chunk_index.find_chunk(first_line)
+        valid = False
+
+        if i is not None and num_lines >= 1:
+            chunk = chunks[i]
+            offset = first_line - chunk_index.starts[i]
+
+            if (chunk['change'] == 'equal' and
+                offset + num_lines <= len(chunk['lines'])):
+                line = chunk['lines'][offset]
+                valid = (line[1] == old_line and line[4] == new_line)
+
+        if not valid:
+            raise invalid_range()
+
+    diffset = filediff.diffset
+    old, new = get_diff_file_contents(diffset, filediff, interfilediff,
+                                      force_interdiff)
+    a = split_file_lines(old)
+    b = split_file_lines(new)
+
+    i1 = old_line - 1
+    i2 = i1 + num_lines
+    j1 = new_line - 1
+    j2 = j1 + num_lines
+
+    if (num_lines < 1 or i1 < 0 or j1 < 0 or
+        i2 > len(a) or j2 > len(b)):
+        raise invalid_range()
+
+    if chunks is None:
+        if get_ignore_space(filediff.source_file, diffset.diffcompat):
+            normalize = normalize_line_space
+        else:
+            normalize = lambda line: line
+
+        if map(normalize, a[i1:i2]) != map(normalize, b[j1:j2]):
+            raise invalid_range()
+
+    if not can_highlight_file(len(a), len(b)):
+        enable_syntax_highlighting = False
+
+    old_lines = a[i1:i2]
+    new_lines = b[j1:j2]
+    markup_a, markup_b = get_file_markup(filediff,
+                                         '\n'.join(old_lines) + '\n',
+                                         '\n'.join(new_lines) + '\n',
+                                         enable_syntax_highlighting)
+    markup_a = markup_a[:num_lines]
+    markup_a += [''] * (num_lines - len(markup_a))
+    markup_b = markup_b[:num_lines]
+    markup_b += [''] * (num_lines - len(markup_b))
+    markup_a = [render_line_markup(line) for line in markup_a]
+    markup_b = [render_line_markup(line) for line in markup_b]
+
+    return {
+        'lines': ChunkLines(first_line, num_lines,
+                            old_line, num_lines, new_line, num_lines,
+                            ChunkLines.pack_markup(markup_a),
+                            ChunkLines.pack_markup(markup_b)),
+        'numlines': num_lines,
+        'change': 'equal',
+        'collapsable': False,
+        'meta': {},
+    }
+
+
+def get_large_file_tier(old, new, a_num_lines, b_num_lines):
+    """
+    Returns how much of the diff viewer's work should be done for a file.
+
+    old and new are the contents of the two versions of the file, and
+    a_num_lines and b_num_lines are their line counts. This returns one of:
+
+    * LARGE_FILE_FULL, for files within the diffviewer_large_file_lines and
+      diffviewer_large_file_bytes settings.
+    * LARGE_FILE_REDUCED, for larger files. These are diffed with the
+      histogram diff algorithm, without moved lines or changed regions.
+    * LARGE_FILE_TOO_LARGE, for files past the diffviewer_max_file_lines or
+      diffviewer_max_file_bytes settings. These aren't diffed at all.
+
+    A setting of 0 means there's no limit.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    num_lines = max(a_num_lines, b_num_lines)
+    num_bytes = max(len(old or ''), len(new or ''))
+
+    def exceeds(lines_key, bytes_key):
+        max_lines = siteconfig.get(lines_key)
+        max_bytes = siteconfig.get(bytes_key)
+
+        return ((max_lines and num_lines > max_lines) or
+                (max_bytes and num_bytes > max_bytes))
+
+    if exceeds('diffviewer_max_file_lines', 'diffviewer_max_file_bytes'):
+        return LARGE_FILE_TOO_LARGE
+    elif exceeds('diffviewer_large_file_lines', 'diffviewer_large_file_bytes'):
+        return LARGE_FILE_REDUCED
+    else:
+        return LARGE_FILE_FULL
+
+
+def is_diff_too_large(filediff, interfilediff):
+    """
+    Returns whether a file is known to be too large to diff from its
+    FileDiffs alone, before fetching or patching anything.
+
+    The versions of the file being compared have at least as many lines as
+    the diffs inserted, and the original file has at least as many as were
+    deleted, so these are checked against the diffviewer_max_file_lines
+    setting. Line counts that haven't been filled in yet are skipped. The
+    size of a diff says little about the size of the files, so the byte
+    limit is only checked once the files are loaded.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    max_lines = siteconfig.get('diffviewer_max_file_lines')
+
+    if not max_lines:
+        return False
+
+    line_counts = [filediff.inserted_lines]
+
+    if interfilediff:
+        line_counts.append(interfilediff.inserted_lines)
+    else:
+        line_counts.append(filediff.deleted_lines)
+
+    for num_lines in line_counts:
+        if num_lines is not None and num_lines > max_lines:
+            return True
+
+    return False
+
+
+def get_chunks(diffset, filediff, interfilediff, force_interdiff,
+               enable_syntax_highlighting):
+    def diff_lines(vlinenum, i1, i2, j1, j2, tag, meta):
+        numlines = max(i2 - i1, j2 - j1)
+        regions = {}
+        whitespace_lines = set()
+        moved = {}
+
+        region_indexes = []
+        region_pairs = []
+
+        if tier[0] == LARGE_FILE_FULL:
+            for i, (oldline, newline) in enumerate(zip(a[i1:i2], b[j1:j2])):
+                if oldline and newline and oldline != newline:
+                    region_indexes.append(i)
+                    region_pairs.append((oldline, newline))
+
+        for i, line_regions in zip(region_indexes,
+                                   get_lines_changed_regions(region_pairs,
+                                                             region_cache)):
+            if line_regions != ([], []):
+                regions[i] = line_regions
+
+        for oldlinenum, newlinenum in meta['whitespace_lines']:
+            i = oldlinenum - i1 - 1
+
+            if newlinenum - j1 - 1 == i and 0 <= i < numlines:
+                whitespace_lines.add(i)
+
+        if meta.get('moved'):
+            for i in xrange(numlines):
+                if i < i2 - i1 and i1 + i + 1 in meta['moved']:
+                    moved[i] = meta['moved'][i1 + i + 1]
+                elif i < j2 - j1 and j1 + i + 1 in meta['moved']:
+                    moved[i] = meta['moved'][j1 + i + 1]
+
+        # The highlighter may have returned fewer lines than there are in
+        # the file. Those lines are shown without markup.
+        oldmarkup = markup_a[i1:i2]
+        oldmarkup += [''] * (i2 - i1 - len(oldmarkup))
+        newmarkup = markup_b[j1:j2]
+        newmarkup += [''] * (j2 - j1 - len(newmarkup))
+
+        # Changed regions are only highlighted in replaced lines. They're
+        # still stored for the other lines, for anything that needs them.
+        if tag == 'replace':
+            oldmarkup = [render_line_markup(line, regions.get(i, ([], []))[0])
+                         for i, line in enumerate(oldmarkup)]
+            newmarkup = [render_line_markup(line, regions.get(i, ([], []))[1])
+                         for i, line in enumerate(newmarkup)]
+        else:
+            oldmarkup = [render_line_markup(line) for line in oldmarkup]
+            newmarkup = [render_line_markup(line) for line in newmarkup]
+
+        return ChunkLines(vlinenum, numlines,
+                          i1 + 1, i2 - i1, j1 + 1, j2 - j1,
+                          ChunkLines.pack_markup(oldmarkup),
+                          ChunkLines.pack_markup(newmarkup),
+                          regions, frozenset(whitespace_lines), moved)
 
     def new_chunk(lines, start, end, collapsable=False,
                   tag='equal', meta=None):
@@ -433,6 +1046,7 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
 
         meta['left_headers'] = left_headers
         meta['right_headers'] = right_headers
+        meta['large_file_tier'] = tier[0]
 
         if left_headers:
             last_header[0] = left_headers[-1][1]
@@ -494,24 +1108,6 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
         else:
             last_header_index[0] = last_index
 
-    def apply_pygments(data, filename):
-        # XXX Guessing is preferable but really slow, especially on XML
-        #     files.
-        #if filename.endswith(".xml"):
-        lexer = get_lexer_for_filename(filename, stripnl=False,
-                                       encoding='utf-8')
-        #else:
-        #    lexer = guess_lexer_for_filename(filename, data, stripnl=False)
-
-        try:
-            # This is only available in 0.7 and higher
-            lexer.add_filter('codetagify')
-        except AttributeError:
-            pass
-
-        return pygments.highlight(data, lexer, NoWrapperHtmlFormatter()).splitlines()
-
-
     # There are three ways this function is called:
     #
     #     1) filediff, no interfilediff
@@ -548,80 +1144,63 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
 
     file = filediff.source_file
 
-    old = get_original_file(filediff)
-    new = get_patched_file(old, filediff)
-
-    if interfilediff:
-        old = new
-        interdiff_orig = get_original_file(interfilediff)
-        new = get_patched_file(interdiff_orig, interfilediff)
-    elif force_interdiff:
-        # Basically, revert the change.
-        old, new = new, old
-
-    encoding = diffset.repository.encoding or 'iso-8859-15'
-    old = convert_to_utf8(old, encoding)
-    new = convert_to_utf8(new, encoding)
-
-    # Normalize the input so that if there isn't a trailing newline, we add
-    # it.
-    if old and old[-1] != '\n':
-        old += '\n'
-
-    if new and new[-1] != '\n':
-        new += '\n'
-
-    a = NEWLINES_RE.split(old or '')
-    b = NEWLINES_RE.split(new or '')
-
-    # Remove the trailing newline, now that we've split this. This will
-    # prevent a duplicate line number at the end of the diff.
-    del(a[-1])
-    del(b[-1])
-
-    a_num_lines = len(a)
-    b_num_lines = len(b)
-
-    markup_a = markup_b = None
+    if is_diff_too_large(filediff, interfilediff):
+        # There's no point in fetching and patching the files.
+        tier = LARGE_FILE_TOO_LARGE
+    else:
+        old, new = get_diff_file_contents(diffset, filediff, interfilediff,
+                                          force_interdiff)
+        a = split_file_lines(old)
+        b = split_file_lines(new)
+
+        a_num_lines = len(a)
+        b_num_lines = len(b)
+
+        tier = get_large_file_tier(old, new, a_num_lines, b_num_lines)
+
+    if tier == LARGE_FILE_TOO_LARGE:
+        # The file isn't diffed. The diff viewer shows a link to download
+        # the diff instead.
+        yield {
+            'lines': [],
+            'numlines': 0,
+            'change': 'equal',
+            'collapsable': False,
+            'meta': {
+                'large_file_tier': LARGE_FILE_TOO_LARGE,
+            },
+        }
+        return
 
     siteconfig = SiteConfiguration.objects.get_current()
 
-    threshold = siteconfig.get('diffviewer_syntax_highlighting_threshold')
+    # This is a list so that it can be changed from within diff_lines and
+    # new_chunk, if the file runs out of time.
+    tier = [tier]
 
-    if threshold and (a_num_lines > threshold or b_num_lines > threshold):
-        enable_syntax_highlighting = False
+    time_budget = siteconfig.get('diffviewer_file_time_budget')
 
-    if enable_syntax_highlighting:
-        repository = filediff.diffset.repository
-        tool = repository.get_scmtool()
-        source_file = tool.normalize_path_for_display(filediff.source_file)
-        dest_file = tool.normalize_path_for_display(filediff.dest_file)
-        try:
-            # TODO: Try to figure out the right lexer for these files
-            #       once instead of twice.
-            markup_a = apply_pygments(old or '', source_file)
-            markup_b = apply_pygments(new or '', dest_file)
-        except:
-            pass
+    if time_budget:
+        deadline = time.time() + time_budget
+    else:
+        deadline = None
 
-    if not markup_a:
-        markup_a = NEWLINES_RE.split(escape(old))
+    if not can_highlight_file(a_num_lines, b_num_lines):
+        enable_syntax_highlighting = False
 
-    if not markup_b:
-        markup_b = NEWLINES_RE.split(escape(new))
+    markup_a, markup_b = get_file_markup(filediff, old, new,
+                                         enable_syntax_highlighting)
 
     linenum = 1
     last_header = [None, None]
     last_header_index = [0, 0]
+    region_cache = {}
 
-    ignore_space = True
-    for pattern in siteconfig.get("diffviewer_include_space_patterns"):
-        if fnmatch.fnmatch(file, pattern):
-            ignore_space = False
-            break
+    ignore_space = get_ignore_space(file, diffset.diffcompat)
 
     differ = Differ(a, b, ignore_space=ignore_space,
-                    compat_version=diffset.diffcompat)
+                    compat_version=diffset.diffcompat,
+                    large_file=(tier[0] != LARGE_FILE_FULL))
 
     # Register any regexes for interesting lines we may want to show.
     register_interesting_lines_for_filename(differ, file)
@@ -639,15 +1218,34 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
             "Generating diff chunks for filediff id %s (%s)" %
             (filediff.id, filediff.source_file))
 
-    for tag, i1, i2, j1, j2, meta in opcodes_with_metadata(differ):
-        oldlines = markup_a[i1:i2]
-        newlines = markup_b[j1:j2]
-        numlines = max(len(oldlines), len(newlines))
+    move_timeout = siteconfig.get('diffviewer_move_detection_timeout')
+    detect_moves = (tier[0] == LARGE_FILE_FULL)
+
+    if detect_moves and deadline is not None:
+        # Move detection gets whatever is left of the file's time budget,
+        # if that's less than its own limit.
+        remaining = deadline - time.time()
+
+        if remaining <= 0:
+            detect_moves = False
+        elif not move_timeout or remaining < move_timeout:
+            move_timeout = remaining
 
-        lines = map(diff_line,
-                    xrange(linenum, linenum + numlines),
-                    xrange(i1 + 1, i2 + 1), xrange(j1 + 1, j2 + 1),
-                    a[i1:i2], b[j1:j2], oldlines, newlines)
+    opcodes = opcodes_with_metadata(
+        differ,
+        siteconfig.get('diffviewer_move_detection_min_lines'),
+        move_timeout,
+        detect_moves)
+
+    for tag, i1, i2, j1, j2, meta in opcodes:
+        if (tier[0] == LARGE_FILE_FULL and deadline is not None and
+            time.time() > deadline):
+            # The file is out of time. The rest of it is shown without
+            # changed regions.
+            tier[0] = LARGE_FILE_REDUCED
+
+        lines = diff_lines(linenum, i1, i2, j1, j2, tag, meta)
+        numlines = len(lines)
 
         if tag == 'equal' and numlines > collapse_threshold:
             last_range_start = numlines - context_num_lines
@@ -691,18 +1289,24 @@ def is_valid_move_range(lines):
     return False
 
 
-def opcodes_with_metadata(differ):
+def opcodes_with_metadata(differ, min_move_lines=1, move_timeout=None,
+                          detect_moves=True):
     """Returns opcodes from the differ with extra metadata.
 
     This is a wrapper around a differ's get_opcodes function, which returns
     extra metadata along with each range. That metadata includes information
     on moved blocks of code and whitespace-only lines.
 
+    Moved blocks shorter than min_move_lines aren't shown. If finding them
+    takes longer than move_timeout seconds, or detect_moves is False, no
+    moves are shown for the file, and "moves_skipped" is set in the metadata
+    of every changed range.
+
     This returns a list of opcodes as tuples in the form of
     (tag, i1, i2, j1, j2, meta).
     """
     groups = []
-    removes = {}
+    removes = []
     inserts = []
 
     for tag, i1, i2, j1, j2 in differ.get_opcodes():
@@ -734,178 +1338,177 @@ def opcodes_with_metadata(differ):
         group = (tag, i1, i2, j1, j2, meta)
         groups.append(group)
 
-        # Store delete/insert ranges for later lookup. We will be building
-        # keys that in most cases will be unique for the particular block
-        # of text being inserted/deleted. There is a chance of collision,
-        # so we store a list of matching groups under that key.
-        #
-        # Later, we will loop through the keys and attempt to find insert
-        # keys/groups that match remove keys/groups.
         if tag == 'delete':
-            for i in xrange(i1, i2):
-                line = differ.a[i].strip()
-
-                if line:
-                    removes.setdefault(line, []).append((i, group))
+            removes.append(group)
         elif tag == 'insert':
             inserts.append(group)
 
-    # We now need to figure out all the moved locations.
-    #
-    # At this point, we know all the inserted groups, and all the individually
-    # deleted lines. We'll be going through and finding consecutive groups
-    # of matching inserts/deletes that represent a move block.
-    #
-    # The algorithm will be documented as we go in the code.
-    #
-    # We start by looping through all the inserted groups.
-    for itag, ii1, ii2, ij1, ij2, imeta in inserts:
-        # Store some state on the range we'll be working with inside this
-        # insert group.
-        #
-        # i_move_cur is the current location inside the insert group
-        # (from ij1 through ij2).
-        #
-        # i_move_range is the current range of consecutive lines that we'll
-        # use for a move. Each line in this range has a corresponding
-        # consecutive delete line.
-        #
-        # r_move_ranges represents deleted move ranges. The key is a
-        # string in the form of "{i1}-{i2}-{j1}-{j2}", with those positions
-        # taken from the remove group for the line. The value
-        # is an array of tuples of (r_start, r_end, r_group). These values
-        # are used to quickly locate deleted lines we've found that match
-        # the inserted lines, so we can assemble ranges later.
-        i_move_cur = ij1
-        i_move_range = (i_move_cur, i_move_cur)
-        r_move_ranges = {} # key -> [(start, end, group)]
-
-        # Loop through every location from ij1 through ij2 until we've
-        # reached the end.
-        while i_move_cur <= ij2:
-            try:
-                iline = differ.b[i_move_cur].strip()
-            except IndexError:
-                iline = None
-
-            if iline is not None and iline in removes:
-                # The inserted line at this location has a corresponding
-                # removed line.
-                #
-                # If there's already some information on removed line ranges
-                # for this particular move block we're processing then we'll
-                # update the range.
-                #
-                # The way we do that is to find each removed line that
-                # matches this inserted line, and for each of those find
-                # out if there's an existing move range that the found
-                # removed line immediately follows. If there is, we update
-                # the existing range.
-                #
-                # If there isn't any move information for this line, we'll
-                # simply add it to the move ranges.
-                for ri, rgroup in removes.get(iline, []):
-                    key = "%s-%s-%s-%s" % rgroup[1:5]
-
-                    if r_move_ranges:
-                        for i, r_move_range in \
-                            enumerate(r_move_ranges.get(key, [])):
-                            # If the remove information for the line is next in
-                            # the sequence for this calculated move range...
-                            if ri == r_move_range[1] + 1:
-                                r_move_ranges[key][i] = (r_move_range[0], ri,
-                                                         rgroup)
-                                break
-                    else:
-                        # We don't have any move ranges yet, so it's time to
-                        # build one based on any removed lines we find that
-                        # match the inserted line.
-                        r_move_ranges[key] = [(ri, ri, rgroup)]
-
-                # On to the next line in the sequence...
-                i_move_cur += 1
-            else:
-                # We've reached the very end of the insert group. See if
-                # we have anything that looks like a move.
-                if r_move_ranges:
-                    r_move_range = None
-
-                    # Go through every range of lines we've found and
-                    # find the longest.
-                    #
-                    # The longest move range wins. If we find two ranges that
-                    # are equal, though, we'll ignore both. The idea is that
-                    # if we have two identical moves, then it's probably
-                    # common enough code that we don't want to show the move.
-                    # An example might be some standard part of a comment
-                    # block, with no real changes in content.
-                    #
-                    # Note that with the current approach, finding duplicate
-                    # moves doesn't cause us to reset the winning range
-                    # to the second-highest identical match. We may want to
-                    # do that down the road, but it means additional state,
-                    # and this is hopefully uncommon enough to not be a real
-                    # problem.
-                    for ranges in r_move_ranges.itervalues():
-                        for r1, r2, rgroup in ranges:
-                            if not r_move_range:
-                                r_move_range = (r1, r2, rgroup)
-                            else:
-                                len1 = r_move_range[2] - r_move_range[1]
-                                len2 = r2 - r1
-
-                                if len1 < len2:
-                                    r_move_range = (r1, r2, rgroup)
-                                elif len1 == len2:
-                                    # If there are two that are the same, it
-                                    # may be common code that we don't want to
-                                    # see moves for. Comments, for example.
-                                    r_move_range = None
-
-                    # If we have a move range, see if it's one we want to
-                    # include or filter out. Some moves are not impressive
-                    # enough to display. For example, a small portion of a
-                    # comment, or whitespace-only changes.
-                    if (r_move_range and
-                        is_valid_move_range(
-                            differ.a[r_move_range[0]:r_move_range[1]])):
-
-                        # Rebuild the insert and remove ranges based on
-                        # where we are now and which range we won.
-                        #
-                        # The new ranges will be actual lists of positions,
-                        # rather than a beginning and end. These will be
-                        # provided to the renderer.
-                        #
-                        # The ranges expected by the renderers are 1-based,
-                        # whereas our calculations for this algorithm are
-                        # 0-based, so we add 1 to the numbers.
-                        #
-                        # The upper boundaries passed to the range() function
-                        # must actually be one higher than the value we want.
-                        # So, for r_move_range, we actually increment by 2.
-                        # We only increment i_move_cur by one, because
-                        # i_move_cur already factored in the + 1 by being
-                        # at the end of the while loop.
-                        i_move_range = range(i_move_range[0] + 1,
-                                             i_move_cur + 1)
-                        r_move_range = range(r_move_range[0] + 1,
-                                             r_move_range[1] + 2)
-
-                        rmeta = rgroup[-1]
-                        rmeta.setdefault('moved', {}).update(
-                            dict(zip(r_move_range, i_move_range)))
-                        imeta.setdefault('moved', {}).update(
-                            dict(zip(i_move_range, r_move_range)))
-
-                # Reset the state for the next range.
-                i_move_cur += 1
-                i_move_range = (i_move_cur, i_move_cur)
-                r_move_ranges = {}
+    if removes and inserts:
+        if detect_moves:
+            moves = find_moved_lines(differ, removes, inserts,
+                                     min_move_lines, move_timeout)
+        else:
+            moves = None
+
+        if moves is None:
+            for group in groups:
+                if group[0] != 'equal':
+                    group[-1]['moves_skipped'] = True
+        else:
+            for rgroup, igroup, r_move_range, i_move_range in moves:
+                rgroup[-1].setdefault('moved', {}).update(
+                    dict(zip(r_move_range, i_move_range)))
+                igroup[-1].setdefault('moved', {}).update(
+                    dict(zip(i_move_range, r_move_range)))
 
     return groups
 
 
+def find_moved_lines(differ, removes, inserts, min_lines=1, timeout=None):
+    """Finds blocks of deleted lines that were inserted somewhere else.
+
+    removes and inserts are the delete and insert opcodes from the differ.
+
+    Lines are compared using integer codes (see get_move_line_codes). The
+    deleted lines are indexed by their codes, and each insert group is swept
+    once from top to bottom. At each inserted line, the runs of matching
+    lines ending on the line before it are extended, and the runs that
+    can't be extended are finished.
+
+    In each insert group, the longest runs win. If two runs of the same
+    length match the same inserted lines, neither is shown, since that's
+    usually common code, like part of a comment block, rather than a real
+    move. Runs with no alphanumeric content (see is_valid_move_range) and
+    runs shorter than min_lines aren't shown either.
+
+    Returns a list of (remove group, insert group, removed line numbers,
+    inserted line numbers) tuples, with 1-based line numbers. If timeout
+    seconds pass first, this gives up and returns None.
+    """
+    if timeout:
+        deadline = time.time() + timeout
+    else:
+        deadline = None
+
+    a_codes, b_codes = get_move_line_codes(differ)
+    a = differ.a
+    b = differ.b
+
+    # Maps codes to the deleted lines that have them, and deleted lines to
+    # the groups they're in. Blank lines are never part of a move.
+    index = {}
+    remove_groups = {}
+
+    for rgroup in removes:
+        for i in xrange(rgroup[1], rgroup[2]):
+            if a[i].strip():
+                index.setdefault(a_codes[i], []).append(i)
+                remove_groups[i] = rgroup
+
+    moves = []
+    used_lines = set()
+
+    for igroup in inserts:
+        ij1, ij2 = igroup[3:5]
+
+        # Runs that end on the previous inserted line, mapping the last
+        # deleted line in the run to the first deleted and inserted lines.
+        active = {}
+
+        # Finished runs, as (length, deleted start, inserted start).
+        runs = []
+
+        # The extra iteration at the end finishes any runs that are left.
+        for j in xrange(ij1, ij2 + 1):
+            if deadline and time.time() > deadline:
+                return None
+
+            extended = {}
+
+            if j < ij2 and b[j].strip():
+                code = b_codes[j]
+
+                for last_i, start in active.iteritems():
+                    i = last_i + 1
+
+                    if (i in remove_groups and a_codes[i] == code and
+                        remove_groups[i] is remove_groups[last_i]):
+                        extended[i] = start
+
+                # Lines that were deleted in lots of places, like closing
+                # braces, can extend runs but don't start new ones.
+                candidates = index.get(code, [])
+
+                if len(candidates) <= MAX_MOVE_CANDIDATES:
+                    for i in candidates:
+                        if i not in extended:
+                            extended[i] = (i, j)
+
+            for last_i, start in active.iteritems():
+                if extended.get(last_i + 1) is not start:
+                    i_start, j_start = start
+                    length = last_i - i_start + 1
+
+                    if length >= min_lines:
+                        runs.append((length, i_start, j_start))
+
+            active = extended
+
+        # Runs of the same length matching the same inserted lines are
+        # ambiguous.
+        counts = {}
+
+        for length, i_start, j_start in runs:
+            key = (length, j_start)
+            counts[key] = counts.get(key, 0) + 1
+
+        runs.sort(key=lambda run: (-run[0], run[2], run[1]))
+        used_inserts = set()
+
+        for length, i_start, j_start in runs:
+            i_range = range(i_start, i_start + length)
+            j_range = range(j_start, j_start + length)
+
+            if (counts[(length, j_start)] == 1 and
+                used_lines.isdisjoint(i_range) and
+                used_inserts.isdisjoint(j_range) and
+                is_valid_move_range(a[i_start:i_start + length])):
+                used_lines.update(i_range)
+                used_inserts.update(j_range)
+
+                # The ranges expected by the renderers are 1-based.
+                moves.append((remove_groups[i_start], igroup,
+                              [i + 1 for i in i_range],
+                              [j + 1 for j in j_range]))
+
+    return moves
+
+
+def get_move_line_codes(differ):
+    """Returns lists of integer codes for the lines in a differ's files.
+
+    Two lines with the same code are considered the same when looking for
+    moved lines. Leading whitespace is ignored, so that blocks of code that
+    were moved into or out of an indented block are found.
+
+    The codes the differ computed while diffing are used if it ignored
+    leading whitespace. Otherwise, codes are computed from the stripped
+    lines.
+    """
+    a_data = getattr(differ, 'a_data', None)
+
+    if a_data is not None and getattr(differ, 'ignore_space', False):
+        return a_data.data, differ.b_data.data
+
+    code_table = {}
+
+    def get_codes(lines):
+        return [code_table.setdefault(line.strip(), len(code_table))
+                for line in lines]
+
+    return get_codes(differ.a), get_codes(differ.b)
+
+
 def get_revision_str(revision):
     if revision == HEAD:
         return "HEAD"
@@ -915,6 +1518,203 @@ def get_revision_str(revision):
         return "Revision %s" % revision
 
 
+def get_stored_chunks(filediff, interfilediff, force_interdiff,
+                      enable_syntax_highlighting):
+    """
+    Returns the list of chunks for a file, using the site's chunk store.
+
+    If the chunks aren't in the chunk store, they're generated and stored
+    for next time. If there's no chunk store configured, this just
+    generates them.
+    """
+    store = get_chunk_store()
+
+    if store:
+        key = store.make_key(filediff, interfilediff, force_interdiff,
+                             enable_syntax_highlighting,
+                             get_chunks_version())
+        chunks = store.get(key)
+
+        if chunks is not None:
+            return chunks
+
+    chunks = list(get_chunks(filediff.diffset, filediff, interfilediff,
+                             force_interdiff, enable_syntax_highlighting))
+
+    if store:
+        store.set(key, chunks)
+
+    return chunks
+
+
+def get_chunks_version():
+    """
+    Returns a string identifying how chunks are generated.
+
+    This covers CHUNK_FORMAT_VERSION and the settings that change the
+    chunks generated for a diff. It's part of the keys for chunks in
+    memcached and the chunk store, so that chunks generated differently
+    are never mixed or served after a change.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+
+    return 'v%s-h%s' % (
+        CHUNK_FORMAT_VERSION,
+        siteconfig.get('diffviewer_histogram_diff_threshold'))
+
+
+def get_chunks_cache_key(filediff, interfilediff, force_interdiff,
+                         enable_syntax_highlighting):
+    """
+    Returns the memcached key for the chunks of a filediff or interdiff.
+
+    The key is based on the contents of the filediffs (see
+    FileDiff.get_content_key), so identical filediffs in different diff
+    revisions share their chunks. It also includes get_chunks_version.
+    """
+    key = "diff-sidebyside-%s-" % get_chunks_version()
+
+    if enable_syntax_highlighting:
+        key += "hl-"
+
+    if not force_interdiff:
+        key += filediff.get_content_key()
+    elif interfilediff:
+        key += "interdiff-%s-%s" % (filediff.get_content_key(),
+                                    interfilediff.get_content_key())
+    else:
+        key += "interdiff-%s-none" % filediff.get_content_key()
+
+    return key
+
+
+def get_cached_chunks(filediff, interfilediff, force_interdiff,
+                      enable_syntax_highlighting):
+    """
+    Returns the list of chunks for a file, generating them if they're not
+    in memcached or the chunk store.
+    """
+    return cache_memoize(
+        get_chunks_cache_key(filediff, interfilediff, force_interdiff,
+                             enable_syntax_highlighting),
+        lambda: get_stored_chunks(filediff, interfilediff, force_interdiff,
+                                  enable_syntax_highlighting),
+        large_data=True)
+
+
+class _ChunksNotCached(Exception):
+    pass
+
+
+def get_chunks_from_cache(filediff, interfilediff, force_interdiff,
+                          enable_syntax_highlighting):
+    """
+    Returns the list of chunks for a file from memcached, or None if they
+    aren't cached. Nothing is generated.
+    """
+    def not_cached():
+        raise _ChunksNotCached
+
+    try:
+        return cache_memoize(
+            get_chunks_cache_key(filediff, interfilediff, force_interdiff,
+                                 enable_syntax_highlighting),
+            not_cached,
+            large_data=True)
+    except _ChunksNotCached:
+        return None
+
+
+def load_file_chunks(files, enable_syntax_highlighting, max_workers=1):
+    """
+    Loads the chunks for a list of files from get_diff_files.
+
+    Files whose chunks aren't cached have to be fetched from the repository,
+    patched, diffed and highlighted. If max_workers is greater than 1, up to
+    that many files are processed at once in separate threads, which lets
+    the repository fetches and patches for different files overlap. Files
+    whose chunks are already in memcached are loaded first, so threads are
+    only started for the files that need to be generated.
+    """
+    text_files = [file for file in files
+                  if not file['binary'] and not file['deleted']]
+
+    def load_chunks(file):
+        return get_cached_chunks(file['filediff'], file['interfilediff'],
+                                 file['force_interdiff'],
+                                 enable_syntax_highlighting)
+
+    for file in files:
+        file['chunks'] = []
+
+    if min(max_workers, len(text_files)) > 1:
+        uncached_files = []
+
+        for file in text_files:
+            chunks = get_chunks_from_cache(file['filediff'],
+                                           file['interfilediff'],
+                                           file['force_interdiff'],
+                                           enable_syntax_highlighting)
+
+            if chunks is None:
+                uncached_files.append(file)
+            else:
+                file['chunks'] = chunks
+    else:
+        uncached_files = text_files
+
+    max_workers = min(max_workers, len(uncached_files))
+
+    if max_workers > 1:
+        # Look up everything get_chunks needs from the database now. The
+        # threads must not make queries, since they may share the
+        # request's database connection.
+        SiteConfiguration.objects.get_current()
+
+        for file in uncached_files:
+            for filediff in (file['filediff'], file['interfilediff']):
+                if filediff:
+                    filediff.diffset.repository.tool
+                    filediff.diff_blob
+                    filediff.parent_diff_blob
+
+        pool = ThreadPool(max_workers)
+
+        try:
+            all_chunks = pool.map(load_chunks, uncached_files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        all_chunks = [load_chunks(file) for file in uncached_files]
+
+    for file, chunks in zip(uncached_files, all_chunks):
+        file['chunks'] = chunks
+
+    for file in files:
+        file['changed_chunk_indexes'] = []
+        file['whitespace_only'] = True
+        file['too_large'] = False
+
+        for j, chunk in enumerate(file['chunks']):
+            chunk['index'] = j
+
+            if (chunk.get('meta', {}).get('large_file_tier') ==
+                LARGE_FILE_TOO_LARGE):
+                file['too_large'] = True
+                file['whitespace_only'] = False
+
+            if chunk['change'] != 'equal':
+                file['changed_chunk_indexes'].append(j)
+                meta = chunk.get('meta', {})
+
+                if not meta.get('whitespace_chunk', False):
+                    file['whitespace_only'] = False
+
+        file['num_changes'] = len(file['changed_chunk_indexes'])
+        file['chunk_index'] = ChunkIndex(file['chunks'])
+
+
 def get_diff_files(diffset, filediff=None, interdiffset=None,
                    enable_syntax_highlighting=True,
                    load_chunks=True):
@@ -930,7 +1730,9 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
                                   "diffset id %s, filediff %s" %
                                   (diffset.id, filediff.id))
     else:
-        filediffs = diffset.files.select_related().all()
+        filediffs = diffset.files.select_related('diffset__repository__tool',
+                                                 'diff_blob',
+                                                 'parent_diff_blob')
 
         if interdiffset:
             log_timer = log_timed("Generating diff file info for "
@@ -945,16 +1747,12 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
     # source file.
     interdiff_map = {}
     if interdiffset:
-        for interfilediff in interdiffset.files.all():
+        for interfilediff in interdiffset.files.select_related(
+                'diff_blob', 'parent_diff_blob'):
             if not filediff or \
                filediff.source_file == interfilediff.source_file:
                 interdiff_map[interfilediff.source_file] = interfilediff
 
-    key_prefix = "diff-sidebyside-"
-
-    if enable_syntax_highlighting:
-        key_prefix += "hl-"
-
 
     # In order to support interdiffs properly, we need to display diffs
     # on every file in the union of both diffsets. Iterating over one diffset
@@ -1002,7 +1800,7 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
             # We only process if there's a difference in files.
 
             if (filediff and interfilediff and
-                filediff.diff == interfilediff.diff):
+                filediff.has_same_diff(interfilediff)):
                 continue
 
             source_revision = "Diff Revision %s" % diffset.revision
@@ -1049,45 +1847,12 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
             'index': len(files),
         }
 
-        if load_chunks:
-            chunks = []
-
-            if not filediff.binary and not filediff.deleted:
-                key = key_prefix
-
-                if not force_interdiff:
-                    key += str(filediff.id)
-                elif interfilediff:
-                    key += "interdiff-%s-%s" % (filediff.id, interfilediff.id)
-                else:
-                    key += "interdiff-%s-none" % filediff.id
-
-                chunks = cache_memoize(
-                    key,
-                    lambda: list(get_chunks(filediff.diffset,
-                                            filediff, interfilediff,
-                                            force_interdiff,
-                                            enable_syntax_highlighting)),
-                    large_data=True)
-
-            file['chunks'] = chunks
-            file['changed_chunk_indexes'] = []
-            file['whitespace_only'] = True
-
-            for j, chunk in enumerate(file['chunks']):
-                chunk['index'] = j
-
-                if chunk['change'] != 'equal':
-                    file['changed_chunk_indexes'].append(j)
-                    meta = chunk.get('meta', {})
-
-                    if not meta.get('whitespace_chunk', False):
-                        file['whitespace_only'] = False
-
-            file['num_changes'] = len(file['changed_chunk_indexes'])
-
         files.append(file)
 
+    if load_chunks:
+        load_file_chunks(files, enable_syntax_highlighting,
+                         diffset.repository.diff_generation_concurrency)
+
     def cmp_file(x, y):
         # Sort based on basepath in asc order
         if x["basepath"] != y["basepath"]:
@@ -1109,11 +1874,118 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
     return files
 
 
+def get_diff_file_list(diffset, interdiffset=None):
+    """
+    Returns the list of files shown for a diff or interdiff.
+
+    This is the list get_diff_files returns without chunks, except that
+    each file's FileDiffs are replaced by their IDs in 'filediff_id' and
+    'interfilediff_id'. Pass the files being shown to
+    get_files_with_filediffs to get the FileDiffs back.
+
+    Building the list means querying every FileDiff and looking up the
+    repository's SCMTool, which adds up when paging through large diffs,
+    so the list is cached until either DiffSet or one of their FileDiffs
+    changes.
+    """
+    return cache_memoize(get_diff_file_list_cache_key(diffset, interdiffset),
+                         lambda: build_diff_file_list(diffset, interdiffset))
+
+
+def get_diff_file_list_cache_key(diffset, interdiffset=None):
+    """
+    Returns the memcached key for the list of files from get_diff_file_list.
+    """
+    key = 'diff-file-list-%s-%s' % (diffset.pk,
+                                    get_file_list_version(diffset.pk))
+
+    if interdiffset:
+        key += '-interdiff-%s-%s' % (interdiffset.pk,
+                                     get_file_list_version(interdiffset.pk))
+
+    return key
+
+
+def build_diff_file_list(diffset, interdiffset=None):
+    """
+    Builds the list of files returned by get_diff_file_list, without
+    caching it.
+    """
+    files = get_diff_files(diffset, None, interdiffset, load_chunks=False)
+
+    for file in files:
+        file['filediff_id'] = file.pop('filediff').pk
+        interfilediff = file.pop('interfilediff')
+
+        if interfilediff:
+            file['interfilediff_id'] = interfilediff.pk
+        else:
+            file['interfilediff_id'] = None
+
+    return files
+
+
+def get_files_with_filediffs(files):
+    """
+    Returns copies of files from get_diff_file_list with their FileDiffs.
+
+    The FileDiffs are fetched in one query and set in 'filediff' and
+    'interfilediff', as get_diff_files would. Files whose FileDiffs no
+    longer exist are left out.
+    """
+    ids = set()
+
+    for file in files:
+        ids.add(file['filediff_id'])
+
+        if file['interfilediff_id']:
+            ids.add(file['interfilediff_id'])
+
+    filediffs = FileDiff.objects.select_related(
+        'diffset', 'diff_blob', 'parent_diff_blob').in_bulk(list(ids))
+    result = []
+
+    for file in files:
+        filediff = filediffs.get(file['filediff_id'])
+
+        if filediff:
+            file = dict(file)
+            file['filediff'] = filediff
+            file['interfilediff'] = filediffs.get(file['interfilediff_id'])
+            result.append(file)
+
+    return result
+
+
+def get_diff_file(filediff, interfilediff=None,
+                  enable_syntax_highlighting=True, load_chunks=True):
+    """
+    Returns the file from get_diff_files for a filediff, or an interdiff
+    between filediff and interfilediff.
+
+    Returns None if there's nothing to show, which happens when the file
+    didn't change between the two diffsets of an interdiff.
+    """
+    if interfilediff:
+        interdiffset = interfilediff.diffset
+    else:
+        interdiffset = None
+
+    files = get_diff_files(filediff.diffset, filediff, interdiffset,
+                           enable_syntax_highlighting, load_chunks)
+
+    if not files:
+        return None
+
+    assert len(files) == 1
+    return files[0]
+
+
 def get_file_chunks_in_range(context, filediff, interfilediff,
                              first_line, num_lines):
     """
-    A generator that yields chunks within a range of lines in the specified
-    filediff/interfilediff.
+    Returns an iterator over the chunks within a range of lines in the
+    specified filediff/interfilediff.
 
     This is primarily intended for use with templates. It takes a
     RequestContext for looking up the user and for caching file lists,
@@ -1127,8 +1999,9 @@ def get_file_chunks_in_range(context, filediff, interfilediff,
       ============= ========================================================
       ``change``    The change type ("equal", "replace", "insert", "delete")
       ``numlines``  The number of lines in the chunk.
-      ``lines``     The list of lines in the chunk.
+      ``lines``     The lines in the chunk, as a ChunkLines.
       ``meta``      A dictionary containing metadata on the chunk
+      ``index``     The index of the chunk in the file's list of chunks
       ============= ========================================================
 
 
@@ -1145,81 +2018,87 @@ def get_file_chunks_in_range(context, filediff, interfilediff,
       5        HTML markup of the patched file
       6        Changed regions of the patched line (for "replace" chunks)
       7        True if line consists of only whitespace changes
+      8        The line number this line was moved to or from, if any
       ======== =============================================================
     """
-    def find_header(headers):
-        for header in reversed(headers):
-            if header[0] < first_line:
-                return header[1]
-
-    interdiffset = None
-
     key = "_diff_files_%s_%s" % (filediff.diffset.id, filediff.id)
 
     if interfilediff:
         key += "_%s" % (interfilediff.id)
-        interdiffset = interfilediff.diffset
 
     if key in context:
-        files = context[key]
+        file = context[key]
     else:
         assert 'user' in context
-        files = get_diff_files(filediff.diffset, filediff, interdiffset,
-                               get_enable_highlighting(context['user']))
-        context[key] = files
+        file = get_diff_file(filediff, interfilediff,
+                             get_enable_highlighting(context['user']))
+        context[key] = file
 
-    if not files:
-        raise StopIteration
+    if not file:
+        return iter([])
 
-    assert len(files) == 1
-    last_header = (None, None)
+    return get_chunks_in_range(file, first_line, num_lines)
 
-    for chunk in files[0]['chunks']:
-        if ('headers' in chunk['meta'] and
-            (chunk['meta']['headers'][0] or chunk['meta']['headers'][1])):
-            last_header = chunk['meta']['headers']
 
+def get_chunks_in_range(file, first_line, num_lines):
+    """
+    A generator that yields the chunks within a range of lines in a file
+    from get_diff_files.
+
+    The chunks are in the same format as get_file_chunks_in_range. The
+    first chunk is looked up using the file's chunk index, so this doesn't
+    need to look at any chunks before the range.
+    """
+    def find_header(headers):
+        for header in reversed(headers):
+            if header[0] < first_line:
+                return header[1]
+
+    chunks = file['chunks']
+    chunk_index = file.get('chunk_index') or ChunkIndex(chunks)
+
+    i = chunk_index.find_chunk(first_line)
+
+    if i is None:
+        raise StopIteration
+
+    while num_lines > 0 and i < len(chunks):
+        chunk = chunks[i]
         lines = chunk['lines']
+        start_index = first_line - chunk_index.starts[i]
+        last_index = min(start_index + num_lines, len(lines))
+
+        # The chunks may be shared with other callers through the cache,
+        # so the metadata is copied before changing the headers.
+        meta = dict(chunk.get('meta', {}))
+
+        new_chunk = {
+            'lines': lines[start_index:last_index],
+            'numlines': last_index - start_index,
+            'change': chunk['change'],
+            'index': i,
+            'meta': meta,
+        }
 
-        if lines[-1][0] >= first_line >= lines[0][0]:
-            start_index = first_line - lines[0][0]
+        if 'left_headers' in meta:
+            left_header = find_header(meta.pop('left_headers'))
+            right_header = find_header(meta.pop('right_headers'))
 
-            if first_line + num_lines <= lines[-1][0]:
-                last_index = start_index + num_lines
+            if left_header or right_header:
+                header = (left_header, right_header)
             else:
-                last_index = len(lines)
-
-            new_chunk = {
-                'lines': chunk['lines'][start_index:last_index],
-                'numlines': last_index - start_index,
-                'change': chunk['change'],
-                'meta': chunk.get('meta', {}),
-            }
-
-            if 'left_headers' in chunk['meta']:
-                left_header = find_header(chunk['meta']['left_headers'])
-                right_header = find_header(chunk['meta']['right_headers'])
-                del new_chunk['meta']['left_headers']
-                del new_chunk['meta']['right_headers']
-
-                if left_header or right_header:
-                    header = (left_header, right_header)
-                else:
-                    header = last_header
-
-                new_chunk['meta']['headers'] = [
-                    (header[0] or "").strip(),
-                    (header[1] or "").strip(),
-                ]
+                header = chunk_index.get_last_header(i)
 
-            yield new_chunk
+            meta['headers'] = [
+                (header[0] or "").strip(),
+                (header[1] or "").strip(),
+            ]
 
-            first_line += new_chunk['numlines']
-            num_lines -= new_chunk['numlines']
+        yield new_chunk
 
-            assert num_lines >= 0
-            if num_lines == 0:
-                break
+        first_line += new_chunk['numlines']
+        num_lines -= new_chunk['numlines']
+        i += 1
 
 
 def get_enable_highlighting(user):
@@ -3,4 +3,7 @@ SEQUENCE = [
     'filediff_filenames_1024_chars',
     'diffset_basedir',
     'filediff_status',
+    'filediff_diff_hashes',
+    'filediff_diff_blobs',
+    'line_counts',
 ]
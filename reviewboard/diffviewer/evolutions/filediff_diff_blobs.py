@@ -0,0 +1,13 @@
+from django_evolution.mutations import AddField, RenameField
+from django.db import models
+
+
+MUTATIONS = [
+    RenameField('FileDiff', 'diff', 'legacy_diff', db_column='diff_base64'),
+    RenameField('FileDiff', 'parent_diff', 'legacy_parent_diff',
+                db_column='parent_diff_base64'),
+    AddField('FileDiff', 'diff_blob', models.ForeignKey, null=True,
+             related_model='diffviewer.DiffBlob'),
+    AddField('FileDiff', 'parent_diff_blob', models.ForeignKey, null=True,
+             related_model='diffviewer.DiffBlob'),
+]
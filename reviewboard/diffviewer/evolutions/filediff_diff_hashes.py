@@ -0,0 +1,10 @@
+from django_evolution.mutations import AddField
+from django.db import models
+
+
+MUTATIONS = [
+    AddField('FileDiff', 'diff_hash', models.CharField, initial='',
+             max_length=40, db_index=True),
+    AddField('FileDiff', 'parent_diff_hash', models.CharField, initial='',
+             max_length=40),
+]
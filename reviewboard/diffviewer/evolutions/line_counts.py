@@ -0,0 +1,14 @@
+from django_evolution.mutations import AddField
+from django.db import models
+
+
+MUTATIONS = [
+    AddField('FileDiff', 'inserted_lines', models.IntegerField, null=True),
+    AddField('FileDiff', 'deleted_lines', models.IntegerField, null=True),
+    AddField('FileDiff', 'changed_lines', models.IntegerField, null=True),
+    AddField('FileDiff', 'hunk_count', models.IntegerField, null=True),
+    AddField('DiffSet', 'inserted_lines', models.IntegerField, null=True),
+    AddField('DiffSet', 'deleted_lines', models.IntegerField, null=True),
+    AddField('DiffSet', 'changed_lines', models.IntegerField, null=True),
+    AddField('DiffSet', 'hunk_count', models.IntegerField, null=True),
+]
@@ -4,6 +4,7 @@ from django import forms
 from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext as _
 
+from reviewboard.diffviewer.chunkgen import queue_chunk_generation
 from reviewboard.diffviewer.diffutils import DEFAULT_DIFF_COMPAT_VERSION
 from reviewboard.diffviewer.models import DiffSet, FileDiff
 from reviewboard.scmtools.core import PRE_CREATION, UNKNOWN, FileNotFoundError
@@ -126,10 +127,30 @@ class UploadDiffForm(forms.Form):
                                 parent_diff=parent_content,
                                 binary=f.binary,
                                 status=status)
+            filediff.update_line_counts()
             filediff.save()
 
+        diffset.update_line_counts()
+        diffset.save()
+
+        queue_chunk_generation(diffset, self._get_previous_diffset(diffset))
+
         return diffset
 
+    def _get_previous_diffset(self, diffset):
+        """
+        Returns the diffset that came before a new diffset, or None.
+
+        Interdiffs between the two are generated along with the new diffset.
+        """
+        if not diffset.history:
+            return None
+
+        try:
+            return diffset.history.diffsets.exclude(pk=diffset.pk).latest()
+        except DiffSet.DoesNotExist:
+            return None
+
     def _process_files(self, file, basedir, check_existance=False):
         tool = self.repository.get_scmtool()
 
@@ -0,0 +1,147 @@
+import re
+import sre_constants
+import sre_parse
+import string
+
+
+# The characters matched by the categories used in header regexes. Headers
+# are matched against ASCII source code, so other characters don't matter.
+CATEGORY_CHARS = {
+    sre_constants.CATEGORY_DIGIT: string.digits,
+    sre_constants.CATEGORY_WORD: string.ascii_letters + string.digits + '_',
+}
+
+
+class HeaderMatcher(object):
+    """
+    Finds function and class headers in a language's source code.
+
+    A language can have several header regexes. Rather than trying each of
+    them on every line, they're combined into one regex, with a named group
+    for each, so a line is matched once.
+
+    Before that, the first non-whitespace character of the line is checked
+    against the characters that any of the regexes could start with, which
+    rules out most lines without running the regex at all.
+
+    This has the same match method as a compiled regex, so it can be
+    registered with a differ's add_interesting_line_regex.
+    """
+    def __init__(self, regexes):
+        self.regex = re.compile('|'.join([
+            '(?P<header%d>%s)' % (i, regex.pattern)
+            for i, regex in enumerate(regexes)
+        ]))
+
+        first_chars = set()
+
+        for regex in regexes:
+            chars = get_first_chars(regex.pattern)
+
+            if chars is None:
+                first_chars = None
+                break
+
+            first_chars.update(chars)
+
+        self.first_chars = first_chars
+
+    def match(self, line):
+        """
+        Returns the match for a header, or None if the line isn't one.
+
+        The match's lastgroup is the name of the group for the regex that
+        matched.
+        """
+        if (self.first_chars is not None and
+            line.lstrip()[:1] not in self.first_chars):
+            return None
+
+        return self.regex.match(line)
+
+
+def get_first_chars(pattern):
+    """
+    Returns the characters a match of the pattern can start with.
+
+    Leading whitespace is skipped, so these are the characters a match can
+    start with once leading whitespace is stripped from the line. Returns
+    None if that can't be worked out, in which case any line may match.
+    """
+    try:
+        return _get_first_chars(list(sre_parse.parse(pattern)))
+    except (sre_constants.error, KeyError, TypeError, ValueError):
+        return None
+
+
+def _get_first_chars(items):
+    for i, (op, av) in enumerate(items):
+        rest = items[i + 1:]
+
+        if op == sre_constants.AT:
+            continue
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_count, max_count, subpattern = av
+
+            if _is_whitespace(list(subpattern)):
+                continue
+
+            chars = _get_first_chars(list(subpattern))
+
+            if chars is None or min_count > 0:
+                return chars
+
+            # The repeated part can be left out, so whatever comes after
+            # it can come first.
+            rest_chars = _get_first_chars(rest)
+
+            if rest_chars is None:
+                return None
+
+            return chars | rest_chars
+        elif op == sre_constants.SUBPATTERN:
+            return _get_first_chars(list(av[-1]) + rest)
+        elif op == sre_constants.BRANCH:
+            chars = set()
+
+            for branch in av[1]:
+                branch_chars = _get_first_chars(list(branch) + rest)
+
+                if branch_chars is None:
+                    return None
+
+                chars.update(branch_chars)
+
+            return chars
+        elif op == sre_constants.LITERAL:
+            return set([chr(av)])
+        elif op == sre_constants.IN:
+            return _get_set_chars(av)
+        else:
+            return None
+
+    # The whole pattern can match an empty string.
+    return None
+
+
+def _get_set_chars(members):
+    chars = set()
+
+    for op, av in members:
+        if op == sre_constants.LITERAL:
+            chars.add(chr(av))
+        elif op == sre_constants.RANGE:
+            chars.update([chr(c) for c in xrange(av[0], av[1] + 1)])
+        elif op == sre_constants.CATEGORY and av in CATEGORY_CHARS:
+            chars.update(CATEGORY_CHARS[av])
+        else:
+            return None
+
+    return chars
+
+
+def _is_whitespace(items):
+    return (len(items) == 1 and
+            items[0] == (sre_constants.IN,
+                         [(sre_constants.CATEGORY,
+                           sre_constants.CATEGORY_SPACE)]))
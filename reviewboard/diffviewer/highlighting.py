@@ -0,0 +1,109 @@
+import fnmatch
+
+try:
+    import pygments
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name, get_lexer_for_filename
+    from pygments.util import ClassNotFound
+except ImportError:
+    HtmlFormatter = object
+
+
+class NoWrapperHtmlFormatter(HtmlFormatter):
+    """An HTML Formatter for Pygments that don't wrap items in a div."""
+    def __init__(self, *args, **kwargs):
+        super(NoWrapperHtmlFormatter, self).__init__(*args, **kwargs)
+
+    def _wrap_div(self, inner):
+        """
+        Method called by the formatter to wrap the contents of inner.
+        Inner is a list of tuples containing formatted code. If the first item
+        in the tuple is zero, then it's a wrapper, so we should ignore it.
+        """
+        for tup in inner:
+            if tup[0]:
+                yield tup
+
+
+class LexerCache(object):
+    """
+    Looks up and caches the Pygments lexers for files.
+
+    Finding a lexer for a filename means checking the filename patterns of
+    every lexer Pygments knows about, which is slow when highlighting lots
+    of small files. Lexers are cached by the file's basename, since that's
+    all Pygments looks at.
+
+    overrides is a list of (pattern, lexer name) pairs. Files whose
+    basenames match a pattern use that lexer, instead of the one Pygments
+    would pick. The first matching pattern wins.
+    """
+    # The cache is cleared once it holds this many basenames, so that
+    # repositories with lots of uniquely named files can't grow it forever.
+    MAX_SIZE = 10000
+
+    def __init__(self, overrides=[]):
+        self.overrides = [tuple(override) for override in overrides]
+        self._lexers = {}
+
+    def get_lexer(self, filename):
+        """
+        Returns the lexer for a file, or None if there isn't one.
+
+        The lexer is shared by every caller, so it must not be modified.
+        """
+        basename = filename.rsplit('/', 1)[-1]
+
+        try:
+            return self._lexers[basename]
+        except KeyError:
+            pass
+
+        lexer = self._find_lexer(basename)
+
+        if len(self._lexers) >= self.MAX_SIZE:
+            self._lexers.clear()
+
+        self._lexers[basename] = lexer
+
+        return lexer
+
+    def _find_lexer(self, basename):
+        try:
+            for pattern, name in self.overrides:
+                if fnmatch.fnmatch(basename, pattern):
+                    lexer = get_lexer_by_name(name, stripnl=False,
+                                              encoding='utf-8')
+                    break
+            else:
+                # XXX Guessing is preferable but really slow, especially on
+                #     XML files.
+                lexer = get_lexer_for_filename(basename, stripnl=False,
+                                               encoding='utf-8')
+        except ClassNotFound:
+            return None
+
+        try:
+            # This is only available in 0.7 and higher
+            lexer.add_filter('codetagify')
+        except AttributeError:
+            pass
+
+        return lexer
+
+
+_formatter = None
+
+
+def highlight(data, lexer):
+    """
+    Highlights data with a lexer, returning a list of lines of markup.
+
+    The HTML formatter is created once and shared.
+    """
+    global _formatter
+
+    if _formatter is None:
+        _formatter = NoWrapperHtmlFormatter()
+
+    return pygments.highlight(data, lexer, _formatter).splitlines()
@@ -0,0 +1,260 @@
+from array import array
+from bisect import bisect_left
+
+from reviewboard.diffviewer.myersdiff import MyersDiffer
+
+
+class HistogramDiffer(MyersDiffer):
+    """
+    An implementation of the histogram diff algorithm, based on JGit's.
+
+    Rather than searching for the shortest edit script, this anchors the
+    diff on lines that occur rarely, and then diffs the regions between the
+    anchors separately. Lines that appear exactly once in both files are
+    all anchored at once, patience diff style, using the longest sequence
+    of them that appears in the same order in both files. When there are
+    none, the longest run of lines that occur the fewest times in the old
+    file is used instead. This stays fast on large files that have been
+    heavily reordered, which are the worst case for Myers's algorithm.
+
+    The results are stored the same way MyersDiffer stores them, so
+    opcodes, interesting lines and chunk shifting all behave the same.
+    """
+    # Lines that appear more often than this in a region of the old file
+    # are never used as anchors.
+    MAX_CHAIN_LENGTH = 64
+
+    # Regions without any usable anchors are diffed with Myers's algorithm
+    # if they have at most this many lines between both files. Larger ones
+    # only have very common lines (blank lines, braces and such) in
+    # common, so they're simply marked as replaced.
+    MAX_FALLBACK_LINES = 1000
+
+    def _gen_diff_data(self):
+        """
+        Generate all the diff data needed to return opcodes or the diff ratio.
+        This is only called once during the lifetime of a HistogramDiffer
+        instance.
+        """
+        if self.a_data and self.b_data:
+            return
+
+        self.a_data = self.DiffData(self._gen_diff_codes(self.a, False))
+        self.b_data = self.DiffData(self._gen_diff_codes(self.b, True))
+
+        # Regions are processed from a stack rather than through recursion,
+        # since large files can split into more regions than Python's
+        # recursion limit allows.
+        regions = [(0, self.a_data.length, 0, self.b_data.length)]
+
+        while regions:
+            self._diff_region(regions, *regions.pop())
+
+        self._shift_chunks(self.a_data, self.b_data)
+        self._shift_chunks(self.b_data, self.a_data)
+
+    def _diff_region(self, regions, a_lower, a_upper, b_lower, b_upper):
+        """
+        Diffs a region of the files, marking the modified lines.
+
+        If a suitable anchor is found, the regions before and after it are
+        pushed onto the regions stack to be diffed separately.
+        """
+        a = self.a_data.data
+        b = self.b_data.data
+
+        # Fast walkthrough equal lines at the start and end.
+        while a_lower < a_upper and b_lower < b_upper and \
+              a[a_lower] == b[b_lower]:
+            a_lower += 1
+            b_lower += 1
+
+        while a_upper > a_lower and b_upper > b_lower and \
+              a[a_upper - 1] == b[b_upper - 1]:
+            a_upper -= 1
+            b_upper -= 1
+
+        if a_lower == a_upper or b_lower == b_upper:
+            self._mark_modified(a_lower, a_upper, b_lower, b_upper)
+            return
+
+        anchors = self._find_unique_anchors(a_lower, a_upper,
+                                            b_lower, b_upper)
+
+        if anchors:
+            # Diff everything between the anchors. The anchors themselves
+            # are equal lines.
+            for a_anchor, b_anchor in anchors:
+                regions.append((a_lower, a_anchor, b_lower, b_anchor))
+                a_lower = a_anchor + 1
+                b_lower = b_anchor + 1
+
+            regions.append((a_lower, a_upper, b_lower, b_upper))
+            return
+
+        # Build the histogram of lines in this region of the old file.
+        occurrences = {}
+
+        for i in xrange(a_lower, a_upper):
+            occurrences.setdefault(a[i], []).append(i)
+
+        best = None
+        best_count = self.MAX_CHAIN_LENGTH + 1
+        best_length = 0
+
+        j = b_lower
+
+        while j < b_upper:
+            positions = occurrences.get(b[j])
+            next_j = j + 1
+
+            if positions is None or len(positions) > best_count:
+                j = next_j
+                continue
+
+            for i in positions:
+                a_start = i
+                a_end = i + 1
+                b_start = j
+                b_end = j + 1
+                count = len(positions)
+
+                # Extend the matching region as far as it will go, keeping
+                # track of the rarest line in it.
+                while a_start > a_lower and b_start > b_lower and \
+                      a[a_start - 1] == b[b_start - 1]:
+                    a_start -= 1
+                    b_start -= 1
+                    count = min(count, len(occurrences[a[a_start]]))
+
+                while a_end < a_upper and b_end < b_upper and \
+                      a[a_end] == b[b_end]:
+                    count = min(count, len(occurrences[a[a_end]]))
+                    a_end += 1
+                    b_end += 1
+
+                if b_end > next_j:
+                    next_j = b_end
+
+                if a_end - a_start > best_length or count < best_count:
+                    best = (a_start, a_end, b_start, b_end)
+                    best_length = a_end - a_start
+                    best_count = count
+
+            j = next_j
+
+        if best is None:
+            # Every line in common is too frequent to anchor on, so fall
+            # back on Myers's algorithm for this region, if it's small
+            # enough.
+            if (a_upper - a_lower) + (b_upper - b_lower) <= \
+               self.MAX_FALLBACK_LINES:
+                self._myers_diff_region(a_lower, a_upper, b_lower, b_upper)
+            else:
+                self._mark_modified(a_lower, a_upper, b_lower, b_upper)
+        else:
+            a_start, a_end, b_start, b_end = best
+            regions.append((a_end, a_upper, b_end, b_upper))
+            regions.append((a_lower, a_start, b_lower, b_start))
+
+    def _find_unique_anchors(self, a_lower, a_upper, b_lower, b_upper):
+        """
+        Finds lines that appear exactly once in both regions of the files.
+
+        This returns the longest list of (a_index, b_index) pairs for those
+        lines that are in the same order in both files.
+        """
+        a = self.a_data.data
+        b = self.b_data.data
+
+        # Maps line codes to their index in the old region, or to -1 if
+        # they're not unique in it.
+        a_unique = {}
+
+        for i in xrange(a_lower, a_upper):
+            if a[i] in a_unique:
+                a_unique[a[i]] = -1
+            else:
+                a_unique[a[i]] = i
+
+        # Maps line codes to their index in the new region, or to -1 if
+        # they're not unique in it. Only lines unique in the old region
+        # are recorded.
+        b_unique = {}
+
+        for j in xrange(b_lower, b_upper):
+            code = b[j]
+
+            if a_unique.get(code, -1) != -1:
+                if code in b_unique:
+                    b_unique[code] = -1
+                else:
+                    b_unique[code] = j
+
+        # Find the longest increasing subsequence of old indexes, ordered
+        # by new index, using patience sorting.
+        pile_tops = []
+        pile_items = []
+        backrefs = {}
+
+        for j in xrange(b_lower, b_upper):
+            if b_unique.get(b[j], -1) != j:
+                continue
+
+            i = a_unique[b[j]]
+            pile = bisect_left(pile_tops, i)
+
+            if pile > 0:
+                backrefs[j] = pile_items[pile - 1]
+            else:
+                backrefs[j] = None
+
+            if pile == len(pile_tops):
+                pile_tops.append(i)
+                pile_items.append((i, j))
+            else:
+                pile_tops[pile] = i
+                pile_items[pile] = (i, j)
+
+        anchors = []
+
+        if pile_items:
+            item = pile_items[-1]
+
+            while item is not None:
+                anchors.append(item)
+                item = backrefs[item[1]]
+
+            anchors.reverse()
+
+        return anchors
+
+    def _myers_diff_region(self, a_lower, a_upper, b_lower, b_upper):
+        """
+        Diffs a region of the files using Myers's algorithm.
+
+        No lines are discarded, so the LCS is computed directly over the
+        line codes.
+        """
+        if self.fdiag is None:
+            for data in (self.a_data, self.b_data):
+                data.undiscarded = data.data
+                data.undiscarded_lines = data.length
+                data.real_indexes = array('i', xrange(data.length))
+
+            self.max_lines = self.a_data.length + self.b_data.length + 3
+            self.fdiag = [0] * self.max_lines
+            self.bdiag = [0] * self.max_lines
+            self.downoff = self.upoff = self.b_data.length + 1
+
+        self._lcs(a_lower, a_upper, b_lower, b_upper, self.minimal_diff)
+
+    def _mark_modified(self, a_lower, a_upper, b_lower, b_upper):
+        a_modified = self.a_data.modified
+        b_modified = self.b_data.modified
+
+        for i in xrange(a_lower, a_upper):
+            a_modified[i] = 1
+
+        for i in xrange(b_lower, b_upper):
+            b_modified[i] = 1
@@ -0,0 +1,61 @@
+import optparse
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from reviewboard.diffviewer.models import DiffBlob, FileDiff
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--batch-size', type='int', dest='batch_size',
+                             default=200,
+                             help='The number of files to convert in each '
+                                  'transaction'),
+        optparse.make_option('--prune', action='store_true', dest='prune',
+                             default=False,
+                             help='Also delete diff blobs that no files '
+                                  'use anymore'),
+        )
+    help = "Moves diffs uploaded before diff blobs existed into diff blobs"
+    requires_model_validation = True
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        queryset = FileDiff.objects.exclude(legacy_diff='',
+                                            legacy_parent_diff='')
+        queryset = queryset.order_by('pk')
+        total = queryset.count()
+        done = 0
+        last_pk = 0
+
+        while True:
+            filediffs = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+
+            if not filediffs:
+                break
+
+            self.compress_diffs(filediffs)
+
+            last_pk = filediffs[-1].pk
+            done += len(filediffs)
+            print 'Converted %d of %d files' % (done, total)
+
+        if options.get('prune'):
+            print 'Deleted %d unused diff blobs' % \
+                  DiffBlob.objects.delete_unused()
+
+    @transaction.commit_on_success
+    def compress_diffs(self, filediffs):
+        for filediff in filediffs:
+            filediff.store_diff_blobs()
+
+            # Only the diff columns are written, so that this can run while
+            # the site is up without racing other changes to the rows.
+            FileDiff.objects.filter(pk=filediff.pk).update(
+                legacy_diff='',
+                legacy_parent_diff='',
+                diff_blob=filediff.diff_blob,
+                parent_diff_blob=filediff.parent_diff_blob,
+                diff_hash=filediff.diff_hash,
+                parent_diff_hash=filediff.parent_diff_hash)
@@ -0,0 +1,47 @@
+import optparse
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from reviewboard.diffviewer.models import FileDiff
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--batch-size', type='int', dest='batch_size',
+                             default=500,
+                             help='The number of files to update in each '
+                                  'transaction'),
+        )
+    help = "Computes the diff hashes for files uploaded before they existed"
+    requires_model_validation = True
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        queryset = FileDiff.objects.filter(diff_hash='').order_by('pk')
+        total = queryset.count()
+        done = 0
+        last_pk = 0
+
+        while True:
+            filediffs = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+
+            if not filediffs:
+                break
+
+            self.fill_hashes(filediffs)
+
+            last_pk = filediffs[-1].pk
+            done += len(filediffs)
+            print 'Updated %d of %d files' % (done, total)
+
+    @transaction.commit_on_success
+    def fill_hashes(self, filediffs):
+        for filediff in filediffs:
+            filediff.update_diff_hashes()
+
+            # Only the hashes are written, so that this can run while the
+            # site is up without racing other changes to the rows.
+            FileDiff.objects.filter(pk=filediff.pk).update(
+                diff_hash=filediff.diff_hash,
+                parent_diff_hash=filediff.parent_diff_hash)
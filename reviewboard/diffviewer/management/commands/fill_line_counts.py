@@ -0,0 +1,60 @@
+import optparse
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from reviewboard.diffviewer.models import DiffSet, FileDiff, \
+                                          LINE_COUNT_FIELDS
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--batch-size', type='int', dest='batch_size',
+                             default=200,
+                             help='The number of files or diffs to update '
+                                  'in each transaction'),
+        )
+    help = "Counts the changed lines in diffs uploaded before they existed"
+    requires_model_validation = True
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+
+        # The files go first, since the diffsets' counts are their totals.
+        self.fill_in_batches(
+            FileDiff.objects.filter(inserted_lines__isnull=True)
+                            .select_related('diff_blob'),
+            batch_size, 'files')
+        self.fill_in_batches(
+            DiffSet.objects.filter(inserted_lines__isnull=True),
+            batch_size, 'diffs')
+
+    def fill_in_batches(self, queryset, batch_size, name):
+        queryset = queryset.order_by('pk')
+        total = queryset.count()
+        done = 0
+        last_pk = 0
+
+        while True:
+            objs = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+
+            if not objs:
+                break
+
+            self.fill_counts(objs)
+
+            last_pk = objs[-1].pk
+            done += len(objs)
+            print 'Updated %d of %d %s' % (done, total, name)
+
+    @transaction.commit_on_success
+    def fill_counts(self, objs):
+        for obj in objs:
+            obj.update_line_counts()
+
+            # Only the counts are written, so that this can run while the
+            # site is up without racing other changes to the rows.
+            type(obj).objects.filter(pk=obj.pk).update(**dict([
+                (field, getattr(obj, field))
+                for field in LINE_COUNT_FIELDS
+            ]))
@@ -0,0 +1,105 @@
+import optparse
+from datetime import datetime, timedelta
+from multiprocessing import Process
+
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.db.models import Avg, Max
+
+from reviewboard.diffviewer.chunkgen import MAX_TASK_ATTEMPTS, \
+                                            STALE_TASK_TIMEOUT, \
+                                            get_stale_tasks, run_worker
+from reviewboard.diffviewer.models import ChunkGenerationTask
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--workers', type='int', dest='workers',
+                             default=1,
+                             help='The number of worker processes to run'),
+        optparse.make_option('--poll-interval', type='int',
+                             dest='poll_interval', default=5,
+                             help='The number of seconds to wait between '
+                                  'checks for new diffs'),
+        optparse.make_option('--stale-timeout', type='int',
+                             dest='stale_timeout',
+                             default=STALE_TASK_TIMEOUT,
+                             help='The number of seconds after which an '
+                                  'unfinished task is assumed to belong to '
+                                  'a worker that died, and is run again'),
+        optparse.make_option('--once', action='store_true', dest='once',
+                             default=False,
+                             help='Exit once the queue is empty'),
+        optparse.make_option('--status', action='store_true', dest='status',
+                             default=False,
+                             help='Show the queue depth and the slowest '
+                                  'recent files, and exit'),
+        optparse.make_option('--purge', type='int', dest='purge_days',
+                             default=None, metavar='DAYS',
+                             help='Remove finished tasks older than this '
+                                  'many days, and exit'),
+        )
+    help = "Generates the diffs for newly uploaded files in the background"
+    requires_model_validation = True
+
+    def handle_noargs(self, **options):
+        if options['status']:
+            self.show_status(options['stale_timeout'])
+        elif options['purge_days'] is not None:
+            cutoff = datetime.now() - timedelta(days=options['purge_days'])
+            ChunkGenerationTask.objects.filter(
+                duration__isnull=False,
+                queued__lt=cutoff).delete()
+        elif options['workers'] <= 1:
+            run_worker(options['poll_interval'], options['once'],
+                       options['stale_timeout'])
+        else:
+            # Each worker needs its own database and cache connections, so
+            # close ours before forking.
+            connection.close()
+
+            if hasattr(cache, 'close'):
+                cache.close()
+
+            workers = [
+                Process(target=run_worker,
+                        args=(options['poll_interval'], options['once'],
+                              options['stale_timeout']))
+                for i in xrange(options['workers'])
+            ]
+
+            for worker in workers:
+                worker.start()
+
+            for worker in workers:
+                worker.join()
+
+    def show_status(self, stale_timeout):
+        tasks = ChunkGenerationTask.objects.all()
+        stale_tasks = get_stale_tasks(stale_timeout)
+        finished = tasks.filter(duration__isnull=False)
+        stats = finished.aggregate(average=Avg('duration'),
+                                   slowest=Max('duration'))
+
+        print 'Queued:      %d' % tasks.filter(started__isnull=True).count()
+        print 'In progress: %d' % tasks.filter(started__isnull=False,
+                                               duration__isnull=True).count()
+        print 'Stalled:     %d' % stale_tasks.filter(
+            attempts__lt=MAX_TASK_ATTEMPTS).count()
+        print 'Abandoned:   %d' % stale_tasks.filter(
+            attempts__gte=MAX_TASK_ATTEMPTS).count()
+        print 'Finished:    %d' % finished.count()
+        print 'Failed:      %d' % finished.exclude(error='').count()
+
+        if stats['average'] is not None:
+            print 'Average:     %.2fs' % stats['average']
+            print 'Slowest:     %.2fs' % stats['slowest']
+            print
+            print 'Slowest recent files:'
+
+            recent = finished.filter(
+                started__gte=datetime.now() - timedelta(days=1))
+
+            for task in recent.order_by('-duration')[:10]:
+                print '  %8.2fs  %s' % (task.duration, task)
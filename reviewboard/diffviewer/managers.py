@@ -0,0 +1,48 @@
+import zlib
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from django.db.models import Manager
+
+
+class DiffBlobManager(Manager):
+    """A manager for DiffBlob models."""
+    def get_for_data(self, data, data_hash=None):
+        """
+        Returns the DiffBlob storing the given data, creating it if needed.
+
+        data_hash is the SHA1 of the data, if the caller already has it.
+        """
+        if data_hash is None:
+            data_hash = sha1(data).hexdigest()
+
+        blob, is_new = self.get_or_create(
+            hash=data_hash,
+            defaults={
+                'compressed_data': zlib.compress(data),
+            })
+
+        return blob
+
+    def delete_unused(self, ids=None):
+        """
+        Deletes the DiffBlobs that no FileDiffs use anymore.
+
+        If ids is given, only those DiffBlobs are checked. Returns the
+        number of DiffBlobs deleted.
+        """
+        queryset = self.filter(filediffs__isnull=True,
+                               parent_filediffs__isnull=True)
+
+        if ids is not None:
+            queryset = queryset.filter(pk__in=ids)
+
+        count = queryset.count()
+
+        if count:
+            queryset.delete()
+
+        return count
@@ -1,18 +1,68 @@
+import uuid
+import zlib
 from datetime import datetime
 
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Sum
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.utils.translation import ugettext_lazy as _
 from djblets.util.fields import Base64Field
 
+from reviewboard.diffviewer.chunkstore import diffset_deleted_cb
+from reviewboard.diffviewer.managers import DiffBlobManager
+from reviewboard.diffviewer.parser import get_diff_line_counts
 from reviewboard.scmtools.models import Repository
 
 
+# The line counts stored on FileDiffs and totalled on DiffSets.
+LINE_COUNT_FIELDS = ('inserted_lines', 'deleted_lines', 'changed_lines',
+                     'hunk_count')
+
+
+class DiffBlob(models.Model):
+    """
+    The zlib-compressed contents of a diff.
+
+    Blobs are looked up by the SHA1 of their uncompressed contents, so a
+    diff that's uploaded again, like the unchanged files in a new revision
+    of a diff, is only stored once. They're shared between FileDiffs and
+    should never be modified.
+    """
+    hash = models.CharField(_('hash'), max_length=40, unique=True)
+    compressed_data = Base64Field(_('compressed data'),
+                                  db_column='compressed_data_base64')
+
+    objects = DiffBlobManager()
+
+    def get_data(self):
+        """Returns the uncompressed contents of the diff."""
+        if not hasattr(self, '_data'):
+            self._data = zlib.decompress(self.compressed_data)
+
+        return self._data
+
+    def __unicode__(self):
+        return self.hash
+
+
 class FileDiff(models.Model):
     """
     A diff of a single file.
 
     This contains the patch and information needed to produce original and
     patched versions of a single file in a repository.
+
+    The diff and parent diff are stored in DiffBlobs when the FileDiff is
+    saved. FileDiffs saved before DiffBlobs existed keep them in the
+    legacy_diff and legacy_parent_diff fields until the compress_diffs
+    management command is run. The diff and parent_diff properties return
+    the diffs from wherever they're stored, and can be set to new diffs.
     """
     MODIFIED = 'M'
     DELETED = 'D'
@@ -32,16 +82,168 @@ class FileDiff(models.Model):
                                        max_length=512)
     dest_detail = models.CharField(_("destination file details"),
                                    max_length=512)
-    diff = Base64Field(_("diff"), db_column="diff_base64")
-    binary = models.BooleanField(_("binary file"), default=False)
-    parent_diff = Base64Field(_("parent diff"), db_column="parent_diff_base64",
+    legacy_diff = Base64Field(_("diff"), db_column="diff_base64",
                               blank=True)
+    binary = models.BooleanField(_("binary file"), default=False)
+    legacy_parent_diff = Base64Field(_("parent diff"),
+                                     db_column="parent_diff_base64",
+                                     blank=True)
+    diff_blob = models.ForeignKey(DiffBlob,
+                                  null=True,
+                                  blank=True,
+                                  related_name='filediffs',
+                                  verbose_name=_("diff blob"))
+    parent_diff_blob = models.ForeignKey(DiffBlob,
+                                         null=True,
+                                         blank=True,
+                                         related_name='parent_filediffs',
+                                         verbose_name=_("parent diff blob"))
     status = models.CharField(_("status"), max_length=1, choices=STATUSES)
 
+    # SHA1 hashes of diff and parent_diff. These are empty for FileDiffs
+    # created before they were added, until the fill_diff_hashes management
+    # command is run.
+    diff_hash = models.CharField(_("diff hash"), max_length=40, blank=True,
+                                 db_index=True)
+    parent_diff_hash = models.CharField(_("parent diff hash"), max_length=40,
+                                        blank=True)
+
+    # Line counts of the diff, so the size of a change can be shown without
+    # generating the diff. These are None for FileDiffs created before they
+    # were added, until the fill_line_counts management command is run.
+    inserted_lines = models.IntegerField(_("inserted lines"), null=True,
+                                         blank=True)
+    deleted_lines = models.IntegerField(_("deleted lines"), null=True,
+                                        blank=True)
+    changed_lines = models.IntegerField(_("changed lines"), null=True,
+                                        blank=True)
+    hunk_count = models.IntegerField(_("hunk count"), null=True, blank=True)
+
     @property
     def deleted(self):
         return self.status == 'D'
 
+    def _get_diff(self):
+        return self._get_diff_data('diff')
+
+    def _set_diff(self, diff):
+        self._set_diff_data('diff', diff)
+
+    diff = property(_get_diff, _set_diff)
+
+    def _get_parent_diff(self):
+        return self._get_diff_data('parent_diff')
+
+    def _set_parent_diff(self, parent_diff):
+        self._set_diff_data('parent_diff', parent_diff)
+
+    parent_diff = property(_get_parent_diff, _set_parent_diff)
+
+    def _get_diff_data(self, name):
+        pending = self.__dict__.get('_pending_diff_data', {})
+
+        if name in pending:
+            return pending[name]
+        elif getattr(self, '%s_blob_id' % name):
+            return getattr(self, '%s_blob' % name).get_data()
+        else:
+            return getattr(self, 'legacy_%s' % name)
+
+    def _set_diff_data(self, name, data):
+        # The blob isn't looked up until the FileDiff is saved.
+        self.__dict__.setdefault('_pending_diff_data', {})[name] = data or ''
+
+    def store_diff_blobs(self):
+        """
+        Moves newly set diffs and legacy diffs into DiffBlobs.
+
+        The diff hashes are updated along with the blobs. Empty diffs
+        don't get a blob. This is done automatically when saving, and
+        doesn't save the FileDiff itself.
+        """
+        pending = self.__dict__.pop('_pending_diff_data', {})
+
+        for name in ('diff', 'parent_diff'):
+            hash_attr = '%s_hash' % name
+
+            if name in pending:
+                data = pending[name]
+            else:
+                data = getattr(self, 'legacy_%s' % name)
+
+                if not data and getattr(self, hash_attr):
+                    # This is either already in a blob or empty.
+                    continue
+
+            data_hash = sha1(data).hexdigest()
+
+            if data:
+                blob = DiffBlob.objects.get_for_data(data, data_hash)
+            else:
+                blob = None
+
+            setattr(self, hash_attr, data_hash)
+            setattr(self, '%s_blob' % name, blob)
+            setattr(self, 'legacy_%s' % name, '')
+
+    def save(self, **kwargs):
+        self.store_diff_blobs()
+
+        super(FileDiff, self).save(**kwargs)
+
+    def update_diff_hashes(self):
+        """Computes the hashes of the diff and parent diff."""
+        self.diff_hash = sha1(self.diff or '').hexdigest()
+        self.parent_diff_hash = sha1(self.parent_diff or '').hexdigest()
+
+    def update_line_counts(self):
+        """
+        Counts the lines inserted, deleted and changed by the diff.
+
+        The counts are left as None for context diffs, which can't be
+        counted. See parser.get_diff_line_counts.
+        """
+        counts = get_diff_line_counts(self.diff or '')
+
+        for field in LINE_COUNT_FIELDS:
+            setattr(self, field, counts and counts[field])
+
+    def has_same_diff(self, other):
+        """
+        Returns whether this FileDiff has the same diff as another.
+
+        This compares the hashes of the diffs, if both have been computed,
+        instead of the diffs themselves.
+        """
+        if self.diff_hash and other.diff_hash:
+            return self.diff_hash == other.diff_hash
+
+        return self.diff == other.diff
+
+    def get_content_key(self):
+        """
+        Returns a key for what this FileDiff shows, for use in cache keys.
+
+        FileDiffs that apply the same diff and parent diff to the same file
+        in the same repository, like the unchanged files in a new revision
+        of a diff, have the same key, so they can share cached data. If the
+        hashes haven't been computed, the FileDiff's ID is used instead.
+        """
+        if not self.diff_hash:
+            return str(self.pk)
+
+        diffset = self.diffset
+
+        return sha1(u'\0'.join([
+            unicode(diffset.repository_id),
+            unicode(diffset.diffcompat),
+            self.source_file,
+            self.source_revision,
+            self.dest_file,
+            self.diff_hash,
+            self.parent_diff_hash,
+        ]).encode('utf-8')).hexdigest()
+
     def __unicode__(self):
         return u"%s (%s) -> %s (%s)" % (self.source_file, self.source_revision,
                                         self.dest_file, self.dest_detail)
@@ -67,6 +269,16 @@ class DiffSet(models.Model):
         help_text=_("The diff generator compatibility version to use. "
                     "This can and should be ignored."))
 
+    # Totals of the line counts of the files. These are None if any of the
+    # files' line counts are.
+    inserted_lines = models.IntegerField(_("inserted lines"), null=True,
+                                         blank=True)
+    deleted_lines = models.IntegerField(_("deleted lines"), null=True,
+                                        blank=True)
+    changed_lines = models.IntegerField(_("changed lines"), null=True,
+                                        blank=True)
+    hunk_count = models.IntegerField(_("hunk count"), null=True, blank=True)
+
     def save(self, **kwargs):
         """
         Saves this diffset.
@@ -84,6 +296,25 @@ class DiffSet(models.Model):
 
         super(DiffSet, self).save()
 
+    def update_line_counts(self):
+        """
+        Totals the line counts of the files in this diffset.
+
+        This doesn't save the diffset.
+        """
+        files = self.files.all()
+
+        if files.filter(inserted_lines__isnull=True).count():
+            totals = dict.fromkeys(LINE_COUNT_FIELDS)
+        else:
+            sums = files.aggregate(*[Sum(field)
+                                     for field in LINE_COUNT_FIELDS])
+            totals = dict([(field, sums['%s__sum' % field] or 0)
+                           for field in LINE_COUNT_FIELDS])
+
+        for field in LINE_COUNT_FIELDS:
+            setattr(self, field, totals[field])
+
     def __unicode__(self):
         return u"[%s] %s r%s" % (self.id, self.name, self.revision)
 
@@ -107,3 +338,96 @@ class DiffSetHistory(models.Model):
 
     class Meta:
         verbose_name_plural = "Diff set histories"
+
+
+class ChunkGenerationTask(models.Model):
+    """
+    A queued request to generate the diff chunks for a FileDiff.
+
+    These are created when a diff is uploaded and processed by the
+    generate_diff_chunks management command, so that the first person to
+    view a diff doesn't have to wait for it to be generated. If an
+    interdiffset is set, the chunks for the interdiff between the
+    FileDiff's diffset and the interdiffset are generated.
+    """
+    filediff = models.ForeignKey(FileDiff,
+                                 related_name='chunk_generation_tasks',
+                                 verbose_name=_('file diff'))
+    interdiffset = models.ForeignKey(
+        DiffSet,
+        null=True,
+        blank=True,
+        related_name='interdiff_chunk_generation_tasks',
+        verbose_name=_('interdiff diff set'))
+    queued = models.DateTimeField(_('queued'), default=datetime.now)
+    started = models.DateTimeField(_('started'), null=True, blank=True)
+    attempts = models.IntegerField(
+        _('attempts'),
+        default=0,
+        help_text=_("The number of times a worker has claimed the task."))
+    duration = models.FloatField(
+        _('duration'),
+        null=True,
+        blank=True,
+        help_text=_("The number of seconds spent generating the chunks."))
+    error = models.TextField(_('error'), blank=True)
+
+    def __unicode__(self):
+        if self.interdiffset_id:
+            return u'%s (interdiff against diff set %s)' % \
+                   (self.filediff.source_file, self.interdiffset_id)
+        else:
+            return self.filediff.source_file
+
+    class Meta:
+        ordering = ['queued']
+
+
+def _filediff_deleted_cb(sender, instance, **kwargs):
+    # Blobs are shared, so they're only deleted once nothing uses them.
+    blob_ids = [blob_id
+                for blob_id in (instance.diff_blob_id,
+                                instance.parent_diff_blob_id)
+                if blob_id]
+
+    if blob_ids:
+        DiffBlob.objects.delete_unused(blob_ids)
+
+
+def _get_file_list_version_key(diffset_id):
+    return 'diffset-file-list-version-%s' % diffset_id
+
+
+def get_file_list_version(diffset_id):
+    """
+    Returns the version of the cached file lists for a DiffSet.
+
+    The version is part of the cache keys for the file lists built by
+    diffutils.get_diff_file_list. It changes whenever the DiffSet or one of
+    its FileDiffs is saved or deleted, so stale lists are never used.
+    """
+    key = _get_file_list_version_key(diffset_id)
+    version = cache.get(key)
+
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(key, version)
+
+    return version
+
+
+def _file_list_changed_cb(sender, instance, **kwargs):
+    if isinstance(instance, FileDiff):
+        diffset_id = instance.diffset_id
+    else:
+        diffset_id = instance.pk
+
+    cache.delete(_get_file_list_version_key(diffset_id))
+
+
+pre_delete.connect(diffset_deleted_cb, sender=DiffSet)
+post_save.connect(_file_list_changed_cb, sender=DiffSet)
+post_delete.connect(_file_list_changed_cb, sender=DiffSet)
+post_save.connect(_file_list_changed_cb, sender=FileDiff)
+post_delete.connect(_file_list_changed_cb, sender=FileDiff)
+post_delete.connect(_filediff_deleted_cb, sender=FileDiff)
@@ -1,3 +1,6 @@
+from array import array
+
+
 class MyersDiffer:
     """
     An implementation of Eugene Myers's O(ND) Diff algorithm based on GNU diff.
@@ -15,10 +18,15 @@ class MyersDiffer:
         def __init__(self, data):
             self.data = data
             self.length = len(data)
-            self.modified = {}
-            self.undiscarded = []
+
+            # A bitmap of modified lines. There's one extra, always unset,
+            # entry at the end, which both index -1 and index "length" map
+            # to. This saves bounds checks when scanning the ends of runs
+            # of changes.
+            self.modified = bytearray(self.length + 1)
+            self.undiscarded = array('i', [0]) * self.length
             self.undiscarded_lines = 0
-            self.real_indexes = []
+            self.real_indexes = array('i', [0]) * self.length
 
     def __init__(self, a, b, ignore_space=False):
         if type(a) != type(b):
@@ -42,8 +50,8 @@ class MyersDiffer:
 
     def ratio(self):
         self._gen_diff_data()
-        a_equals = self.a_data.length - len(self.a_data.modified)
-        b_equals = self.b_data.length - len(self.b_data.modified)
+        a_equals = self.a_data.length - self.a_data.modified.count('\x01')
+        b_equals = self.b_data.length - self.b_data.modified.count('\x01')
 
         return 1.0 * (a_equals + b_equals) / \
                      (self.a_data.length + self.b_data.length)
@@ -78,18 +86,21 @@ class MyersDiffer:
         """
         self._gen_diff_data()
 
+        a_length = self.a_data.length
+        b_length = self.b_data.length
+        a_modified = self.a_data.modified
+        b_modified = self.b_data.modified
+
         a_line = b_line = 0
         last_group = None
 
         # Go through the entire set of lines on both the old and new files
-        while a_line < self.a_data.length or b_line < self.b_data.length:
+        while a_line < a_length or b_line < b_length:
             a_start = a_line
             b_start = b_line
 
-            if a_line < self.a_data.length and \
-               not self.a_data.modified.get(a_line, False) and \
-               b_line < self.b_data.length and \
-               not self.b_data.modified.get(b_line, False):
+            if a_line < a_length and not a_modified[a_line] and \
+               b_line < b_length and not b_modified[b_line]:
                 # Equal
                 a_changed = b_changed = 1
                 tag = "equal"
@@ -101,17 +112,15 @@ class MyersDiffer:
                 # Count every old line that's been modified, and the
                 # remainder of old lines if we've reached the end of the new
                 # file.
-                while a_line < self.a_data.length and \
-                      (b_line >= self.b_data.length or \
-                       self.a_data.modified.get(a_line, False)):
+                while a_line < a_length and \
+                      (b_line >= b_length or a_modified[a_line]):
                     a_line += 1
 
                 # Count every new line that's been modified, and the
                 # remainder of new lines if we've reached the end of the old
                 # file.
-                while b_line < self.b_data.length and \
-                      (a_line >= self.a_data.length or \
-                       self.b_data.modified.get(b_line, False)):
+                while b_line < b_length and \
+                      (a_line >= a_length or b_modified[b_line]):
                     b_line += 1
 
                 a_changed = a_line - a_start
@@ -148,7 +157,7 @@ class MyersDiffer:
 
 
         if not last_group:
-            last_group = ("equal", 0, self.a_data.length, 0, self.b_data.length)
+            last_group = ("equal", 0, a_length, 0, b_length)
 
         yield last_group
 
@@ -168,6 +177,10 @@ class MyersDiffer:
         self.max_lines = self.a_data.undiscarded_lines + \
                          self.b_data.undiscarded_lines + 3
 
+        # The diagonal vectors are allocated once here and shared by every
+        # _find_sms call made while computing the LCS. Unlike the rest of
+        # the state, these are kept as lists, since they're accessed in the
+        # innermost loops, where lists are faster to index than arrays.
         vector_size = self.a_data.undiscarded_lines + \
                       self.b_data.undiscarded_lines + 3
         self.fdiag = [0] * vector_size
@@ -185,7 +198,7 @@ class MyersDiffer:
         Converts all unique lines of text into unique numbers. Comparing
         lists of numbers is faster than comparing lists of strings.
         """
-        codes = []
+        codes = array('i')
 
         linenum = 0
 
@@ -243,13 +256,17 @@ class MyersDiffer:
         """
         down_vector = self.fdiag # The vector for the (0, 0) to (x, y) search
         up_vector   = self.bdiag # The vector for the (u, v) to (N, M) search
+        downoff = self.downoff
+        upoff = self.upoff
+        a_undiscarded = self.a_data.undiscarded
+        b_undiscarded = self.b_data.undiscarded
 
         down_k = a_lower - b_lower # The k-line to start the forward search
         up_k   = a_upper - b_upper # The k-line to start the reverse search
         odd_delta = (down_k - up_k) % 2 != 0
 
-        down_vector[self.downoff + down_k] = a_lower
-        up_vector[self.upoff + up_k] = a_upper
+        down_vector[downoff + down_k] = a_lower
+        up_vector[upoff + up_k] = a_upper
 
         dmin = a_lower - b_upper
         dmax = a_upper - b_lower
@@ -266,20 +283,20 @@ class MyersDiffer:
 
             if down_min > dmin:
                 down_min -= 1
-                down_vector[self.downoff + down_min - 1] = -1
+                down_vector[downoff + down_min - 1] = -1
             else:
                 down_min += 1
 
             if down_max < dmax:
                 down_max += 1
-                down_vector[self.downoff + down_max + 1] = -1
+                down_vector[downoff + down_max + 1] = -1
             else:
                 down_max -= 1
 
             # Extend the forward path
             for k in xrange(down_max, down_min - 1, -2):
-                tlo = down_vector[self.downoff + k - 1]
-                thi = down_vector[self.downoff + k + 1]
+                tlo = down_vector[downoff + k - 1]
+                thi = down_vector[downoff + k + 1]
 
                 if tlo >= thi:
                     x = tlo + 1
@@ -292,35 +309,35 @@ class MyersDiffer:
                 # Find the end of the furthest reaching forward D-path in
                 # diagonal k
                 while x < a_upper and y < b_upper and \
-                      self.a_data.undiscarded[x] == self.b_data.undiscarded[y]:
+                      a_undiscarded[x] == b_undiscarded[y]:
                     x += 1
                     y += 1
 
                 if odd_delta and up_min <= k <= up_max and \
-                   up_vector[self.upoff + k] <= x:
+                   up_vector[upoff + k] <= x:
                     return x, y, True, True
 
                 if x - old_x > self.SNAKE_LIMIT:
                     big_snake = True
 
-                down_vector[self.downoff + k] = x
+                down_vector[downoff + k] = x
 
             # Extend the reverse path
             if up_min > dmin:
                 up_min -= 1
-                up_vector[self.upoff + up_min - 1] = self.max_lines
+                up_vector[upoff + up_min - 1] = self.max_lines
             else:
                 up_min += 1
 
             if up_max < dmax:
                 up_max += 1
-                up_vector[self.upoff + up_max + 1] = self.max_lines
+                up_vector[upoff + up_max + 1] = self.max_lines
             else:
                 up_max -= 1
 
             for k in xrange(up_max, up_min - 1, -2):
-                tlo = up_vector[self.upoff + k - 1]
-                thi = up_vector[self.upoff + k + 1]
+                tlo = up_vector[upoff + k - 1]
+                thi = up_vector[upoff + k + 1]
 
                 if tlo < thi:
                     x = tlo
@@ -331,19 +348,18 @@ class MyersDiffer:
                 old_x = x
 
                 while x > a_lower and y > b_lower and \
-                      self.a_data.undiscarded[x - 1] == \
-                      self.b_data.undiscarded[y - 1]:
+                      a_undiscarded[x - 1] == b_undiscarded[y - 1]:
                     x -= 1
                     y -= 1
 
                 if not odd_delta and down_min <= k <= down_max and \
-                   x <= down_vector[self.downoff + k]:
+                   x <= down_vector[downoff + k]:
                     return x, y, True, True
 
                 if old_x - x > self.SNAKE_LIMIT:
                     big_snake = True
 
-                up_vector[self.upoff + k] = x
+                up_vector[upoff + k] = x
 
             if find_minimal:
                 continue
@@ -361,7 +377,7 @@ class MyersDiffer:
             if cost > 200 and big_snake:
                 ret_x, ret_y, best = \
                     self._find_diagonal(down_min, down_max, down_k, 0,
-                                        self.downoff, down_vector,
+                                        downoff, down_vector,
                                         lambda x: x - a_lower,
                                         lambda x: a_lower + self.SNAKE_LIMIT <=
                                                   x < a_upper,
@@ -374,7 +390,7 @@ class MyersDiffer:
                     return ret_x, ret_y, True, False
 
                 ret_x, ret_y, best = \
-                    self._find_diagonal(up_min, up_max, up_k, best, self.upoff,
+                    self._find_diagonal(up_min, up_max, up_k, best, upoff,
                                         up_vector,
                                         lambda x: a_upper - x,
                                         lambda x: a_lower < x <= a_upper -
@@ -397,7 +413,7 @@ class MyersDiffer:
                 # Find the forward diagonal that maximized x + y
                 fxy_best = -1
                 for d in xrange(down_max, down_min - 1, -2):
-                    x = min(down_vector[self.downoff + d], a_upper)
+                    x = min(down_vector[downoff + d], a_upper)
                     y = x - d
 
                     if b_upper < y:
@@ -411,7 +427,7 @@ class MyersDiffer:
                 # Find the backward diagonal that minimizes x + y
                 bxy_best = self.max_lines
                 for d in xrange(up_max, up_min - 1, -2):
-                    x = max(a_lower, up_vector[self.upoff + d])
+                    x = max(a_lower, up_vector[upoff + d])
                     y = x - d
 
                     if y < b_lower:
@@ -478,12 +494,12 @@ class MyersDiffer:
         if a_lower == a_upper:
             # Inserted lines.
             while b_lower < b_upper:
-                self.b_data.modified[self.b_data.real_indexes[b_lower]] = True
+                self.b_data.modified[self.b_data.real_indexes[b_lower]] = 1
                 b_lower += 1
         elif b_lower == b_upper:
             # Deleted lines
             while a_lower < a_upper:
-                self.a_data.modified[self.a_data.real_indexes[a_lower]] = True
+                self.a_data.modified[self.a_data.real_indexes[a_lower]] = 1
                 a_lower += 1
         else:
             # Find the middle snake and length of an optimal path for A and B
@@ -507,15 +523,21 @@ class MyersDiffer:
         the two lines are identical, we can shift the chunk so that the line
         appears both before and after the line, rather than only after.
         """
+        modified = data.modified
+        other_modified = other_data.modified
+
+        # j may step outside of the other file's range while runs are
+        # being moved around. Lines there are treated as unmodified.
         i = j = 0
         i_end = data.length
+        j_end = other_data.length
 
         while True:
             # Scan forward in order to find the start of a run of changes.
-            while i < i_end and not data.modified.get(i, False):
+            while i < i_end and not modified[i]:
                 i += 1
 
-                while other_data.modified.get(j, False):
+                while 0 <= j < j_end and other_modified[j]:
                     j += 1
 
             if i == i_end:
@@ -525,10 +547,10 @@ class MyersDiffer:
 
             # Find the end of these changes
             i += 1
-            while data.modified.get(i, False):
+            while modified[i]:
                 i += 1
 
-            while other_data.modified.get(j, False):
+            while 0 <= j < j_end and other_modified[j]:
                 j += 1
 
             while True:
@@ -541,21 +563,21 @@ class MyersDiffer:
                     start -= 1
                     i -= 1
 
-                    data.modified[start] = True
-                    data.modified[i] = False
+                    modified[start] = 1
+                    modified[i] = 0
 
-                    while data.modified.get(start - 1, False):
+                    while modified[start - 1]:
                         start -= 1
 
                     j -= 1
-                    while other_data.modified.get(j, False):
+                    while 0 <= j < j_end and other_modified[j]:
                         j -= 1
 
                 # The end of the changed run at the last point where it
                 # corresponds to the changed run in the other data set.
                 # If it's equal to i_end, then we didn't find a corresponding
                 # point.
-                if other_data.modified.get(j - 1, False):
+                if 0 < j <= j_end and other_modified[j - 1]:
                     corresponding = i
                 else:
                     corresponding = i_end
@@ -563,17 +585,17 @@ class MyersDiffer:
                 # Move the changed region forward as long as the first
                 # changed line is the same as the following unchanged line.
                 while i != i_end and data.data[start] == data.data[i]:
-                    data.modified[start] = False
-                    data.modified[i] = True
+                    modified[start] = 0
+                    modified[i] = 1
 
                     start += 1
                     i += 1
 
-                    while data.modified.get(i, False):
+                    while modified[i]:
                         i += 1
 
                     j += 1
-                    while other_data.modified.get(j, False):
+                    while 0 <= j < j_end and other_modified[j]:
                         j += 1
                         corresponding = i
 
@@ -586,11 +608,11 @@ class MyersDiffer:
                 start -= 1
                 i -= 1
 
-                data.modified[start] = True
-                data.modified[i] = False
+                modified[start] = 1
+                modified[i] = 0
 
                 j -= 1
-                while other_data.modified.get(j, False):
+                while 0 <= j < j_end and other_modified[j]:
                     j -= 1
 
     def _discard_confusing_lines(self):
@@ -695,19 +717,15 @@ class MyersDiffer:
                     data.real_indexes[j] = i
                     j += 1
                 else:
-                    data.modified[i] = True
+                    data.modified[i] = 1
 
             data.undiscarded_lines = j
 
 
-        self.a_data.undiscarded = [0] * self.a_data.length
-        self.b_data.undiscarded = [0] * self.b_data.length
-        self.a_data.real_indexes = [0] * self.a_data.length
-        self.b_data.real_indexes = [0] * self.b_data.length
-        a_discarded = [0] * self.a_data.length
-        b_discarded = [0] * self.b_data.length
-        a_code_counts = [0] * (1 + self.last_code)
-        b_code_counts = [0] * (1 + self.last_code)
+        a_discarded = bytearray(self.a_data.length)
+        b_discarded = bytearray(self.b_data.length)
+        a_code_counts = array('i', [0]) * (1 + self.last_code)
+        b_code_counts = array('i', [0]) * (1 + self.last_code)
 
         for item in self.a_data.data:
             a_code_counts[item] += 1
@@ -42,23 +42,31 @@ class DiffParser(object):
 
         self.files = []
         file = None
+        body_start = 0
         i = 0
 
         # Go through each line in the diff, looking for diff headers.
+        # Everything between one file's header and the next is that file's
+        # body. It's joined once when the file ends, rather than a line at
+        # a time, which would be quadratic on large diffs.
         while i < len(self.lines):
             next_linenum, new_file = self.parse_change_header(i)
 
             if new_file:
                 # This line is the start of a new file diff.
+                if file:
+                    file.data += self.join_lines(body_start, i)
+
                 file = new_file
                 self.files.append(file)
                 i = next_linenum
+                body_start = i
             else:
-                if file:
-                    file.data += self.lines[i] + "\n"
-
                 i += 1
 
+        if file:
+            file.data += self.join_lines(body_start, len(self.lines))
+
         logging.debug("DiffParser.parse: Finished parsing diff.")
 
         return self.files
@@ -86,7 +94,8 @@ class DiffParser(object):
             file.origInfo = info.get('origInfo')
             file.newInfo  = info.get('newInfo')
             file.origChangesetId = info.get('origChangesetId')
-            file.data = ""
+
+            header_lines = []
 
             # The header is part of the diff, so make sure it gets in the
             # diff content. But only the parts that patch will understand.
@@ -103,10 +112,22 @@ class DiffParser(object):
                     self.lines[i + 1] == self.INDEX_SEP):
 
                     # This is a valid part of a diff header. Add it.
-                    file.data += self.lines[i] + "\n"
+                    header_lines.append(line + "\n")
+
+            file.data = "".join(header_lines)
 
         return linenum, file
 
+    def join_lines(self, start, end):
+        """
+        Returns the lines in the range [start, end) as a string, with each
+        line terminated by a newline.
+        """
+        if start >= end:
+            return ""
+
+        return "\n".join(self.lines[start:end]) + "\n"
+
     def parse_special_header(self, linenum, info):
         """
         Parses part of a diff beginning at the specified line number, trying
@@ -184,5 +205,88 @@ class DiffParser(object):
 
         The returned diff as composed of all FileDiffs in the provided diffset.
         """
-        return ''.join([filediff.diff for filediff in diffset.files.all()])
+        return ''.join(self.iter_raw_diff(diffset))
+
+    def iter_raw_diff(self, diffset):
+        """Yields the diff of each FileDiff in a diffset.
+
+        FileDiffs are loaded without being cached by the queryset, so a
+        large diff can be streamed without keeping every file in memory.
+        """
+        for filediff in diffset.files.select_related('diff_blob').iterator():
+            yield filediff.diff
+
+
+HUNK_HEADER_RE = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+
+
+def get_diff_line_counts(diff):
+    """
+    Counts the lines changed by a unified diff of a single file.
+
+    Returns a dictionary with the number of inserted, deleted and changed
+    lines, and the number of hunks. In each run of removed and added lines,
+    a removed line and an added line make up a changed line, and the rest
+    of the run is counted as deleted or inserted lines. This is how the
+    diff viewer pairs up lines.
+
+    Returns None for context diffs, which aren't counted.
+    """
+    counts = {
+        'inserted_lines': 0,
+        'deleted_lines': 0,
+        'changed_lines': 0,
+        'hunk_count': 0,
+    }
+
+    def end_run(num_deleted, num_inserted):
+        num_changed = min(num_deleted, num_inserted)
+        counts['changed_lines'] += num_changed
+        counts['deleted_lines'] += num_deleted - num_changed
+        counts['inserted_lines'] += num_inserted - num_changed
+
+    lines = diff.splitlines()
+    i = 0
+
+    while i < len(lines):
+        m = HUNK_HEADER_RE.match(lines[i])
+        i += 1
+
+        if not m:
+            if lines[i - 1].startswith('***************'):
+                return None
+
+            continue
+
+        counts['hunk_count'] += 1
+        old_left = int(m.group(1) or 1)
+        new_left = int(m.group(2) or 1)
+        num_deleted = num_inserted = 0
+
+        # The header gives the number of lines on each side, which tells us
+        # where the hunk ends, even if a removed line looks like a header.
+        while i < len(lines) and (old_left > 0 or new_left > 0):
+            line = lines[i]
+            i += 1
+
+            if line.startswith('\\'):
+                # "\ No newline at end of file"
+                continue
+            elif line.startswith('-'):
+                num_deleted += 1
+                old_left -= 1
+            elif line.startswith('+'):
+                num_inserted += 1
+                new_left -= 1
+            elif line.startswith(' ') or not line:
+                end_run(num_deleted, num_inserted)
+                num_deleted = num_inserted = 0
+                old_left -= 1
+                new_left -= 1
+            else:
+                i -= 1
+                break
+
+        end_run(num_deleted, num_inserted)
 
+    return counts
@@ -0,0 +1,436 @@
+import re
+
+
+class PatchError(Exception):
+    """An error encountered while applying a diff to a file."""
+    def __init__(self, msg, linenum=None):
+        Exception.__init__(self, msg)
+        self.linenum = linenum
+
+
+class UnsupportedPatchError(PatchError):
+    """The diff isn't in a format the in-process patcher understands.
+
+    Callers can fall back on the external ``patch`` tool when this is
+    raised.
+    """
+    pass
+
+
+class HunkApplyError(PatchError):
+    """A hunk from the diff could not be located in the file.
+
+    The hunk number is 1-based, as with ``patch`` output. ``linenum`` is
+    the line in the diff where the hunk begins, and ``orig_linenum`` is the
+    line in the original file where the hunk was expected to apply.
+    """
+    def __init__(self, msg, hunk_num, linenum, orig_linenum):
+        PatchError.__init__(self, msg, linenum)
+        self.hunk_num = hunk_num
+        self.orig_linenum = orig_linenum
+
+
+class Hunk(object):
+    """A single hunk from a unified diff.
+
+    ``lines`` is a list of (op, text) tuples, where ``op`` is one of
+    ``' '``, ``'-'`` or ``'+'`` and ``text`` contains the line ending, if
+    there is one.
+    """
+    def __init__(self, orig_start, orig_len, new_start, new_len, linenum):
+        self.orig_start = orig_start
+        self.orig_len = orig_len
+        self.new_start = new_start
+        self.new_len = new_len
+        self.linenum = linenum
+        self.lines = []
+
+    def get_orig_lines(self):
+        return [text for op, text in self.lines if op != '+']
+
+    def get_prefix_context(self):
+        """Returns the number of context lines before the first change."""
+        count = 0
+
+        for op, text in self.lines:
+            if op != ' ':
+                break
+
+            count += 1
+
+        return count
+
+    def get_suffix_context(self):
+        """Returns the number of context lines after the last change."""
+        count = 0
+
+        for op, text in reversed(self.lines):
+            if op != ' ':
+                break
+
+            count += 1
+
+        return count
+
+
+class Patcher(object):
+    """Applies a single-file unified diff to a buffer, in-process.
+
+    This mimics the behavior of GNU patch (with the default fuzz factor
+    of 2) closely enough to produce byte-identical results for the diffs
+    we store. That includes offset searching, fuzzy matching of context
+    lines, and ``\\ No newline at end of file`` markers.
+
+    Both the diff and the file are expected to have had their line endings
+    normalized through ``convert_line_endings`` beforehand.
+    """
+    HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+    NO_NEWLINE_PREFIX = '\\'
+
+    MAX_FUZZ = 2
+
+    def __init__(self, diff, filename=None):
+        self.diff = diff
+        self.filename = filename
+        self.hunks = self._parse_hunks(diff)
+
+    def apply(self, data):
+        """Applies the diff to the data, returning the patched result."""
+        lines = data.splitlines(True)
+        num_lines = len(lines)
+        result = []
+
+        # Both of these follow GNU patch's terminology. The offset is the
+        # accumulated difference between where hunks said they'd apply
+        # and where they actually did. The frozen line is the last line
+        # of the original file that's been written out or consumed.
+        in_offset = 0
+        last_frozen_line = 0
+
+        for hunk_num, hunk in enumerate(self.hunks):
+            orig_lines = hunk.get_orig_lines()
+            prefix_context = hunk.get_prefix_context()
+            suffix_context = hunk.get_suffix_context()
+            max_fuzz = min(self.MAX_FUZZ,
+                           max(prefix_context, suffix_context))
+
+            where = None
+
+            for fuzz in xrange(max_fuzz + 1):
+                where, in_offset = \
+                    self._locate_hunk(hunk, orig_lines, lines, fuzz,
+                                      prefix_context, suffix_context,
+                                      in_offset, last_frozen_line)
+
+                if where is not None:
+                    break
+
+                if hunk_num == 0 and self._is_reversed(hunk, lines, fuzz):
+                    # patch will detect this and, when run non-interactively,
+                    # refuse to apply the diff.
+                    raise HunkApplyError(
+                        "The diff for %s appears to be reversed or "
+                        "already applied" % (self.filename or "the file"),
+                        hunk_num + 1, hunk.linenum,
+                        self._get_first_line(hunk))
+
+            if where is None:
+                raise HunkApplyError(
+                    "Hunk #%d (line %d of the diff) failed to apply to "
+                    "%s at line %d" %
+                    (hunk_num + 1, hunk.linenum + 1,
+                     self.filename or "the file",
+                     self._get_first_line(hunk) + in_offset),
+                    hunk_num + 1, hunk.linenum,
+                    self._get_first_line(hunk) + in_offset)
+
+            # Write out the hunk. As in GNU patch, lines from the original
+            # file are only copied once we reach a change, so trailing
+            # context is left for the next hunk (or the end of the file).
+            # Context lines always come from the original file, which
+            # matters when fuzz was used.
+            start = where - 1
+            old = 0
+            last_context = -1
+
+            for i, (op, text) in enumerate(hunk.lines):
+                if op == ' ':
+                    last_context = i
+
+            for i, (op, text) in enumerate(hunk.lines):
+                if op == ' ':
+                    old += 1
+                    continue
+
+                if start + old < last_frozen_line:
+                    raise HunkApplyError(
+                        "Hunk #%d (line %d of the diff) is misordered "
+                        "relative to the previous hunk" %
+                        (hunk_num + 1, hunk.linenum + 1),
+                        hunk_num + 1, hunk.linenum, where)
+
+                self._copy_lines(result, lines, last_frozen_line,
+                                 start + old)
+                last_frozen_line = start + old
+
+                if op == '-':
+                    last_frozen_line += 1
+                    old += 1
+                else:
+                    # patch only terminates a preceding line that's missing
+                    # its newline when writing the inserted lines that
+                    # trail the hunk's last context line.
+                    if (i > last_context and result and
+                        not result[-1].endswith('\n')):
+                        result[-1] += '\n'
+
+                    result.append(text)
+
+        self._copy_lines(result, lines, last_frozen_line, num_lines)
+
+        return ''.join(result)
+
+    def _copy_lines(self, result, lines, start, end):
+        """Copies lines from the original file into the result.
+
+        If the last line written is missing its newline, one is added
+        before copying anything after it.
+        """
+        if start < end:
+            if result and not result[-1].endswith('\n'):
+                result[-1] += '\n'
+
+            result.extend(lines[start:end])
+
+    def _get_first_line(self, hunk):
+        """Returns the 1-based line in the original file a hunk targets.
+
+        Hunks that don't remove or keep any lines (pure insertions) specify
+        the line they insert after, so we bump them to the line they
+        insert before, as patch does.
+        """
+        if hunk.orig_len == 0:
+            return hunk.orig_start + 1
+
+        return hunk.orig_start
+
+    def _is_reversed(self, hunk, lines, fuzz):
+        """Returns whether the hunk would apply if it were reversed."""
+        reversed_hunk = Hunk(hunk.new_start, hunk.new_len,
+                             hunk.orig_start, hunk.orig_len, hunk.linenum)
+        swapped_ops = {'-': '+', '+': '-', ' ': ' '}
+        reversed_hunk.lines = [(swapped_ops[op], text)
+                               for op, text in hunk.lines]
+
+        where, in_offset = \
+            self._locate_hunk(reversed_hunk, reversed_hunk.get_orig_lines(),
+                              lines, fuzz,
+                              reversed_hunk.get_prefix_context(),
+                              reversed_hunk.get_suffix_context(), 0, 0)
+
+        return where is not None
+
+    def _locate_hunk(self, hunk, orig_lines, lines, fuzz, prefix_context,
+                     suffix_context, in_offset, last_frozen_line):
+        """Finds the line where a hunk should apply.
+
+        This returns a tuple of the 1-based line number (or None, if the
+        hunk can't be placed with this amount of fuzz) and the new offset.
+        This is a port of locate_hunk() from GNU patch.
+        """
+        num_lines = len(lines)
+        pat_lines = len(orig_lines)
+        first_guess = self._get_first_line(hunk) + in_offset
+
+        if not pat_lines:
+            # A null range always matches.
+            return first_guess, in_offset
+
+        context = max(prefix_context, suffix_context)
+        prefix_fuzz = fuzz + prefix_context - context
+        suffix_fuzz = fuzz + suffix_context - context
+        max_where = num_lines - (pat_lines - suffix_fuzz) + 1
+        min_where = last_frozen_line + 1
+        max_pos_offset = max_where - first_guess
+        max_neg_offset = first_guess - min_where
+        max_offset = max(max_pos_offset, max_neg_offset)
+
+        # Don't try lines <= 0.
+        if first_guess <= max_neg_offset:
+            max_neg_offset = first_guess - 1
+
+        if prefix_fuzz < 0 and hunk.orig_start <= 1:
+            # This can only match the start of the file.
+            if (suffix_fuzz < 0 and
+                (pat_lines != num_lines or
+                 prefix_context < last_frozen_line)):
+                # This can only match the entire file, and doesn't.
+                return None, in_offset
+
+            offset = 1 - first_guess
+
+            if (last_frozen_line <= prefix_context and
+                offset <= max_pos_offset and
+                self._match(orig_lines, lines, first_guess + offset,
+                            0, suffix_fuzz)):
+                return first_guess + offset, in_offset + offset
+
+            return None, in_offset
+        elif prefix_fuzz < 0:
+            prefix_fuzz = 0
+
+        if suffix_fuzz < 0:
+            # This can only match the end of the file.
+            offset = first_guess - (num_lines - pat_lines + 1)
+
+            if (offset <= max_neg_offset and
+                self._match(orig_lines, lines, first_guess - offset,
+                            prefix_fuzz, 0)):
+                return first_guess - offset, in_offset - offset
+
+            return None, in_offset
+
+        for offset in xrange(max_offset + 1):
+            if (offset <= max_pos_offset and
+                self._match(orig_lines, lines, first_guess + offset,
+                            prefix_fuzz, suffix_fuzz)):
+                return first_guess + offset, in_offset + offset
+
+            if (0 < offset <= max_neg_offset and
+                first_guess - offset <= max_where and
+                self._match(orig_lines, lines, first_guess - offset,
+                            prefix_fuzz, suffix_fuzz)):
+                return first_guess - offset, in_offset - offset
+
+        return None, in_offset
+
+    def _match(self, orig_lines, lines, where, prefix_fuzz, suffix_fuzz):
+        """Returns whether the hunk's original lines match at a location.
+
+        The first ``prefix_fuzz`` and last ``suffix_fuzz`` lines of the
+        hunk are ignored.
+        """
+        num_lines = len(lines)
+        i = where - 1 + prefix_fuzz
+
+        for j in xrange(prefix_fuzz, len(orig_lines) - suffix_fuzz):
+            if i >= num_lines:
+                if orig_lines[j] != '':
+                    return False
+            elif lines[i] != orig_lines[j]:
+                return False
+
+            i += 1
+
+        return True
+
+    def _parse_hunks(self, diff):
+        """Parses the hunks out of a unified diff.
+
+        Anything before the first hunk is considered part of the header.
+        Diffs without hunks, or diffs containing more than one file, raise
+        UnsupportedPatchError.
+        """
+        lines = diff.splitlines(True)
+        num_lines = len(lines)
+        hunks = []
+        i = 0
+
+        while i < num_lines:
+            line = lines[i]
+            m = self.HUNK_RE.match(line)
+
+            if not m:
+                if hunks and (line.startswith('--- ') or
+                              line.startswith('diff ') or
+                              line.startswith('Index: ')):
+                    raise UnsupportedPatchError(
+                        "The diff contains more than one file", i)
+
+                i += 1
+                continue
+
+            orig_start = int(m.group(1))
+            new_start = int(m.group(3))
+
+            if m.group(2) is None:
+                orig_len = 1
+            else:
+                orig_len = int(m.group(2))
+
+            if m.group(4) is None:
+                new_len = 1
+            else:
+                new_len = int(m.group(4))
+
+            hunk = Hunk(orig_start, orig_len, new_start, new_len, i)
+            hunks.append(hunk)
+            i += 1
+
+            orig_remaining = orig_len
+            new_remaining = new_len
+
+            while orig_remaining > 0 or new_remaining > 0:
+                if i >= num_lines:
+                    raise PatchError("Unexpected end of hunk #%d" %
+                                     len(hunks), i)
+
+                line = lines[i]
+
+                if line in ('\n', ''):
+                    # Some tools strip the trailing whitespace from blank
+                    # context lines. patch accepts these as context.
+                    op = ' '
+                    text = line
+                else:
+                    op = line[0]
+                    text = line[1:]
+
+                if op == ' ':
+                    orig_remaining -= 1
+                    new_remaining -= 1
+                elif op == '-':
+                    orig_remaining -= 1
+                elif op == '+':
+                    new_remaining -= 1
+                elif op == self.NO_NEWLINE_PREFIX and hunk.lines:
+                    self._strip_newline(hunk)
+                    i += 1
+                    continue
+                else:
+                    raise PatchError("Malformed patch at line %d: %s" %
+                                     (i + 1, line.rstrip()), i)
+
+                if orig_remaining < 0 or new_remaining < 0:
+                    raise PatchError("Malformed patch at line %d: %s" %
+                                     (i + 1, line.rstrip()), i)
+
+                hunk.lines.append((op, text))
+                i += 1
+
+            # A "No newline at end of file" marker may follow the last
+            # line of the hunk.
+            if (i < num_lines and
+                lines[i].startswith(self.NO_NEWLINE_PREFIX)):
+                self._strip_newline(hunk)
+                i += 1
+
+        if not hunks:
+            raise UnsupportedPatchError("The diff doesn't contain any "
+                                        "unified diff hunks")
+
+        return hunks
+
+    def _strip_newline(self, hunk):
+        op, text = hunk.lines[-1]
+
+        if text.endswith('\n'):
+            hunk.lines[-1] = (op, text[:-1])
+
+
+def apply_patch(diff, data, filename=None):
+    """Applies a unified diff to the data, returning the patched result.
+
+    See Patcher for details.
+    """
+    return Patcher(diff, filename).apply(data)
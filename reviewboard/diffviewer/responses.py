@@ -0,0 +1,68 @@
+import re
+from cStringIO import StringIO
+from gzip import GzipFile
+
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+
+_accepts_gzip_re = re.compile(r'\bgzip\b')
+
+
+class PatchResponse(HttpResponse):
+    """
+    A response that streams a patch to the client.
+
+    diffs is an iterable of strings, usually a generator loading one
+    FileDiff at a time, which are sent as they're read instead of being
+    joined into one string first. If the client accepts it, the patch is
+    gzip-compressed as it's sent.
+
+    Django joins the iterable into a string whenever response.content is
+    accessed, which GZipMiddleware and ConditionalGetMiddleware both do.
+    The response sets the streaming attribute so that Review Board's
+    versions of those middleware leave it alone. Anything else that reads
+    the content gets the whole patch, which is then sent as-is.
+    """
+    streaming = True
+
+    def __init__(self, request, diffs, filename):
+        gzip = _accepts_gzip_re.search(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''))
+
+        if gzip:
+            diffs = self._gzip_diffs(diffs)
+
+        super(PatchResponse, self).__init__(diffs, mimetype='text/x-patch')
+
+        if gzip:
+            self['Content-Encoding'] = 'gzip'
+
+        patch_vary_headers(self, ('Accept-Encoding',))
+        self['Content-Disposition'] = 'inline; filename=%s' % filename
+
+    def _get_content(self):
+        # Joining the iterable consumes it, so keep the result to send.
+        content = ''.join(self._container)
+        self._container = [content]
+        self._is_string = True
+
+        return content
+
+    content = property(_get_content, HttpResponse._set_content)
+
+    def _gzip_diffs(self, diffs):
+        buf = StringIO()
+        gzip_file = GzipFile(mode='wb', compresslevel=6, fileobj=buf)
+
+        for diff in diffs:
+            gzip_file.write(diff)
+            data = buf.getvalue()
+
+            if data:
+                buf.seek(0)
+                buf.truncate()
+                yield data
+
+        gzip_file.close()
+        yield buf.getvalue()
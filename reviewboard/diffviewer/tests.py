@@ -1,13 +1,40 @@
+import base64
+import cPickle as pickle
 import os
+import re
+import shutil
+import tempfile
 import unittest
+import zlib
+from datetime import datetime, timedelta
 
+from django.core.cache import cache
+from django.http import HttpRequest
 from django.test import TestCase
 from djblets.siteconfig.models import SiteConfiguration
-
-from reviewboard.diffviewer.models import DiffSet, FileDiff
+from djblets.util.misc import cache_memoize
+
+from reviewboard.admin.middleware import ConditionalGetMiddleware, \
+                                         GZipMiddleware
+from reviewboard.diffviewer.chunkgen import MAX_TASK_ATTEMPTS, \
+                                            claim_next_task, \
+                                            queue_chunk_generation
+from reviewboard.diffviewer.chunklines import ChunkIndex, ChunkLines
+from reviewboard.diffviewer.chunkstore import DiskChunkStore
+from reviewboard.diffviewer.highlighting import LexerCache
+from reviewboard.diffviewer.histogramdiff import HistogramDiffer
+from reviewboard.diffviewer.management.commands.compress_diffs import \
+     Command as CompressDiffsCommand
+from reviewboard.diffviewer.models import ChunkGenerationTask, DiffBlob, \
+                                         DiffSet, FileDiff
+from reviewboard.diffviewer.patcher import HunkApplyError, \
+                                           UnsupportedPatchError, \
+                                           apply_patch
+from reviewboard.diffviewer.responses import PatchResponse
 from reviewboard.diffviewer.templatetags.difftags import highlightregion
 import reviewboard.diffviewer.diffutils as diffutils
 import reviewboard.diffviewer.parser as diffparser
+from reviewboard.scmtools.core import PRE_CREATION
 from reviewboard.scmtools.models import Repository
 
 
@@ -34,12 +61,74 @@ class MyersDifferTest(TestCase):
                           ("insert",  5, 5, 5, 9),
                           ("equal",   5, 8, 9, 12)])
 
+    def testShiftChunks(self):
+        """Testing myers differ shifting changed chunks"""
+        self.__test_diff(["1", "1"],
+                         ["1", "0"],
+                         [("equal",   0, 1, 0, 1),
+                          ("replace", 1, 2, 1, 2)])
+
+        self.__test_diff(["0", "0", "0", "0"],
+                         ["0", "0", "0", "1", "1"],
+                         [("equal",   0, 3, 0, 3),
+                          ("replace", 3, 4, 3, 4),
+                          ("insert",  4, 4, 4, 5)])
+
 
     def __test_diff(self, a, b, expected):
         opcodes = list(diffutils.MyersDiffer(a, b).get_opcodes())
         self.assertEquals(opcodes, expected)
 
 
+class HistogramDifferTest(TestCase):
+    def testDiff(self):
+        """Testing histogram differ"""
+        self.__test_diff(["1", "2", "3"],
+                         ["1", "2", "3"],
+                         [("equal", 0, 3, 0, 3),])
+
+        self.__test_diff(["1", "2", "3"],
+                         [],
+                         [("delete", 0, 3, 0, 0),])
+
+        self.__test_diff("1\n2\n3\n",
+                         "0\n1\n2\n3\n",
+                         [("insert", 0, 0, 0, 2),
+                          ("equal",  0, 6, 2, 8)])
+
+        self.__test_diff("1\n2\n3\n7\n",
+                         "1\n2\n4\n5\n6\n7\n",
+                         [("equal",   0, 4, 0, 4),
+                          ("replace", 4, 5, 4, 5),
+                          ("insert",  5, 5, 5, 9),
+                          ("equal",   5, 8, 9, 12)])
+
+    def testReordered(self):
+        """Testing histogram differ with reordered lines"""
+        self.__test_diff(["a", "x", "b", "x", "c"],
+                         ["c", "x", "a", "x", "b"],
+                         [("insert", 0, 0, 0, 2),
+                          ("equal",  0, 3, 2, 5),
+                          ("delete", 3, 5, 5, 5)])
+
+    def testInterestingLines(self):
+        """Testing histogram differ with interesting lines"""
+        differ = HistogramDiffer(["def a():\n", "    pass\n"],
+                                 ["def a():\n", "    return 1\n",
+                                  "def b():\n", "    pass\n"])
+        differ.add_interesting_line_regex('header', re.compile(r'def '))
+        list(differ.get_opcodes())
+
+        self.assertEqual(differ.get_interesting_lines('header', False),
+                         [(0, "def a():\n")])
+        self.assertEqual(differ.get_interesting_lines('header', True),
+                         [(0, "def a():\n"), (2, "def b():\n")])
+
+    def __test_diff(self, a, b, expected):
+        opcodes = list(HistogramDiffer(a, b).get_opcodes())
+        self.assertEquals(opcodes, expected)
+
+
 class InterestingLinesTest(TestCase):
     PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
 
@@ -142,6 +231,40 @@ class InterestingLinesTest(TestCase):
         self.assertEqual(lines[1][0], (1, 'class HelloWorld\n'))
         self.assertEqual(lines[1][1], (3, '\tdef helloWorld()\n'))
 
+    def testAliasedFilename(self):
+        """Testing interesting lines scanner with an aliased file name"""
+        a = ['import os\n', 'def build(env):\n', '    pass\n']
+        b = ['import os\n', 'def build(env):\n', '    return\n']
+        differ = diffutils.MyersDiffer(a, b)
+        diffutils.register_interesting_lines_for_filename(differ,
+                                                          'src/SConstruct')
+        list(differ.get_opcodes())
+
+        self.assertEqual(differ.get_interesting_lines('header', True),
+                         [(1, 'def build(env):\n')])
+
+    def testHeaderMatcher(self):
+        """Testing HeaderMatcher against the individual header regexes"""
+        lines = ['def foo(self):\n', '    class Bar(object):\n',
+                 '    return foo\n', '#define FOO\n', 'int main() {\n',
+                 '@interface Foo\n', '- (void) sayHello {\n', '}\n',
+                 '  public static void main(String[] args) {\n',
+                 'var foo = function() {\n', '\n', '']
+
+        for ext, regexes in diffutils.HEADER_REGEXES.iteritems():
+            matcher = diffutils.get_header_matcher('file' + ext)
+            self.assertTrue(matcher is diffutils.get_header_matcher(
+                'other' + ext))
+
+            for line in lines:
+                self.assertEqual(
+                    bool(matcher.match(line)),
+                    bool([regex for regex in regexes if regex.match(line)]))
+
+        self.assertEqual(
+            diffutils.get_header_matcher('foo.py').first_chars,
+            set(['c', 'd']))
+
     def __get_lines(self, filename):
         f = open(os.path.join(self.PREFIX, "orig_src", filename), "r")
         a = f.readlines()
@@ -296,6 +419,27 @@ class DiffParserTest(unittest.TestCase):
         regions = diffutils.get_line_changed_regions(old, new)
         deepEqual(regions, (None, None))
 
+    def testInterlineBatch(self):
+        """Testing inter-line diffs for a batch of lines"""
+        pairs = [
+            ('submitter = models.ForeignKey(Person)',
+             'submitter = models.ForeignKey(User)'),
+            ('abcdefghijklm', 'nopqrstuvwxyz'),
+            ('short', 'a much, much longer line'),
+            ('same', 'same'),
+            ('submitter = models.ForeignKey(Person)',
+             'submitter = models.ForeignKey(User)'),
+        ]
+        cache = {}
+
+        regions = diffutils.get_lines_changed_regions(pairs, cache)
+        self.assertEqual(regions,
+                         [diffutils.get_line_changed_regions(old, new)
+                          for old, new in pairs])
+        self.assertEqual(regions[2], (None, None))
+        self.assertEqual(regions[3], ([], []))
+        self.assertEqual(len(cache), 4)
+
     def testMoveDetection(self):
         """Testing move detection"""
         # movetest1 has two blocks of code that would appear to be moves:
@@ -337,6 +481,128 @@ class DiffParserTest(unittest.TestCase):
             self.assertEqual(i_moves[0][j], i)
             self.assertEqual(r_moves[0][i], j)
 
+    def testMoveDetectionLimits(self):
+        """Testing move detection with a minimum size and time limit"""
+        old = self._get_file('orig_src', 'movetest1.c')
+        new = self._get_file('new_src', 'movetest1.c')
+
+        # The moved function is 5 lines long.
+        for min_move_lines, num_moves in ((5, 2), (6, 0)):
+            differ = diffutils.Differ(old.splitlines(), new.splitlines())
+            moves = [meta for tag, i1, i2, j1, j2, meta in
+                     diffutils.opcodes_with_metadata(differ, min_move_lines)
+                     if 'moved' in meta]
+            self.assertEqual(len(moves), num_moves)
+
+        # With a time limit that's already passed, moves aren't looked for.
+        differ = diffutils.Differ(old.splitlines(), new.splitlines())
+
+        for tag, i1, i2, j1, j2, meta in \
+            diffutils.opcodes_with_metadata(differ, move_timeout=-1):
+            self.assertFalse('moved' in meta)
+
+            if tag != 'equal':
+                self.assertTrue(meta['moves_skipped'])
+
+    def _get_file(self, *relative):
+        f = open(os.path.join(*tuple([self.PREFIX] + list(relative))))
+        data = f.read()
+        f.close()
+        return data
+
+
+class PatcherTest(unittest.TestCase):
+    PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
+
+    def testBuiltinMatchesExternal(self):
+        """Testing in-process patching against the patch command"""
+        for filename in os.listdir(os.path.join(self.PREFIX, 'orig_src')):
+            diff_path = os.path.join(self.PREFIX, 'diffs', 'unified',
+                                     filename + '.diff')
+
+            if not os.path.exists(diff_path):
+                continue
+
+            old = self._get_file('orig_src', filename)
+            diff = self._get_file('diffs', 'unified', filename + '.diff')
+
+            self.assertEqual(
+                diffutils.patch(diff, old, filename, engine='builtin'),
+                diffutils.patch(diff, old, filename, engine='external'))
+
+    def testBuiltinContextDiff(self):
+        """Testing in-process patching falls back for context diffs"""
+        old = self._get_file('orig_src', 'foo.c')
+        new = self._get_file('new_src', 'foo.c')
+        diff = self._get_file('diffs', 'context', 'foo.c.diff')
+
+        self.assertRaises(UnsupportedPatchError,
+                          lambda: apply_patch(diff, old))
+        self.assertEqual(diffutils.patch(diff, old, 'foo.c',
+                                         engine='builtin'),
+                         new)
+
+    def testOffsetAndFuzz(self):
+        """Testing in-process patching with offsets and fuzz"""
+        diff = ("--- a\n"
+                "+++ b\n"
+                "@@ -2,3 +2,4 @@\n"
+                " b\n"
+                " c\n"
+                "+X\n"
+                " d\n")
+
+        # The hunk applies two lines later than stated.
+        self.assertEqual(apply_patch(diff, "z\nz\na\nb\nc\nd\n"),
+                         "z\nz\na\nb\nc\nX\nd\n")
+
+        # The leading context line doesn't match, but fuzz allows it.
+        # Context always comes from the original file.
+        self.assertEqual(apply_patch(diff, "a\nq\nc\nd\n"),
+                         "a\nq\nc\nX\nd\n")
+
+    def testNoNewline(self):
+        """Testing in-process patching with missing trailing newlines"""
+        diff = ("--- a\n"
+                "+++ b\n"
+                "@@ -1,2 +1,2 @@\n"
+                " a\n"
+                "-b\n"
+                "\\ No newline at end of file\n"
+                "+c\n")
+        self.assertEqual(apply_patch(diff, "a\nb"), "a\nc\n")
+
+        diff = ("--- a\n"
+                "+++ b\n"
+                "@@ -1,2 +1,2 @@\n"
+                " a\n"
+                "-b\n"
+                "+c\n"
+                "\\ No newline at end of file\n")
+        self.assertEqual(apply_patch(diff, "a\nb\n"), "a\nc")
+
+    def testHunkErrors(self):
+        """Testing in-process patching reports failed hunks"""
+        diff = ("--- a\n"
+                "+++ b\n"
+                "@@ -1,3 +1,3 @@\n"
+                " a\n"
+                "-b\n"
+                "+B\n"
+                " c\n"
+                "@@ -10,3 +10,3 @@\n"
+                " j\n"
+                "-k\n"
+                "+K\n"
+                " l\n")
+
+        try:
+            apply_patch(diff, "a\nb\nc\nd\n", 'test.c')
+            self.fail("HunkApplyError was not raised")
+        except HunkApplyError, e:
+            self.assertEqual(e.hunk_num, 2)
+            self.assertEqual(e.linenum, 7)
+            self.assertEqual(e.orig_linenum, 10)
 
     def _get_file(self, *relative):
         f = open(os.path.join(*tuple([self.PREFIX] + list(relative))))
@@ -345,6 +611,232 @@ class DiffParserTest(unittest.TestCase):
         return data
 
 
+class ChunkLinesTest(unittest.TestCase):
+    def setUp(self):
+        # A replace chunk of three lines against two, where the first line
+        # has changed regions, the second only changes whitespace and the
+        # third was moved.
+        self.lines = ChunkLines(10, 3, 5, 3, 7, 2,
+                                ChunkLines.pack_markup(['a', 'b', 'c']),
+                                ChunkLines.pack_markup(['A', ' b']),
+                                {0: ([(0, 1)], [(0, 1)])},
+                                frozenset([1]),
+                                {2: 20})
+        self.expected = [
+            [10, 5, 'a', [(0, 1)], 7, 'A', [(0, 1)], False],
+            [11, 6, 'b', [], 8, ' b', [], True],
+            [12, 7, 'c', [], '', '', [], False, 20],
+        ]
+
+    def testLines(self):
+        """Testing ChunkLines building lines"""
+        self.assertEqual(len(self.lines), 3)
+        self.assertEqual(list(self.lines), self.expected)
+        self.assertEqual(self.lines[0], self.expected[0])
+        self.assertEqual(self.lines[-1], self.expected[-1])
+        self.assertRaises(IndexError, lambda: self.lines[3])
+
+    def testSlice(self):
+        """Testing ChunkLines slicing"""
+        lines = self.lines[1:]
+        self.assertTrue(isinstance(lines, ChunkLines))
+        self.assertEqual(list(lines), self.expected[1:])
+        self.assertEqual(list(self.lines[1:2]), self.expected[1:2])
+        self.assertEqual(list(self.lines[3:]), [])
+
+    def testPickle(self):
+        """Testing ChunkLines pickling"""
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            lines = pickle.loads(pickle.dumps(self.lines, protocol))
+            self.assertEqual(list(lines), self.expected)
+
+
+class ChunkIndexTest(unittest.TestCase):
+    def setUp(self):
+        def make_chunk(vlinenum, numlines, change, headers=None):
+            chunk = {
+                'change': change,
+                'lines': ChunkLines(vlinenum, numlines, vlinenum, numlines,
+                                    vlinenum, numlines,
+                                    ChunkLines.pack_markup(['x'] * numlines),
+                                    ChunkLines.pack_markup(['x'] * numlines)),
+                'numlines': numlines,
+                'meta': {},
+            }
+
+            if headers:
+                chunk['meta']['headers'] = headers
+                chunk['meta']['left_headers'] = []
+                chunk['meta']['right_headers'] = []
+
+            return chunk
+
+        self.file = {
+            'chunks': [
+                make_chunk(1, 10, 'equal', ('', '')),
+                make_chunk(11, 2, 'replace'),
+                make_chunk(13, 20, 'equal', ('def foo', 'def foo')),
+                make_chunk(33, 1, 'insert'),
+                make_chunk(34, 5, 'equal', ('', '')),
+            ],
+        }
+        self.index = ChunkIndex(self.file['chunks'])
+
+    def testFindChunk(self):
+        """Testing ChunkIndex.find_chunk"""
+        self.assertEqual(self.index.find_chunk(0), None)
+        self.assertEqual(self.index.find_chunk(1), 0)
+        self.assertEqual(self.index.find_chunk(10), 0)
+        self.assertEqual(self.index.find_chunk(11), 1)
+        self.assertEqual(self.index.find_chunk(33), 3)
+        self.assertEqual(self.index.find_chunk(38), 4)
+        self.assertEqual(self.index.find_chunk(39), None)
+
+    def testChunksInRange(self):
+        """Testing get_chunks_in_range with a ChunkIndex"""
+        chunks = list(diffutils.get_chunks_in_range(self.file, 9, 25))
+        self.assertEqual([chunk['index'] for chunk in chunks], [0, 1, 2, 3])
+        self.assertEqual([chunk['numlines'] for chunk in chunks],
+                         [2, 2, 20, 1])
+        self.assertEqual(chunks[0]['lines'][0][0], 9)
+        self.assertEqual(chunks[-1]['lines'][-1][0], 33)
+
+        # The last header is used for chunks without one of their own, and
+        # the cached chunks must not be modified.
+        chunks = list(diffutils.get_chunks_in_range(self.file, 35, 2))
+        self.assertEqual(chunks[0]['meta']['headers'], ['def foo', 'def foo'])
+        self.assertTrue('left_headers' in self.file['chunks'][4]['meta'])
+        self.assertEqual(self.file['chunks'][4]['meta']['headers'], ('', ''))
+
+
+class LexerCacheTest(unittest.TestCase):
+    def testGetLexer(self):
+        """Testing LexerCache looking up lexers"""
+        cache = LexerCache()
+
+        lexer = cache.get_lexer('src/foo.py')
+        self.assertEqual(lexer.name, 'Python')
+        self.assertTrue(cache.get_lexer('lib/foo.py') is lexer)
+        self.assertEqual(cache.get_lexer('Makefile').name, 'Makefile')
+        self.assertEqual(cache.get_lexer('foo.unknown-extension'), None)
+
+    def testOverrides(self):
+        """Testing LexerCache with lexer overrides"""
+        cache = LexerCache([('*.tmpl', 'html+django'),
+                            ('SConstruct', 'python')])
+
+        self.assertTrue('html+django' in
+                        cache.get_lexer('templates/foo.tmpl').aliases)
+        self.assertEqual(cache.get_lexer('src/SConstruct').name, 'Python')
+        self.assertEqual(cache.get_lexer('foo.c').name, 'C')
+
+
+class DiskChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='rb-tests-')
+        self.store = DiskChunkStore(self.path, 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def testGetSet(self):
+        """Testing DiskChunkStore storing and loading chunks"""
+        chunks = [{'change': 'equal', 'lines': [[1, 1, 'foo']]}]
+
+        self.assertEqual(self.store.get((1, 'hl-c2')), None)
+        self.store.set((1, 'hl-c2'), chunks)
+        self.assertEqual(self.store.get((1, 'hl-c2')), chunks)
+        self.assertEqual(self.store.get((1, 'c2')), None)
+
+    def testInvalidate(self):
+        """Testing DiskChunkStore invalidating filediffs"""
+        self.store.set((1, 'c2'), [])
+        self.store.set((2, 'c2'), [])
+        self.store.set((2, 'c2-interdiff-1'), [])
+        self.store.set((2, 'c2-interdiff-3'), [])
+
+        self.store.invalidate([1])
+
+        self.assertEqual(self.store.get((1, 'c2')), None)
+        self.assertEqual(self.store.get((2, 'c2-interdiff-1')), None)
+        self.assertEqual(self.store.get((2, 'c2')), [])
+        self.assertEqual(self.store.get((2, 'c2-interdiff-3')), [])
+
+    def testInvalidateWithoutWalking(self):
+        """Testing DiskChunkStore invalidating without walking the store"""
+        self.store.set((2, 'c2-interdiff-1'), [])
+        self.store._get_entries = self._fail_walk
+
+        self.store.invalidate([1])
+
+        self.assertEqual(self.store.get((2, 'c2-interdiff-1')), None)
+
+    def testRecordedSize(self):
+        """Testing DiskChunkStore using the size recorded by another process"""
+        self.store.set((1, 'c2'), [])
+
+        store = DiskChunkStore(self.path, self.store.max_size)
+        store._get_entries = self._fail_walk
+        store.set((2, 'c2'), [])
+
+        self.assertEqual(store.get((2, 'c2')), [])
+
+    def testEviction(self):
+        """Testing DiskChunkStore evicting least recently used chunks"""
+        data = [os.urandom(400).encode('hex')]
+
+        self.store.set((1, 'c2'), data)
+        entry_size = os.path.getsize(self.store._get_filename((1, 'c2')))
+        self.store.max_size = entry_size * 3 + entry_size / 2
+
+        # Make the first entry the least recently used.
+        os.utime(self.store._get_filename((1, 'c2')), (0, 0))
+        self.store.set((2, 'c2'), data)
+        self.store.set((3, 'c2'), data)
+        self.store.set((4, 'c2'), data)
+
+        self.assertEqual(self.store.get((1, 'c2')), None)
+        self.assertEqual(self.store.get((2, 'c2')), data)
+        self.assertEqual(self.store.get((3, 'c2')), data)
+        self.assertEqual(self.store.get((4, 'c2')), data)
+
+    def testEvictionRemovesRefs(self):
+        """Testing DiskChunkStore evicting interdiffs and their references"""
+        data = [os.urandom(400).encode('hex')]
+
+        self.store.set((2, 'c2-interdiff-1'), data)
+        entry_size = os.path.getsize(
+            self.store._get_filename((2, 'c2-interdiff-1')))
+        self.store.max_size = entry_size * 3 + entry_size / 2
+
+        os.utime(self.store._get_filename((2, 'c2-interdiff-1')), (0, 0))
+        self.store.set((3, 'c2'), data)
+        self.store.set((4, 'c2'), data)
+        self.store.set((5, 'c2'), data)
+
+        self.assertEqual(self.store.get((2, 'c2-interdiff-1')), None)
+        self.assertFalse(os.path.exists(
+            self.store._get_ref_filename((2, 'c2-interdiff-1'))))
+
+        # The directories of both filediffs are left empty, and are removed
+        # on the next eviction check.
+        self.store.evict()
+        self.assertFalse(os.path.exists(os.path.join(self.path, '1')))
+        self.assertFalse(os.path.exists(os.path.join(self.path, '2')))
+
+    def testDanglingRefs(self):
+        """Testing DiskChunkStore removing references to missing entries"""
+        self.store.set((2, 'c2-interdiff-1'), [])
+        os.unlink(self.store._get_filename((2, 'c2-interdiff-1')))
+
+        self.store.evict()
+
+        self.assertFalse(os.path.exists(os.path.join(self.path, '1')))
+
+    def _fail_walk(self):
+        self.fail('The whole store was walked')
+
+
 class HighlightRegionTest(TestCase):
     def setUp(self):
         siteconfig = SiteConfiguration.objects.get_current()
@@ -407,6 +899,20 @@ class HighlightRegionTest(TestCase):
             'foo=<span class="ab"><span class="hl">&quot;foo&quot;' +
             '</span></span>)')
 
+    def testRenderLineMarkup(self):
+        """Testing render_line_markup"""
+        self.assertEquals(diffutils.render_line_markup('abc'), 'abc')
+
+        self.assertEquals(diffutils.render_line_markup('abc  '),
+                          'abc<span class="ew">  </span>')
+
+        self.assertEquals(diffutils.render_line_markup('a  \tbc'),
+                          'a<span class="ew">  \t</span>bc')
+
+        self.assertEquals(diffutils.render_line_markup('abc ', [(1, 2)]),
+                          'a<span class="hl">b</span>c'
+                          '<span class="ew"> </span>')
+
 
 class DbTests(TestCase):
     """Unit tests for database operations."""
@@ -427,3 +933,830 @@ class DbTests(TestCase):
 
         filediff = FileDiff.objects.get(pk=filediff.id)
         self.assertEquals(filediff.source_file, long_filename)
+
+
+class ChunkGenerationTest(TestCase):
+    """Unit tests for generating diff chunks at upload time."""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        self.siteconfig = SiteConfiguration.objects.get_current()
+        self.siteconfig.set('diffviewer_syntax_highlighting', False)
+        cache.clear()
+
+        repository = Repository.objects.get(pk=1)
+        self.diffset1 = self._create_diffset(repository, 1, 'foo\n')
+        self.diffset2 = self._create_diffset(repository, 2, 'bar\n')
+
+    def tearDown(self):
+        self.siteconfig.set('diffviewer_chunk_generation', 'none')
+
+    def testDisabled(self):
+        """Testing chunk generation when disabled"""
+        self.siteconfig.set('diffviewer_chunk_generation', 'none')
+        self.assertEqual(queue_chunk_generation(self.diffset2, self.diffset1),
+                         [])
+        self.assertEqual(ChunkGenerationTask.objects.count(), 0)
+
+    def testQueue(self):
+        """Testing queueing chunk generation"""
+        self.siteconfig.set('diffviewer_chunk_generation', 'queue')
+        tasks = queue_chunk_generation(self.diffset2, self.diffset1)
+
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(tasks[0].interdiffset, None)
+        self.assertEqual(tasks[1].interdiffset, self.diffset2)
+
+        for task in tasks:
+            self.assertEqual(task.started, None)
+
+        self.assertEqual(claim_next_task(), tasks[0])
+        self.assertEqual(claim_next_task(), tasks[1])
+        self.assertEqual(claim_next_task(), None)
+
+    def testReclaimStaleTask(self):
+        """Testing claiming tasks whose worker died"""
+        self.siteconfig.set('diffviewer_chunk_generation', 'queue')
+        task = queue_chunk_generation(self.diffset1)[0]
+
+        for i in xrange(MAX_TASK_ATTEMPTS):
+            claimed = claim_next_task(stale_timeout=0)
+            self.assertEqual(claimed, task)
+            self.assertEqual(claimed.attempts, i + 1)
+
+            # The worker dies without finishing the task.
+            ChunkGenerationTask.objects.filter(pk=task.pk).update(
+                started=datetime.now() - timedelta(seconds=1))
+
+        self.assertEqual(claim_next_task(stale_timeout=0), None)
+
+    def testSync(self):
+        """Testing synchronous chunk generation"""
+        self.siteconfig.set('diffviewer_chunk_generation', 'sync')
+        queue_chunk_generation(self.diffset2, self.diffset1)
+
+        filediff1 = self.diffset1.files.get()
+        filediff2 = self.diffset2.files.get()
+
+        for task in ChunkGenerationTask.objects.all():
+            self.assertNotEqual(task.started, None)
+            self.assertNotEqual(task.duration, None)
+            self.assertEqual(task.error, '')
+
+        self.assertTrue(self._is_cached(filediff2, None, False))
+        self.assertTrue(self._is_cached(filediff1, filediff2, True))
+
+    def _is_cached(self, filediff, interfilediff, force_interdiff):
+        key = diffutils.get_chunks_cache_key(filediff, interfilediff,
+                                             force_interdiff, False)
+
+        return cache_memoize(key, lambda: None, large_data=True) is not None
+
+    def _create_diffset(self, repository, revision, content):
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=revision,
+                                         repository=repository,
+                                         diffcompat=2)
+        FileDiff.objects.create(
+            diffset=diffset,
+            source_file='README',
+            dest_file='README',
+            source_revision=PRE_CREATION,
+            dest_detail='',
+            diff='--- README\n+++ README\n@@ -0,0 +1,1 @@\n+%s' % content,
+            status=FileDiff.MODIFIED)
+
+        return diffset
+
+
+class ParallelChunksTest(TestCase):
+    """Unit tests for generating chunks for several files at once."""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_syntax_highlighting', False)
+        cache.clear()
+
+        self.repository = Repository.objects.get(pk=1)
+        self.diffset = DiffSet.objects.create(name='test',
+                                              revision=1,
+                                              repository=self.repository,
+                                              diffcompat=2)
+
+        for i in range(5):
+            FileDiff.objects.create(
+                diffset=self.diffset,
+                source_file='file%s' % i,
+                dest_file='file%s' % i,
+                source_revision=PRE_CREATION,
+                dest_detail='',
+                diff='--- file%s\n+++ file%s\n@@ -0,0 +1,%s @@\n%s' %
+                     (i, i, i + 1, '+line\n' * (i + 1)),
+                status=FileDiff.MODIFIED)
+
+    def testParallel(self):
+        """Testing get_diff_files generating chunks in parallel"""
+        self.repository.diff_generation_concurrency = 1
+        serial_files = diffutils.get_diff_files(self.diffset, None, None,
+                                                False)
+
+        cache.clear()
+        self.repository.diff_generation_concurrency = 3
+        parallel_files = diffutils.get_diff_files(self.diffset, None, None,
+                                                  False)
+
+        self.assertEqual(len(parallel_files), 5)
+
+        for serial_file, parallel_file in zip(serial_files, parallel_files):
+            self.assertEqual(serial_file['filediff'],
+                             parallel_file['filediff'])
+            self.assertEqual(serial_file['chunks'], parallel_file['chunks'])
+            self.assertEqual(parallel_file['num_changes'], 1)
+
+    def testParallelCached(self):
+        """Testing get_diff_files with cached chunks and no threads"""
+        self.repository.diff_generation_concurrency = 1
+        serial_files = diffutils.get_diff_files(self.diffset, None, None,
+                                                False)
+
+        def fail(*args):
+            self.fail('A thread pool was created for cached chunks')
+
+        self.repository.diff_generation_concurrency = 3
+        old_thread_pool = diffutils.ThreadPool
+        diffutils.ThreadPool = fail
+
+        try:
+            cached_files = diffutils.get_diff_files(self.diffset, None, None,
+                                                    False)
+        finally:
+            diffutils.ThreadPool = old_thread_pool
+
+        for serial_file, cached_file in zip(serial_files, cached_files):
+            self.assertEqual(serial_file['chunks'], cached_file['chunks'])
+
+
+class PatchedFileCacheTest(TestCase):
+    """Unit tests for caching original and patched files."""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        cache.clear()
+
+        diffset = DiffSet.objects.create(
+            name='test',
+            revision=1,
+            repository=Repository.objects.get(pk=1))
+        self.filediff = FileDiff.objects.create(
+            diffset=diffset,
+            source_file='README',
+            dest_file='README',
+            source_revision=PRE_CREATION,
+            dest_detail='',
+            diff='--- README\n+++ README\n@@ -1,1 +1,1 @@\n-foo\n+bar\n',
+            parent_diff='--- README\n+++ README\n@@ -0,0 +1,1 @@\n+foo\n',
+            status=FileDiff.MODIFIED)
+
+        self.num_patches = 0
+        self.old_patch = diffutils.patch
+
+        def counting_patch(*args, **kwargs):
+            self.num_patches += 1
+            return self.old_patch(*args, **kwargs)
+
+        diffutils.patch = counting_patch
+
+    def tearDown(self):
+        diffutils.patch = self.old_patch
+
+    def testCachedFiles(self):
+        """Testing caching of parent-patched and patched files"""
+        for i in range(2):
+            orig = diffutils.get_original_file(self.filediff)
+            self.assertEqual(orig, 'foo\n')
+            self.assertEqual(diffutils.get_patched_file(orig, self.filediff),
+                             'bar\n')
+
+        self.assertEqual(self.num_patches, 2)
+
+    def testPatchedFileWithoutOriginal(self):
+        """Testing get_patched_file with a cached file and no original"""
+        diffutils.get_patched_file(None, self.filediff)
+        self.assertEqual(self.num_patches, 2)
+
+        self.assertEqual(diffutils.get_patched_file(None, self.filediff),
+                         'bar\n')
+        self.assertEqual(self.num_patches, 2)
+
+
+class ContextChunkTest(TestCase):
+    """Unit tests for building chunks of context directly from files."""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        cache.clear()
+
+        lines = ['line %d\n' % i for i in range(1, 31)]
+        diffset = DiffSet.objects.create(
+            name='test',
+            revision=1,
+            repository=Repository.objects.get(pk=1),
+            diffcompat=2)
+        self.filediff = FileDiff.objects.create(
+            diffset=diffset,
+            source_file='README',
+            dest_file='README',
+            source_revision=PRE_CREATION,
+            dest_detail='',
+            diff='--- README\n+++ README\n@@ -14,3 +14,3 @@\n' +
+                 ' ' + lines[13] + '-' + lines[14] + '+changed\n' +
+                 ' ' + lines[15],
+            parent_diff='--- README\n+++ README\n@@ -0,0 +1,30 @@\n' +
+                        ''.join(['+' + line for line in lines]),
+            status=FileDiff.MODIFIED)
+
+    def testContextChunk(self):
+        """Testing get_context_chunk matches the generated chunks"""
+        chunks = list(diffutils.get_chunks(self.filediff.diffset,
+                                           self.filediff, None, False,
+                                           False))
+        collapsed = [chunk for chunk in chunks if chunk['collapsable']]
+        self.assertTrue(collapsed)
+
+        for chunk in collapsed:
+            lines = chunk['lines']
+            context = diffutils.get_context_chunk(
+                self.filediff, None, False, lines.vlinenum, lines.old_start,
+                lines.new_start, chunk['numlines'], False)
+
+            self.assertEqual(context['change'], 'equal')
+            self.assertEqual(list(context['lines']), list(lines))
+
+    def testReplacedLineMarkup(self):
+        """Testing get_chunks stores the final markup for replaced lines"""
+        chunks = list(diffutils.get_chunks(self.filediff.diffset,
+                                           self.filediff, None, False,
+                                           False))
+        replaced = [chunk for chunk in chunks if chunk['change'] == 'replace']
+        self.assertEqual(len(replaced), 1)
+
+        line = replaced[0]['lines'][0]
+        self.assertEqual(line[2],
+                         diffutils.render_line_markup('line 15', line[3]))
+        self.assertEqual(line[5],
+                         diffutils.render_line_markup('changed', line[6]))
+
+    def testInvalidRange(self):
+        """Testing get_context_chunk with lines outside the file"""
+        self.assertRaises(diffutils.UserVisibleError,
+                          diffutils.get_context_chunk,
+                          self.filediff, None, False, 25, 25, 25, 10, False)
+
+    def testMismatchedRange(self):
+        """Testing get_context_chunk with lines that aren't equal context"""
+        # Line 15 was changed.
+        self.assertRaises(diffutils.UserVisibleError,
+                          diffutils.get_context_chunk,
+                          self.filediff, None, False, 14, 14, 14, 3, False)
+
+    def testMismatchedCachedRange(self):
+        """Testing get_context_chunk with lines not in the cached chunks"""
+        diffutils.get_cached_chunks(self.filediff, None, False, False)
+
+        # The line numbers don't match the virtual line number.
+        self.assertRaises(diffutils.UserVisibleError,
+                          diffutils.get_context_chunk,
+                          self.filediff, None, False, 1, 2, 2, 3, False)
+
+    def testUncachedChunks(self):
+        """Testing get_context_chunk doesn't generate uncached chunks"""
+        def get_stored_chunks(*args, **kwargs):
+            self.fail('The chunks were generated')
+
+        old_get_stored_chunks = diffutils.get_stored_chunks
+        diffutils.get_stored_chunks = get_stored_chunks
+
+        try:
+            context = diffutils.get_context_chunk(
+                self.filediff, None, False, 1, 1, 1, 10, False)
+        finally:
+            diffutils.get_stored_chunks = old_get_stored_chunks
+
+        self.assertEqual(context['numlines'], 10)
+        self.assertEqual(context['lines'][0][1], 1)
+        self.assertEqual(context['lines'][0][4], 1)
+
+
+class LargeFileTest(TestCase):
+    """Unit tests for the diff viewer's handling of large files."""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        self.siteconfig = SiteConfiguration.objects.get_current()
+        self.siteconfig.set('diffviewer_syntax_highlighting', False)
+        cache.clear()
+
+        lines = ['line %d\n' % i for i in range(1, 31)]
+        diffset = DiffSet.objects.create(
+            name='test',
+            revision=1,
+            repository=Repository.objects.get(pk=1),
+            diffcompat=2)
+        self.filediff = FileDiff.objects.create(
+            diffset=diffset,
+            source_file='README',
+            dest_file='README',
+            source_revision=PRE_CREATION,
+            dest_detail='',
+            diff='--- README\n+++ README\n@@ -14,3 +14,3 @@\n' +
+                 ' ' + lines[13] + '-' + lines[14] + '+line 15 changed\n' +
+                 ' ' + lines[15],
+            parent_diff='--- README\n+++ README\n@@ -0,0 +1,30 @@\n' +
+                        ''.join(['+' + line for line in lines]),
+            status=FileDiff.MODIFIED)
+
+    def tearDown(self):
+        self.siteconfig.set('diffviewer_large_file_lines', 20000)
+        self.siteconfig.set('diffviewer_max_file_bytes', 20971520)
+        self.siteconfig.set('diffviewer_max_file_lines', 200000)
+
+    def testFullTier(self):
+        """Testing get_chunks with files under the large file limits"""
+        chunks = self._get_chunks()
+        changed = [chunk for chunk in chunks if chunk['change'] != 'equal']
+
+        self.assertEqual(len(changed), 1)
+        self.assertTrue(changed[0]['lines'][0][3])
+
+        for chunk in chunks:
+            self.assertEqual(chunk['meta']['large_file_tier'],
+                             diffutils.LARGE_FILE_FULL)
+
+    def testReducedTier(self):
+        """Testing get_chunks with files past the large file limits"""
+        self.siteconfig.set('diffviewer_large_file_lines', 10)
+        chunks = self._get_chunks()
+        changed = [chunk for chunk in chunks if chunk['change'] != 'equal']
+
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(changed[0]['lines'][0][3], [])
+        self.assertEqual(changed[0]['lines'][0][6], [])
+
+        for chunk in chunks:
+            self.assertEqual(chunk['meta']['large_file_tier'],
+                             diffutils.LARGE_FILE_REDUCED)
+
+    def testTooLargeTier(self):
+        """Testing get_chunks with files past the maximum file size"""
+        self.siteconfig.set('diffviewer_max_file_bytes', 100)
+        chunks = self._get_chunks()
+
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0]['lines'], [])
+        self.assertEqual(chunks[0]['meta']['large_file_tier'],
+                         diffutils.LARGE_FILE_TOO_LARGE)
+
+        files = diffutils.get_diff_files(self.filediff.diffset,
+                                         enable_syntax_highlighting=False)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0]['too_large'])
+        self.assertFalse(files[0]['whitespace_only'])
+
+    def testLargeDiff(self):
+        """Testing get_chunks with diffs larger than the maximum file size"""
+        filediff = FileDiff.objects.create(
+            diffset=self.filediff.diffset,
+            source_file='NEWS',
+            dest_file='NEWS',
+            source_revision=PRE_CREATION,
+            dest_detail='',
+            diff='--- NEWS\n+++ NEWS\n@@ -0,0 +1,1 @@\n+x\n',
+            status=FileDiff.MODIFIED)
+
+        # The diff is past the limit, but the file isn't.
+        self.siteconfig.set('diffviewer_max_file_bytes', 10)
+        chunks = list(diffutils.get_chunks(filediff.diffset, filediff, None,
+                                           False, False))
+
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0]['change'], 'insert')
+        self.assertEqual(chunks[0]['meta']['large_file_tier'],
+                         diffutils.LARGE_FILE_FULL)
+
+    def testTooLargeLineCounts(self):
+        """Testing get_chunks with line counts past the maximum file size"""
+        self.siteconfig.set('diffviewer_max_file_lines', 10)
+        self.filediff.inserted_lines = 20
+        self._check_not_fetched()
+
+    def _check_not_fetched(self):
+        def get_diff_file_contents(*args, **kwargs):
+            self.fail('The files were fetched')
+
+        old_get_diff_file_contents = diffutils.get_diff_file_contents
+        diffutils.get_diff_file_contents = get_diff_file_contents
+
+        try:
+            chunks = self._get_chunks()
+        finally:
+            diffutils.get_diff_file_contents = old_get_diff_file_contents
+
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0]['meta']['large_file_tier'],
+                         diffutils.LARGE_FILE_TOO_LARGE)
+
+    def _get_chunks(self):
+        return list(diffutils.get_chunks(self.filediff.diffset,
+                                         self.filediff, None, False, False))
+
+
+class DiffHashTest(TestCase):
+    """Unit tests for FileDiff diff hashes."""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        self.repository = Repository.objects.get(pk=1)
+
+    def testContentKey(self):
+        """Testing FileDiff.get_content_key"""
+        filediff1 = self._create_filediff(1, '+foo\n')
+        filediff2 = self._create_filediff(2, '+foo\n')
+        filediff3 = self._create_filediff(3, '+bar\n')
+
+        # Without hashes, the key is just the ID.
+        filediff1.diff_hash = ''
+        self.assertEqual(filediff1.get_content_key(), str(filediff1.pk))
+
+        for filediff in (filediff1, filediff2, filediff3):
+            filediff.update_diff_hashes()
+
+        self.assertTrue(filediff1.has_same_diff(filediff2))
+        self.assertFalse(filediff1.has_same_diff(filediff3))
+        self.assertEqual(filediff1.get_content_key(),
+                         filediff2.get_content_key())
+        self.assertNotEqual(filediff1.get_content_key(),
+                            filediff3.get_content_key())
+        self.assertEqual(
+            diffutils.get_chunks_cache_key(filediff1, None, False, True),
+            diffutils.get_chunks_cache_key(filediff2, None, False, True))
+
+    def testChunksKeysWithSettings(self):
+        """Testing chunk keys change with the histogram diff threshold"""
+        filediff = self._create_filediff(1, '+foo\n')
+        store = DiskChunkStore('', 0)
+        siteconfig = SiteConfiguration.objects.get_current()
+
+        old_cache_key = diffutils.get_chunks_cache_key(filediff, None, False,
+                                                       True)
+        old_store_key = store.make_key(filediff, None, False, True,
+                                       diffutils.get_chunks_version())
+
+        siteconfig.set('diffviewer_histogram_diff_threshold', 1)
+
+        try:
+            self.assertNotEqual(
+                diffutils.get_chunks_cache_key(filediff, None, False, True),
+                old_cache_key)
+            self.assertNotEqual(
+                store.make_key(filediff, None, False, True,
+                               diffutils.get_chunks_version()),
+                old_store_key)
+        finally:
+            siteconfig.set('diffviewer_histogram_diff_threshold', 5000)
+
+    def testChunksKeysWithFormatVersion(self):
+        """Testing chunk keys change with CHUNK_FORMAT_VERSION"""
+        filediff = self._create_filediff(1, '+foo\n')
+        store = DiskChunkStore('', 0)
+
+        old_cache_key = diffutils.get_chunks_cache_key(filediff, None, False,
+                                                       True)
+        old_store_key = store.make_key(filediff, None, False, True,
+                                       diffutils.get_chunks_version())
+
+        old_version = diffutils.CHUNK_FORMAT_VERSION
+        diffutils.CHUNK_FORMAT_VERSION += 1
+
+        try:
+            self.assertNotEqual(
+                diffutils.get_chunks_cache_key(filediff, None, False, True),
+                old_cache_key)
+            self.assertNotEqual(
+                store.make_key(filediff, None, False, True,
+                               diffutils.get_chunks_version()),
+                old_store_key)
+        finally:
+            diffutils.CHUNK_FORMAT_VERSION = old_version
+
+    def _create_filediff(self, revision, content):
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=revision,
+                                         repository=self.repository)
+
+        return FileDiff.objects.create(
+            diffset=diffset,
+            source_file='README',
+            dest_file='README',
+            source_revision=PRE_CREATION,
+            dest_detail='',
+            diff='--- README\n+++ README\n@@ -0,0 +1,1 @@\n%s' % content,
+            status=FileDiff.MODIFIED)
+
+
+class LineCountTest(TestCase):
+    """Unit tests for counting the lines changed by diffs."""
+    fixtures = ['test_scmtools.json']
+
+    def testCountLines(self):
+        """Testing get_diff_line_counts"""
+        counts = diffparser.get_diff_line_counts(
+            '--- README\t(revision 1)\n'
+            '+++ README\t(working copy)\n'
+            '@@ -1,5 +1,5 @@\n'
+            ' foo\n'
+            '-bar\n'
+            '-baz\n'
+            '+BAR\n'
+            ' qux\n'
+            '+new\n'
+            ' end\n'
+            '@@ -10,2 +10,1 @@\n'
+            '--- not a header\n'
+            ' last\n'
+            '\\ No newline at end of file\n')
+
+        self.assertEqual(counts, {
+            'inserted_lines': 1,
+            'deleted_lines': 2,
+            'changed_lines': 1,
+            'hunk_count': 2,
+        })
+
+    def testCountContextDiff(self):
+        """Testing get_diff_line_counts with a context diff"""
+        self.assertEqual(
+            diffparser.get_diff_line_counts(
+                '*** README\n--- README\n***************\n'),
+            None)
+
+    def testDiffSetTotals(self):
+        """Testing DiffSet.update_line_counts"""
+        diffset = DiffSet.objects.create(
+            name='test',
+            revision=1,
+            repository=Repository.objects.get(pk=1))
+
+        for filename in ('a.c', 'b.c'):
+            filediff = FileDiff(
+                diffset=diffset,
+                source_file=filename,
+                dest_file=filename,
+                source_revision=PRE_CREATION,
+                dest_detail='',
+                diff='--- %s\n+++ %s\n@@ -0,0 +1,2 @@\n+foo\n+bar\n'
+                     % (filename, filename),
+                status=FileDiff.MODIFIED)
+            filediff.update_line_counts()
+            filediff.save()
+
+        diffset.update_line_counts()
+        self.assertEqual(diffset.inserted_lines, 4)
+        self.assertEqual(diffset.deleted_lines, 0)
+        self.assertEqual(diffset.hunk_count, 2)
+
+        # Files without counts leave the totals unknown.
+        FileDiff.objects.filter(source_file='b.c').update(inserted_lines=None)
+        diffset.update_line_counts()
+        self.assertEqual(diffset.inserted_lines, None)
+        self.assertEqual(diffset.hunk_count, None)
+
+
+class FileListCacheTest(TestCase):
+    """Unit tests for caching the list of files in a diff."""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        cache.clear()
+
+        self.diffset = DiffSet.objects.create(
+            name='test',
+            revision=1,
+            repository=Repository.objects.get(pk=1))
+
+        for filename in ('b.c', 'a.h', 'a.c'):
+            self._create_filediff(filename)
+
+        self.num_tool_lookups = 0
+        self.old_get_scmtool = Repository.get_scmtool
+
+        def counting_get_scmtool(repository):
+            self.num_tool_lookups += 1
+            return self.old_get_scmtool(repository)
+
+        Repository.get_scmtool = counting_get_scmtool
+
+    def tearDown(self):
+        Repository.get_scmtool = self.old_get_scmtool
+
+    def testCachedFileList(self):
+        """Testing get_diff_file_list caching"""
+        files = diffutils.get_diff_file_list(self.diffset)
+        self.assertEqual([f['depot_filename'] for f in files],
+                         ['a.h', 'a.c', 'b.c'])
+        self.assertTrue('filediff' not in files[0])
+
+        num_tool_lookups = self.num_tool_lookups
+        self.assertEqual(diffutils.get_diff_file_list(self.diffset), files)
+        self.assertEqual(self.num_tool_lookups, num_tool_lookups)
+
+        files = diffutils.get_files_with_filediffs(files[1:])
+        self.assertEqual([f['filediff'].source_file for f in files],
+                         ['a.c', 'b.c'])
+        self.assertEqual(files[0]['interfilediff'], None)
+
+    def testInvalidation(self):
+        """Testing get_diff_file_list invalidation when files change"""
+        self.assertEqual(len(diffutils.get_diff_file_list(self.diffset)), 3)
+
+        filediff = self._create_filediff('c.c')
+        self.assertEqual(len(diffutils.get_diff_file_list(self.diffset)), 4)
+
+        filediff.delete()
+        self.assertEqual(len(diffutils.get_diff_file_list(self.diffset)), 3)
+
+    def _create_filediff(self, filename):
+        return FileDiff.objects.create(
+            diffset=self.diffset,
+            source_file=filename,
+            dest_file=filename,
+            source_revision=PRE_CREATION,
+            dest_detail='',
+            diff='--- %s\n+++ %s\n@@ -0,0 +1,1 @@\n+foo\n'
+                 % (filename, filename),
+            status=FileDiff.MODIFIED)
+
+class DiffBlobTest(TestCase):
+    """Unit tests for storing diffs in DiffBlobs."""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        self.diffset = DiffSet.objects.create(
+            name='test',
+            revision=1,
+            repository=Repository.objects.get(pk=1))
+
+    def testSharedBlobs(self):
+        """Testing FileDiffs sharing DiffBlobs"""
+        diff = '--- README\n+++ README\n@@ -0,0 +1,1 @@\n+foo\n'
+        filediff1 = self._create_filediff(diff)
+        filediff2 = self._create_filediff(diff)
+
+        self.assertEqual(DiffBlob.objects.count(), 1)
+        self.assertEqual(filediff1.diff_blob_id, filediff2.diff_blob_id)
+        self.assertEqual(filediff1.parent_diff_blob, None)
+        self.assertEqual(filediff1.legacy_diff, '')
+
+        filediff = FileDiff.objects.get(pk=filediff2.pk)
+        self.assertEqual(filediff.diff, diff)
+        self.assertEqual(filediff.parent_diff, '')
+        self.assertTrue(filediff.has_same_diff(filediff1))
+
+    def testCompressLegacyDiffs(self):
+        """Testing the compress_diffs management command"""
+        diff = '--- README\n+++ README\n@@ -1,1 +1,1 @@\n-foo\n+bar\n'
+        parent_diff = '--- README\n+++ README\n@@ -0,0 +1,1 @@\n+foo\n'
+        filediff = self._create_filediff(diff, parent_diff)
+
+        # Put the diffs back the way they were stored before DiffBlobs.
+        FileDiff.objects.filter(pk=filediff.pk).update(
+            legacy_diff=base64.encodestring(diff),
+            legacy_parent_diff=base64.encodestring(parent_diff),
+            diff_blob=None,
+            parent_diff_blob=None,
+            diff_hash='',
+            parent_diff_hash='')
+        DiffBlob.objects.all().delete()
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertEqual(filediff.diff, diff)
+        self.assertEqual(filediff.parent_diff, parent_diff)
+
+        CompressDiffsCommand().handle_noargs(batch_size=10)
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertEqual(filediff.legacy_diff, '')
+        self.assertEqual(filediff.legacy_parent_diff, '')
+        self.assertEqual(DiffBlob.objects.count(), 2)
+        self.assertEqual(filediff.diff, diff)
+        self.assertEqual(filediff.parent_diff, parent_diff)
+        self.assertEqual(filediff.diff_blob.hash, filediff.diff_hash)
+
+    def testDeleteUnusedBlobs(self):
+        """Testing deleting DiffBlobs that FileDiffs no longer use"""
+        diff = '--- README\n+++ README\n@@ -1,1 +1,1 @@\n-foo\n+bar\n'
+        parent_diff = '--- README\n+++ README\n@@ -0,0 +1,1 @@\n+foo\n'
+        filediff1 = self._create_filediff(diff, parent_diff)
+        filediff2 = self._create_filediff(diff)
+        self.assertEqual(DiffBlob.objects.count(), 2)
+
+        # The diff's blob is still used by filediff2.
+        filediff1.delete()
+        self.assertEqual(list(DiffBlob.objects.all()),
+                         [filediff2.diff_blob])
+
+        self.diffset.delete()
+        self.assertEqual(DiffBlob.objects.count(), 0)
+
+    def testPruneBlobs(self):
+        """Testing the compress_diffs management command with --prune"""
+        filediff = self._create_filediff('+foo\n')
+        DiffBlob.objects.get_for_data('+bar\n')
+        self.assertEqual(DiffBlob.objects.count(), 2)
+
+        CompressDiffsCommand().handle_noargs(batch_size=10, prune=True)
+
+        self.assertEqual(list(DiffBlob.objects.all()), [filediff.diff_blob])
+
+    def _create_filediff(self, diff, parent_diff=''):
+        return FileDiff.objects.create(
+            diffset=self.diffset,
+            source_file='README',
+            dest_file='README',
+            source_revision=PRE_CREATION,
+            dest_detail='',
+            diff=diff,
+            parent_diff=parent_diff,
+            status=FileDiff.MODIFIED)
+
+
+class PatchResponseTest(unittest.TestCase):
+    """Unit tests for streaming patches."""
+    DIFFS = ['--- README\n+++ README\n@@ -1,1 +1,1 @@\n-foo%s\n+bar%s\n'
+             % (i, i)
+             for i in range(100)]
+
+    def testStreaming(self):
+        """Testing PatchResponse streaming diffs"""
+        response = PatchResponse(HttpRequest(), iter(self.DIFFS), 'x.patch')
+
+        self.assertEqual(response['Content-Type'], 'text/x-patch')
+        self.assertEqual(response['Content-Disposition'],
+                         'inline; filename=x.patch')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(''.join(response), ''.join(self.DIFFS))
+
+    def testContent(self):
+        """Testing PatchResponse.content"""
+        response = PatchResponse(HttpRequest(), iter(self.DIFFS), 'x.patch')
+
+        self.assertEqual(response.content, ''.join(self.DIFFS))
+
+        # The patch must still be sent after reading the content.
+        self.assertEqual(''.join(response), ''.join(self.DIFFS))
+
+    def testMiddleware(self):
+        """Testing PatchResponse with the content middleware"""
+        request = HttpRequest()
+        request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+
+        def fail():
+            self.fail('The patch was read by the middleware')
+            yield ''
+
+        response = PatchResponse(request, fail(), 'x.patch')
+
+        for middleware in (GZipMiddleware(), ConditionalGetMiddleware()):
+            self.assertTrue(
+                middleware.process_response(request, response) is response)
+
+        self.assertFalse(response.has_header('Content-Length'))
+
+    def testNotModified(self):
+        """Testing PatchResponse with If-Modified-Since"""
+        request = HttpRequest()
+        request.META['HTTP_IF_MODIFIED_SINCE'] = \
+            'Sun, 24 Jun 2007 00:21:45 GMT'
+
+        def fail():
+            self.fail('The patch was read by the middleware')
+            yield ''
+
+        response = PatchResponse(request, fail(), 'x.patch')
+        response['Last-Modified'] = 'Sun, 24 Jun 2007 00:21:45 GMT'
+
+        ConditionalGetMiddleware().process_response(request, response)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.has_header('Content-Length'))
+
+    def testGzip(self):
+        """Testing PatchResponse with gzip encoding"""
+        request = HttpRequest()
+        request.META['HTTP_ACCEPT_ENCODING'] = 'gzip, deflate'
+        response = PatchResponse(request, iter(self.DIFFS), 'x.patch')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        data = zlib.decompress(''.join(response), 16 + zlib.MAX_WBITS)
+        self.assertEqual(data, ''.join(self.DIFFS))
@@ -14,13 +14,42 @@ from djblets.util.misc import cache_memoize, get_object_or_none
 
 from reviewboard.diffviewer.models import DiffSet, FileDiff
 from reviewboard.diffviewer.diffutils import UserVisibleError, \
+                                             get_chunks_in_range, \
+                                             get_context_chunk, \
+                                             get_diff_file_list, \
                                              get_diff_files, \
-                                             get_enable_highlighting
+                                             get_enable_highlighting, \
+                                             get_files_with_filediffs
 
 
 def build_diff_fragment(request, file, chunkindex, highlighting, collapseall,
                         context,
                         template_name='diffviewer/diff_file_fragment.html'):
+    if chunkindex:
+        chunkindex = int(chunkindex)
+        if chunkindex < 0 or chunkindex >= len(file['chunks']):
+            raise UserVisibleError(_(u"Invalid chunk index %s specified.") % \
+                                   chunkindex)
+
+        file['chunks'] = [file['chunks'][chunkindex]]
+
+    if collapseall:
+        context['collapseall'] = True
+
+    context['file'] = file
+
+    return cache_memoize(
+        get_diff_fragment_cache_key(file, chunkindex, highlighting,
+                                    collapseall, template_name),
+        lambda: render_to_string(template_name,
+                                 RequestContext(request, context)))
+
+
+def get_diff_fragment_cache_key(file, chunkindex, highlighting, collapseall,
+                                template_name):
+    """
+    Returns the memcached key for a diff fragment from build_diff_fragment.
+    """
     key = "%s-%s-%s-" % (template_name, file['index'],
                          file['filediff'].diffset.revision)
 
@@ -33,29 +62,18 @@ def build_diff_fragment(request, file, chunkindex, highlighting, collapseall,
     else:
         key += str(file['filediff'].id)
 
-    if chunkindex:
-        chunkindex = int(chunkindex)
-        if chunkindex < 0 or chunkindex >= len(file['chunks']):
-            raise UserVisibleError(_(u"Invalid chunk index %s specified.") % \
-                                   chunkindex)
-
-        file['chunks'] = [file['chunks'][chunkindex]]
+    if chunkindex is not None:
         key += '-chunk-%s' % chunkindex
 
     if collapseall:
         key += '-collapsed'
-        context['collapseall'] = True
 
     if highlighting:
         key += '-highlighting'
 
     key += '-%s' % settings.AJAX_SERIAL
 
-    context['file'] = file
-
-    return cache_memoize(key,
-        lambda: render_to_string(template_name,
-                                 RequestContext(request, context)))
+    return key
 
 
 def get_collapse_diff(request):
@@ -82,8 +100,7 @@ def view_diff(request, diffset, interdiffset=None, extra_context={},
             logging.debug("Generating diff viewer page for filediff id %s",
                           diffset.id)
 
-        files = get_diff_files(diffset, None, interdiffset,
-                               highlighting, False)
+        files = get_diff_file_list(diffset, interdiffset)
 
         # Break the list of files into pages
         siteconfig = SiteConfiguration.objects.get_current()
@@ -98,13 +115,14 @@ def view_diff(request, diffset, interdiffset=None, extra_context={},
             file_id = int(request.GET['file'])
 
             for i, f in enumerate(files):
-                if f['filediff'].id == file_id:
+                if f['filediff_id'] == file_id:
                     page_num = i // paginator.per_page + 1
                     if page_num > paginator.num_pages:
                         page_num = paginator.num_pages
                     break
 
         page = paginator.page(page_num)
+        page_files = get_files_with_filediffs(page.object_list)
 
         collapse_diffs = get_collapse_diff(request)
 
@@ -112,7 +130,7 @@ def view_diff(request, diffset, interdiffset=None, extra_context={},
             'diffset': diffset,
             'interdiffset': interdiffset,
             'diffset_pair': (diffset, interdiffset),
-            'files': page.object_list,
+            'files': page_files,
             'collapseall': collapse_diffs,
 
             # Add the pagination context
@@ -135,8 +153,8 @@ def view_diff(request, diffset, interdiffset=None, extra_context={},
         # diff immediately and instead saw a spinner, making them feel it was
         # taking longer than it used to to load a page. We just trick the
         # user by providing that first file.
-        if page.object_list:
-            first_file = page.object_list[0]
+        if page_files:
+            first_file = page_files[0]
         else:
             first_file = None
 
@@ -235,6 +253,87 @@ def view_diff_fragment(
             extra_context={'file': get_requested_diff_file(False)})
 
 
+def view_diff_lines(
+    request,
+    diffset_id,
+    filediff_id,
+    base_url,
+    first_line,
+    last_line,
+    interdiffset_id=None,
+    template_name='diffviewer/diff_file_fragment.html',
+    error_template_name='diffviewer/diff_fragment_error.html'):
+    """
+    View which renders a range of lines from a diff.
+
+    This is used to expand the context around a part of the diff, without
+    rendering the rest of the chunk the lines are in. first_line and
+    last_line are virtual line numbers, and both are included.
+
+    If the lines are unchanged context, the old_line and new_line query
+    arguments can give the line numbers of first_line in the old and new
+    files. The lines are then built straight from those files, without
+    generating the rest of the diff. chunk_index gives the index of the
+    chunk being expanded.
+    """
+    diffset = get_object_or_404(DiffSet, pk=diffset_id)
+    filediff = get_object_or_404(FileDiff, pk=filediff_id, diffset=diffset)
+    interdiffset = get_object_or_none(DiffSet, pk=interdiffset_id)
+    highlighting = get_enable_highlighting(request.user)
+    first_line = int(first_line)
+    last_line = int(last_line)
+    file = None
+
+    try:
+        if first_line < 1 or last_line < first_line:
+            raise UserVisibleError(_(u"Invalid line range %s-%s specified.") %
+                                   (first_line, last_line))
+
+        old_line = request.GET.get('old_line')
+        new_line = request.GET.get('new_line')
+        is_context = bool(old_line and new_line)
+
+        files = get_diff_files(diffset, filediff, interdiffset, highlighting,
+                               load_chunks=not is_context)
+
+        if not files:
+            raise UserVisibleError(
+                _(u"Internal error. Unable to locate file record for "
+                  u"filediff %s") % filediff.id)
+
+        assert len(files) == 1
+        file = files[0]
+
+        if 'index' in request.GET:
+            file['index'] = request.GET.get('index')
+
+        if is_context:
+            chunk = get_context_chunk(file['filediff'],
+                                      file['interfilediff'],
+                                      file['force_interdiff'],
+                                      first_line, int(old_line),
+                                      int(new_line),
+                                      last_line - first_line + 1,
+                                      highlighting)
+            chunk['index'] = request.GET.get('chunk_index', 0)
+            file['chunks'] = [chunk]
+        else:
+            file['chunks'] = list(get_chunks_in_range(
+                file, first_line, last_line - first_line + 1))
+
+        context = {
+            'standalone': True,
+            'base_url': base_url,
+            'file': file,
+        }
+
+        return render_to_response(template_name,
+                                  RequestContext(request, context))
+    except Exception, e:
+        return exception_traceback(request, e, error_template_name,
+                                   extra_context={'file': file})
+
+
 def exception_traceback_string(request, e, template_name, extra_context={}):
     context = { 'error': e }
     context.update(extra_context)
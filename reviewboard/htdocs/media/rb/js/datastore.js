@@ -343,6 +343,29 @@ $.extend(RB.Diff.prototype, {
         });
     },
 
+    getDiffLines: function(review_base_url, filediff_id, revision,
+                           interdiff_revision, first_line, last_line,
+                           options, onSuccess) {
+        var revisionStr = revision;
+
+        if (interdiff_revision != null) {
+            revisionStr += "-" + interdiff_revision;
+        }
+
+        rbApiCall({
+            url: review_base_url + 'diff/' + revisionStr + '/fragment/' +
+                 filediff_id + '/lines/' + first_line + '-' + last_line + '/',
+            data: options || {},
+            type: "GET",
+            dataType: "html",
+            complete: function(res, status) {
+                if (status == "success") {
+                    onSuccess(res.responseText);
+                }
+            }
+        });
+    },
+
     getDiffFile: function(review_base_url, filediff_id, filediff_revision,
                           interfilediff_id, interfilediff_revision,
                           file_index, onSuccess) {
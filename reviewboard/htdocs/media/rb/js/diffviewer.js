@@ -1063,11 +1063,18 @@ function addCommentFlags(table, lines, key) {
  * @param {string} interdiff_revision  The interdiff revision of the file.
  * @param {int}    chunk_index         The chunk index number.
  * @param {string} tbody_id            The tbody ID to insert into.
+ * @param {int}    first_line          The first virtual line in the chunk.
+ * @param {int}    old_line            The first line in the original file.
+ * @param {int}    new_line            The first line in the patched file.
+ * @param {int}    num_lines           The number of lines in the chunk.
+ *
+ * If the line numbers are given, only those lines are loaded, without
+ * loading the rest of the diff.
  */
 function expandChunk(review_base_url, fileid, filediff_id, revision,
-                     interdiff_revision, chunk_index, link) {
-    gDiff.getDiffFragment(review_base_url, fileid, filediff_id, revision,
-                          interdiff_revision, chunk_index, function(html) {
+                     interdiff_revision, chunk_index, link, first_line,
+                     old_line, new_line, num_lines) {
+    function onLoaded(html) {
         var tbody = $(link).parents("tbody.diff-header");
         var table = tbody.parent();
         var key = "file" + filediff_id;
@@ -1077,7 +1084,20 @@ function expandChunk(review_base_url, fileid, filediff_id, revision,
 
         /* The selection rectangle may not update -- bug #1353. */
         $(gAnchors[gSelectedAnchor]).highlightChunk();
-    });
+    }
+
+    if (first_line && old_line && new_line && num_lines) {
+        gDiff.getDiffLines(review_base_url, filediff_id, revision,
+                           interdiff_revision, first_line,
+                           first_line + num_lines - 1, {
+                               old_line: old_line,
+                               new_line: new_line,
+                               chunk_index: chunk_index
+                           }, onLoaded);
+    } else {
+        gDiff.getDiffFragment(review_base_url, fileid, filediff_id, revision,
+                              interdiff_revision, chunk_index, onLoaded);
+    }
 }
 
 
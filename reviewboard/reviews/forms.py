@@ -301,6 +301,15 @@ class UploadDiffForm(diffviewer_forms.UploadDiffForm):
 
         return diffset
 
+    def _get_previous_diffset(self, diffset):
+        # Drafts aren't attached to the history yet, but they're still
+        # compared against its latest diffset.
+        try:
+            return self.review_request.diffset_history.diffsets.exclude(
+                pk=diffset.pk).latest()
+        except DiffSet.DoesNotExist:
+            return None
+
 
 class UploadScreenshotForm(forms.Form):
     """
@@ -0,0 +1,315 @@
+import itertools
+import logging
+import optparse
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Lock, Manager, Pool
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.http import HttpRequest
+from django.template import RequestContext
+from django.template.loader import render_to_string
+from djblets.util.misc import cache_memoize
+
+from reviewboard.diffviewer.diffutils import build_diff_file_list, \
+                                             get_chunks_cache_key, \
+                                             get_diff_file_list_cache_key, \
+                                             get_diff_files, \
+                                             get_enable_highlighting, \
+                                             get_files_with_filediffs, \
+                                             get_stored_chunks, \
+                                             load_file_chunks
+from reviewboard.diffviewer.views import get_diff_fragment_cache_key
+from reviewboard.reviews.models import ReviewRequest
+
+
+CACHE_NAMES = ('file lists', 'chunks', 'fragments')
+
+FRAGMENT_TEMPLATE = 'diffviewer/diff_file_fragment.html'
+
+
+class DiffCacheWarmer(object):
+    """
+    Fills the caches the diff viewer uses for a review request's diffs.
+
+    This fills the same caches, with the same keys, as viewing the latest
+    diff and the interdiff between the last two diffs would: the lists of
+    files, the chunks for each file and the rendered fragment for each
+    file, collapsed and with the site's default syntax highlighting.
+
+    Files that have to be generated are spaced out so that no more than
+    files_per_minute are generated for a repository. The lock and
+    next_times dictionary are shared by all the workers, so that the limit
+    applies to all of them together.
+    """
+    def __init__(self, files_per_minute=0, lock=None, next_times=None):
+        if files_per_minute > 0:
+            self.interval = 60.0 / files_per_minute
+        else:
+            self.interval = 0
+
+        self.lock = lock or Lock()
+
+        if next_times is None:
+            next_times = {}
+
+        self.next_times = next_times
+
+    def warm_review_request(self, review_request_id):
+        """
+        Fills the caches for the latest diff and interdiff of a review
+        request.
+
+        Returns a tuple of the number of cache hits and misses for each
+        cache, by name, and the number of errors, or None if the review
+        request no longer exists.
+        """
+        self.stats = dict([(name, (0, 0)) for name in CACHE_NAMES])
+        self.errors = 0
+
+        try:
+            review_request = ReviewRequest.objects.get(pk=review_request_id)
+        except ReviewRequest.DoesNotExist:
+            return None
+
+        diffsets = list(review_request.diffset_history.diffsets
+                        .order_by('-revision')[:2])
+
+        if diffsets:
+            self.warm_diff(review_request, diffsets[0], None)
+
+        if len(diffsets) == 2:
+            # Interdiffs are shown from the older diffset's point of view.
+            self.warm_diff(review_request, diffsets[1], diffsets[0])
+
+        return self.stats, self.errors
+
+    def warm_diff(self, review_request, diffset, interdiffset):
+        request = HttpRequest()
+        request.user = AnonymousUser()
+
+        if review_request.local_site:
+            request._local_site_name = review_request.local_site.name
+
+        highlighting = get_enable_highlighting(request.user)
+        base_url = review_request.get_absolute_url()
+
+        try:
+            files = self.memoize(
+                'file lists',
+                get_diff_file_list_cache_key(diffset, interdiffset),
+                lambda: build_diff_file_list(diffset, interdiffset))
+        except Exception, e:
+            logging.error("Unable to list the files in diffset %s: %s"
+                          % (diffset.pk, e), exc_info=1)
+            self.errors += 1
+            return
+
+        for file in get_files_with_filediffs(files):
+            try:
+                self.warm_file(request, base_url, diffset, interdiffset,
+                               file, highlighting)
+            except Exception, e:
+                logging.error("Unable to warm the caches for filediff %s: %s"
+                              % (file['filediff'].pk, e), exc_info=1)
+                self.errors += 1
+
+    def warm_file(self, request, base_url, diffset, interdiffset, file,
+                  highlighting):
+        # The diff viewer loads each file's fragment separately, and the
+        # file it builds for that can differ from the one in the list, so
+        # this builds it the same way view_diff_fragment does.
+        files = get_diff_files(diffset, file['filediff'], interdiffset,
+                               highlighting, load_chunks=False)
+
+        if not files:
+            return
+
+        assert len(files) == 1
+        diff_file = files[0]
+
+        if not diff_file['binary'] and not diff_file['deleted']:
+            self.memoize(
+                'chunks',
+                get_chunks_cache_key(diff_file['filediff'],
+                                     diff_file['interfilediff'],
+                                     diff_file['force_interdiff'],
+                                     highlighting),
+                lambda: self.generate_chunks(diff_file, highlighting),
+                large_data=True)
+
+        # This reads the chunks back from the cache, and fills in the rest
+        # of what the fragment needs.
+        load_file_chunks([diff_file], highlighting)
+        diff_file['index'] = file['index']
+
+        context = {
+            'standalone': False,
+            'base_url': base_url,
+            'collapseall': True,
+            'file': diff_file,
+        }
+
+        self.memoize(
+            'fragments',
+            get_diff_fragment_cache_key(diff_file, None, highlighting, True,
+                                        FRAGMENT_TEMPLATE),
+            lambda: render_to_string(FRAGMENT_TEMPLATE,
+                                     RequestContext(request, context)))
+
+    def generate_chunks(self, file, highlighting):
+        self.wait_for_repository(file['filediff'].diffset.repository_id)
+
+        return get_stored_chunks(file['filediff'], file['interfilediff'],
+                                 file['force_interdiff'], highlighting)
+
+    def wait_for_repository(self, repository_id):
+        """
+        Waits until the rate limit allows generating another file from the
+        repository.
+        """
+        if not self.interval:
+            return
+
+        self.lock.acquire()
+
+        try:
+            now = time.time()
+            start = max(now, self.next_times.get(repository_id, 0))
+            self.next_times[repository_id] = start + self.interval
+        finally:
+            self.lock.release()
+
+        if start > now:
+            time.sleep(start - now)
+
+    def memoize(self, name, key, lookup_callable, **kwargs):
+        """
+        Returns a value from the cache, counting whether it was a hit or a
+        miss.
+        """
+        missed = []
+
+        def lookup():
+            missed.append(True)
+            return lookup_callable()
+
+        result = cache_memoize(key, lookup, **kwargs)
+
+        hits, misses = self.stats[name]
+
+        if missed:
+            self.stats[name] = (hits, misses + 1)
+        else:
+            self.stats[name] = (hits + 1, misses)
+
+        return result
+
+
+_warmer = None
+
+
+def _init_worker(files_per_minute, lock, next_times):
+    global _warmer
+    _warmer = DiffCacheWarmer(files_per_minute, lock, next_times)
+
+
+def _warm_review_request(review_request_id):
+    return review_request_id, _warmer.warm_review_request(review_request_id)
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--concurrency', type='int', dest='concurrency',
+                             default=1,
+                             help='The number of review requests to warm '
+                                  'at the same time'),
+        optparse.make_option('--days', type='float', dest='days',
+                             default=7,
+                             help='Only warm review requests updated in '
+                                  'this many days'),
+        optparse.make_option('--rate-limit', type='float',
+                             dest='files_per_minute', default=0,
+                             metavar='FILES_PER_MINUTE',
+                             help='The most files to generate per minute '
+                                  'for each repository (0 for no limit)'),
+        )
+    help = "Fills the diff viewer's caches for pending review requests"
+    requires_model_validation = True
+
+    def handle_noargs(self, **options):
+        concurrency = options['concurrency']
+        files_per_minute = options['files_per_minute']
+        cutoff = datetime.now() - timedelta(days=options['days'])
+
+        review_request_ids = list(
+            ReviewRequest.objects.filter(
+                status=ReviewRequest.PENDING_REVIEW,
+                public=True,
+                last_updated__gte=cutoff)
+            .order_by('-last_updated')
+            .values_list('pk', flat=True))
+        total = len(review_request_ids)
+
+        pool = None
+        lock = Lock()
+
+        if concurrency > 1:
+            # Each worker needs its own database and cache connections, so
+            # close ours before forking.
+            connection.close()
+
+            if hasattr(cache, 'close'):
+                cache.close()
+
+            manager = Manager()
+            next_times = manager.dict()
+            pool = Pool(concurrency, _init_worker,
+                        (files_per_minute, lock, next_times))
+            results = pool.imap_unordered(_warm_review_request,
+                                          review_request_ids)
+        else:
+            _init_worker(files_per_minute, lock, {})
+            results = itertools.imap(_warm_review_request,
+                                     review_request_ids)
+
+        totals = dict([(name, [0, 0]) for name in CACHE_NAMES])
+        total_errors = 0
+
+        for i, (review_request_id, result) in enumerate(results):
+            if result is None:
+                print 'Skipped review request %s (%d of %d): deleted' % \
+                      (review_request_id, i + 1, total)
+                continue
+
+            stats, errors = result
+            hits = misses = 0
+
+            for name, (name_hits, name_misses) in stats.iteritems():
+                totals[name][0] += name_hits
+                totals[name][1] += name_misses
+                hits += name_hits
+                misses += name_misses
+
+            total_errors += errors
+
+            print 'Warmed review request %s (%d of %d): %d hits, ' \
+                  '%d misses, %d errors' % (review_request_id, i + 1, total,
+                                            hits, misses, errors)
+
+        if pool:
+            pool.close()
+            pool.join()
+
+        print
+        print 'Review requests: %d' % total
+
+        for name in CACHE_NAMES:
+            print '%-16s %d hits, %d misses' % (name.capitalize() + ':',
+                                                totals[name][0],
+                                                totals[name][1])
+
+        print 'Errors:          %d' % total_errors
@@ -2,6 +2,7 @@ import logging
 import os
 
 from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.template import Context, Template
 from django.test import TestCase
@@ -9,14 +10,22 @@ from django.test import TestCase
 from djblets.siteconfig.models import SiteConfiguration
 
 from reviewboard.accounts.models import Profile, LocalSiteProfile
+from reviewboard.diffviewer.models import DiffSet, FileDiff
+from reviewboard.reviews.management.commands.warm_diff_caches import \
+     DiffCacheWarmer
 from reviewboard.reviews.forms import DefaultReviewerForm, GroupForm
-from reviewboard.reviews.models import DefaultReviewer, \
+from reviewboard.reviews.models import Comment, \
+                                       DefaultReviewer, \
                                        Group, \
                                        ReviewRequest, \
                                        ReviewRequestDraft, \
                                        Review
+from reviewboard.scmtools.core import PRE_CREATION
 from reviewboard.scmtools.models import Repository, Tool
 from reviewboard.site.models import LocalSite
+import reviewboard.diffviewer.diffutils as diffutils
+import reviewboard.diffviewer.views as diffviewer_views
+import reviewboard.reviews.views as reviews_views
 
 
 class DbQueryTests(TestCase):
@@ -527,6 +536,64 @@ class ViewTests(TestCase):
         self.assert_('fragment' in files[0])
         self.assert_('interfilediff' in files[0])
 
+    def testCommentDiffFragments(self):
+        """Testing build_diff_comment_fragments"""
+        comments = Comment.objects.filter(pk__in=[1, 3]).order_by('pk')
+        context = {'user': AnonymousUser()}
+
+        had_error, entries = \
+            reviews_views.build_diff_comment_fragments(comments, context)
+        self.assertFalse(had_error)
+        self.assertEqual([entry['comment'].pk for entry in entries], [1, 3])
+
+        # The fragments are cached now, so the diffs shouldn't be touched.
+        def get_diff_file(*args, **kwargs):
+            raise Exception("get_diff_file shouldn't be called")
+
+        old_get_diff_file = reviews_views.get_diff_file
+        reviews_views.get_diff_file = get_diff_file
+
+        try:
+            had_error, cached_entries = \
+                reviews_views.build_diff_comment_fragments(comments, context)
+        finally:
+            reviews_views.get_diff_file = old_get_diff_file
+
+        self.assertFalse(had_error)
+        self.assertEqual([entry['html'] for entry in cached_entries],
+                         [entry['html'] for entry in entries])
+
+    def testCommentDiffFragmentsEditedRange(self):
+        """Testing build_diff_comment_fragments with an edited line range"""
+        comment = Comment.objects.get(pk=1)
+        context = {'user': AnonymousUser()}
+
+        had_error, entries = \
+            reviews_views.build_diff_comment_fragments([comment], context)
+        self.assertFalse(had_error)
+
+        # Editing the range of a comment doesn't change its timestamp.
+        comment.first_line += 20
+        comment.num_lines = 2
+        comment.save()
+
+        had_error, edited_entries = \
+            reviews_views.build_diff_comment_fragments([comment], context)
+        self.assertFalse(had_error)
+        self.assertNotEqual(edited_entries[0]['html'], entries[0]['html'])
+
+    def testRawDiffNotModified(self):
+        """Testing raw_diff with If-Modified-Since"""
+        response = self.client.get('/r/8/diff/raw/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content)
+
+        response = self.client.get(
+            '/r/8/diff/raw/',
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
     def testDashboard5(self):
         """Testing dashboard view (mine)"""
         self.client.login(username='doc', password='doc')
@@ -1354,3 +1421,100 @@ class PolicyTests(TestCase):
         review_request.target_people.clear()
         review_request.target_groups.clear()
         return review_request
+
+
+class WarmDiffCachesTests(TestCase):
+    """Testing the warm_diff_caches management command"""
+    fixtures = ['test_users', 'test_scmtools']
+
+    def setUp(self):
+        cache.clear()
+
+        repository = Repository.objects.get(pk=1)
+        self.review_request = ReviewRequest.objects.create(
+            User.objects.get(username='doc'), repository)
+        self.review_request.public = True
+        self.review_request.save()
+
+        self.diffsets = []
+
+        # OTHER is changed in the first diff, and reverted in the second.
+        for revision, files in ((1, (('README', 'foo'), ('OTHER', 'foo'))),
+                                (2, (('README', 'bar'),))):
+            diffset = DiffSet.objects.create(
+                name='test',
+                revision=revision,
+                repository=repository,
+                history=self.review_request.diffset_history,
+                diffcompat=2)
+            self.diffsets.append(diffset)
+
+            for filename, content in files:
+                FileDiff.objects.create(
+                    diffset=diffset,
+                    source_file=filename,
+                    dest_file=filename,
+                    source_revision=PRE_CREATION,
+                    dest_detail='',
+                    diff='--- %s\n+++ %s\n@@ -0,0 +1,1 @@\n+%s\n'
+                         % (filename, filename, content),
+                    status=FileDiff.MODIFIED)
+
+    def test_warm_review_request(self):
+        """Testing DiffCacheWarmer with the latest diff and interdiff"""
+        warmer = DiffCacheWarmer()
+
+        stats, errors = warmer.warm_review_request(self.review_request.pk)
+        self.assertEqual(errors, 0)
+        self.assertEqual(stats, {
+            'file lists': (0, 2),
+            'chunks': (0, 3),
+            'fragments': (0, 3),
+        })
+
+        stats, errors = warmer.warm_review_request(self.review_request.pk)
+        self.assertEqual(errors, 0)
+        self.assertEqual(stats, {
+            'file lists': (2, 0),
+            'chunks': (3, 0),
+            'fragments': (3, 0),
+        })
+
+    def test_fragments_use_warmed_caches(self):
+        """Testing diff_fragment with caches from DiffCacheWarmer"""
+        DiffCacheWarmer().warm_review_request(self.review_request.pk)
+
+        def fail(*args, **kwargs):
+            self.fail('The fragment was not in the cache')
+
+        old_get_stored_chunks = diffutils.get_stored_chunks
+        old_render_to_string = diffviewer_views.render_to_string
+        diffutils.get_stored_chunks = fail
+        diffviewer_views.render_to_string = fail
+
+        try:
+            diff_url = self.review_request.get_absolute_url() + 'diff/'
+            self._check_fragments(diff_url + '2/', self.diffsets[1], None, 1)
+            self._check_fragments(diff_url + '1-2/', self.diffsets[0],
+                                  self.diffsets[1], 2)
+        finally:
+            diffutils.get_stored_chunks = old_get_stored_chunks
+            diffviewer_views.render_to_string = old_render_to_string
+
+    def _check_fragments(self, url, diffset, interdiffset, num_files):
+        files = diffutils.build_diff_file_list(diffset, interdiffset)
+        self.assertEqual(len(files), num_files)
+
+        for file in files:
+            response = self.client.get(
+                '%sfragment/%s/?index=%s' % (url, file['filediff_id'],
+                                             file['index']))
+            self.assertEqual(response.status_code, 200)
+
+    def test_deleted_review_request(self):
+        """Testing DiffCacheWarmer with a deleted review request"""
+        review_request_id = self.review_request.pk
+        self.review_request.delete()
+
+        self.assertEqual(
+            DiffCacheWarmer().warm_review_request(review_request_id), None)
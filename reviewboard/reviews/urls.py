@@ -29,6 +29,8 @@ urlpatterns = patterns('reviewboard.reviews.views',
      'diff_fragment'),
     (r'^(?P<review_request_id>[0-9]+)/diff/(?P<revision>[0-9]+)/fragment/(?P<filediff_id>[0-9]+)/chunk/(?P<chunkindex>[0-9]+)/$',
      'diff_fragment'),
+    (r'^(?P<review_request_id>[0-9]+)/diff/(?P<revision>[0-9]+)/fragment/(?P<filediff_id>[0-9]+)/lines/(?P<first_line>[0-9]+)-(?P<last_line>[0-9]+)/$',
+     'diff_lines'),
 
     # Fragments
     (r'^(?P<review_request_id>[0-9]+)/fragments/diff-comments/(?P<comment_ids>[0-9,]+)/$',
@@ -41,6 +43,8 @@ urlpatterns = patterns('reviewboard.reviews.views',
      'diff_fragment'),
     (r'^(?P<review_request_id>[0-9]+)/diff/(?P<revision>[0-9]+)-(?P<interdiff_revision>[0-9]+)/fragment/(?P<filediff_id>[0-9]+)/chunk/(?P<chunkindex>[0-9]+)/$',
      'diff_fragment'),
+    (r'^(?P<review_request_id>[0-9]+)/diff/(?P<revision>[0-9]+)-(?P<interdiff_revision>[0-9]+)/fragment/(?P<filediff_id>[0-9]+)/lines/(?P<first_line>[0-9]+)-(?P<last_line>[0-9]+)/$',
+     'diff_lines'),
 
     # Screenshots
     url(r'^(?P<review_request_id>[0-9]+)/s/(?P<screenshot_id>[0-9]+)/$',
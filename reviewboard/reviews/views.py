@@ -4,6 +4,7 @@ from datetime import datetime
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
 from django.db.models import Q
@@ -11,8 +12,8 @@ from django.http import HttpResponse, HttpResponseRedirect, Http404, \
                         HttpResponseNotModified, HttpResponseServerError
 from django.shortcuts import get_object_or_404, get_list_or_404, \
                              render_to_response
-from django.template.context import RequestContext
-from django.template.loader import render_to_string
+from django.template.context import Context, RequestContext
+from django.template.loader import get_template, render_to_string
 from django.utils import simplejson
 from django.utils.http import http_date
 from django.utils.safestring import mark_safe
@@ -31,9 +32,15 @@ from reviewboard.accounts.decorators import check_login_required, \
                                             valid_prefs_required
 from reviewboard.accounts.models import ReviewRequestVisit
 from reviewboard.changedescs.models import ChangeDescription
-from reviewboard.diffviewer.diffutils import get_file_chunks_in_range
+from reviewboard.diffviewer.diffutils import get_chunks_cache_key, \
+                                             get_chunks_in_range, \
+                                             get_diff_file, \
+                                             get_enable_highlighting, \
+                                             load_file_chunks
 from reviewboard.diffviewer.models import DiffSet
+from reviewboard.diffviewer.responses import PatchResponse
 from reviewboard.diffviewer.views import view_diff, view_diff_fragment, \
+                                         view_diff_lines, \
                                          exception_traceback_string
 from reviewboard.reviews.datagrids import DashboardDataGrid, \
                                           GroupDataGrid, \
@@ -153,27 +160,118 @@ def _query_for_diff(review_request, user, revision, query_extra=None):
         raise Http404
 
 
+def _get_comment_fragment_cache_key(comment, template_name,
+                                    enable_syntax_highlighting):
+    """
+    Returns the cache key for the rendered diff fragment of a comment.
+
+    The key includes the key of the chunks the fragment is rendered from,
+    so that fragments aren't shared between highlighted and unhighlighted
+    diffs, and the comment's timestamp and line range, so that edits to
+    draft comments are picked up. The timestamp isn't changed when the
+    range of a draft comment is edited.
+    """
+    return "comment-fragment-%s-%s-%s-%s-%s-%s-%s" % (
+        comment.pk,
+        comment.timestamp.strftime("%Y%m%d%H%M%S%f"),
+        comment.first_line,
+        comment.num_lines,
+        template_name,
+        get_chunks_cache_key(comment.filediff, comment.interfilediff,
+                             comment.interfilediff is not None,
+                             enable_syntax_highlighting),
+        settings.AJAX_SERIAL)
+
+
 def build_diff_comment_fragments(
     comments, context,
     comment_template_name='reviews/diff_comment_fragment.html',
     error_template_name='diffviewer/diff_fragment_error.html'):
+    """
+    Renders the parts of the diffs that a list of comments were made on.
+
+    The rendered fragments are cached for each comment. The chunks for the
+    comments that aren't cached are loaded once for each file (or interdiff
+    file), and the files are loaded in parallel if the repository allows
+    it.
 
+    Returns a tuple of whether rendering any of the fragments failed, and
+    a list of dictionaries containing each comment and its HTML.
+    """
+    comments = list(comments)
     comment_entries = []
     had_error = False
     siteconfig = SiteConfiguration.objects.get_current()
+    domain = Site.objects.get_current().domain
+    domain_method = siteconfig.get("site_domain_method")
+
+    assert 'user' in context
+    highlighting = get_enable_highlighting(context['user'])
+    template = get_template(comment_template_name)
+
+    cache_keys = {}
+
+    for comment in comments:
+        cache_keys[comment.pk] = _get_comment_fragment_cache_key(
+            comment, comment_template_name, highlighting)
+
+    cached_html = cache.get_many(cache_keys.values())
+
+    # Load the chunks for all the files with uncached fragments at once.
+    diff_files = {}
+
+    try:
+        for comment in comments:
+            file_key = (comment.filediff_id, comment.interfilediff_id)
+
+            if (cache_keys[comment.pk] not in cached_html and
+                file_key not in diff_files):
+                diff_files[file_key] = get_diff_file(comment.filediff,
+                                                     comment.interfilediff,
+                                                     highlighting,
+                                                     load_chunks=False)
+
+        files = [file for file in diff_files.itervalues() if file]
+
+        if files:
+            repository = files[0]['filediff'].diffset.repository
+            load_file_chunks(files, highlighting,
+                             repository.diff_generation_concurrency)
+    except Exception, e:
+        # The files will be loaded one at a time below instead, so that
+        # only the comments on the files that failed show an error.
+        logging.warning("Unable to load diff chunks for comments: %s", e)
+        diff_files = {}
 
     for comment in comments:
+        cache_key = cache_keys[comment.pk]
+        file_key = (comment.filediff_id, comment.interfilediff_id)
+
         try:
-            content = render_to_string(comment_template_name, {
-                'comment': comment,
-                'chunks': list(get_file_chunks_in_range(context,
-                                                        comment.filediff,
-                                                        comment.interfilediff,
-                                                        comment.first_line,
-                                                        comment.num_lines)),
-                'domain': Site.objects.get_current().domain,
-                'domain_method': siteconfig.get("site_domain_method"),
-            })
+            if cache_key in cached_html:
+                content = cached_html[cache_key]
+            else:
+                if file_key not in diff_files:
+                    diff_files[file_key] = get_diff_file(comment.filediff,
+                                                         comment.interfilediff,
+                                                         highlighting)
+
+                file = diff_files[file_key]
+
+                if file:
+                    chunks = list(get_chunks_in_range(file,
+                                                      comment.first_line,
+                                                      comment.num_lines))
+                else:
+                    chunks = []
+
+                content = template.render(Context({
+                    'comment': comment,
+                    'chunks': chunks,
+                    'domain': domain,
+                    'domain_method': domain_method,
+                }))
+                cache.set(cache_key, content)
         except Exception, e:
             content = exception_traceback_string(None, e,
                                                  error_template_name, {
@@ -183,8 +281,8 @@ def build_diff_comment_fragments(
                     'index': None,
                     'filediff': comment.filediff,
                 },
-                'domain': Site.objects.get_current().domain,
-                'domain_method': siteconfig.get("site_domain_method"),
+                'domain': domain,
+                'domain_method': domain_method,
             })
 
             # It's bad that we failed, and we'll return a 500, but we'll
@@ -734,16 +832,14 @@ def raw_diff(request,
     diffset = _query_for_diff(review_request, request.user, revision)
 
     tool = review_request.repository.get_scmtool()
-    data = tool.get_parser('').raw_diff(diffset)
-
-    resp = HttpResponse(data, mimetype='text/x-patch')
 
     if diffset.name == 'diff':
         filename = "bug%s.patch" % review_request.bugs_closed.replace(',', '_')
     else:
         filename = diffset.name
 
-    resp['Content-Disposition'] = 'inline; filename=%s' % filename
+    resp = PatchResponse(request, tool.get_parser('').iter_raw_diff(diffset),
+                         filename)
     set_last_modified(resp, diffset.timestamp)
 
     return resp
@@ -841,6 +937,46 @@ def diff_fragment(request,
                               interdiffset_id, chunkindex, template_name)
 
 
+@check_login_required
+def diff_lines(request,
+               review_request_id,
+               revision,
+               filediff_id,
+               first_line,
+               last_line,
+               interdiff_revision=None,
+               template_name='diffviewer/diff_file_fragment.html',
+               local_site_name=None):
+    """
+    Wrapper around diffviewer.views.view_diff_lines that takes a review
+    request.
+
+    Displays a range of lines from a diff or interdiff owned by the given
+    review request.
+    """
+    review_request, response = \
+        _find_review_request(request, review_request_id, local_site_name)
+
+    if not review_request:
+        return response
+
+    review_request.get_draft(request.user)
+
+    if interdiff_revision is not None:
+        interdiffset = _query_for_diff(review_request, request.user,
+                                       interdiff_revision)
+        interdiffset_id = interdiffset.id
+    else:
+        interdiffset_id = None
+
+    diffset = _query_for_diff(review_request, request.user, revision)
+
+    return view_diff_lines(request, diffset.id, filediff_id,
+                           review_request.get_absolute_url(),
+                           first_line, last_line, interdiffset_id,
+                           template_name)
+
+
 @check_login_required
 def preview_review_request_email(
     request,
@@ -43,7 +43,7 @@ class RepositoryAdmin(admin.ModelAdmin):
             'classes': ('wide',),
         }),
         (_('Advanced'), {
-            'fields': ('encoding',),
+            'fields': ('encoding', 'diff_generation_concurrency'),
             'classes': ('wide',),
         }),
         (_('State'), {
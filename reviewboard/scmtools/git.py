@@ -172,8 +172,8 @@ class GitDiffParser(DiffParser):
 
         # Now we have a diff we are going to use so get the filenames + commits
         file_info = File()
-        file_info.data = self.lines[linenum] + "\n"
         file_info.binary = False
+        header_start = linenum
         diff_line = self.lines[linenum].split()
 
         try:
@@ -187,15 +187,11 @@ class GitDiffParser(DiffParser):
 
         # Save the new file, deleted file, mode change and index
         if self._is_new_file(linenum):
-            file_info.data += self.lines[linenum] + "\n"
             linenum += 1
         elif self._is_deleted_file(linenum):
-            file_info.data += self.lines[linenum] + "\n"
             linenum += 1
             file_info.deleted = True
         elif self._is_mode_change(linenum):
-            file_info.data += self.lines[linenum] + "\n"
-            file_info.data += self.lines[linenum + 1] + "\n"
             linenum += 2
 
         if self._is_index_range_line(linenum):
@@ -207,25 +203,28 @@ class GitDiffParser(DiffParser):
             if self.pre_creation_regexp.match(file_info.origInfo):
                 file_info.origInfo = PRE_CREATION
 
-            file_info.data += self.lines[linenum] + "\n"
             linenum += 1
 
-        # Get the changes
+        # Get the changes. Everything from the "diff --git" line up to the
+        # end of the changes is kept, so the data is joined in one go once
+        # we find the end.
         while linenum < len(self.lines):
             if self._is_git_diff(linenum):
-                return linenum, file_info
+                break
 
             if self._is_binary_patch(linenum):
                 file_info.binary = True
+                file_info.data = self.join_lines(header_start, linenum)
                 return linenum + 1, file_info
 
             if self._is_diff_fromfile_line(linenum):
                 if self.lines[linenum].split()[1] == "/dev/null":
                     file_info.origInfo = PRE_CREATION
 
-            file_info.data += self.lines[linenum] + "\n"
             linenum += 1
 
+        file_info.data = self.join_lines(header_start, linenum)
+
         return linenum, file_info
 
     def _is_empty_change(self, linenum):
@@ -78,6 +78,13 @@ class Repository(models.Model):
         help_text=_("The encoding used for files in this repository. This is "
                     "an advanced setting and should only be used if you're "
                     "sure you need it."))
+    diff_generation_concurrency = models.PositiveIntegerField(
+        _('Diff generation concurrency'),
+        default=1,
+        help_text=_("The maximum number of files in a diff that are fetched "
+                    "and diffed at the same time when the diff viewer "
+                    "needs to generate them. Raising this speeds up large "
+                    "diffs, but puts more load on the repository server."))
     visible = models.BooleanField(
         _('Show this repository'),
         default=True,
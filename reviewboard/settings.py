@@ -45,10 +45,10 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
-    'django.middleware.gzip.GZipMiddleware', # Keep this first.
+    'reviewboard.admin.middleware.GZipMiddleware', # Keep this first.
     'django.middleware.common.CommonMiddleware',
     'django.middleware.doc.XViewMiddleware',
-    'django.middleware.http.ConditionalGetMiddleware',
+    'reviewboard.admin.middleware.ConditionalGetMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -9,7 +9,7 @@ from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.db.models import Q
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect
 from django.template.defaultfilters import timesince
 from django.utils.translation import ugettext as _
 from djblets.siteconfig.models import SiteConfiguration
@@ -35,6 +35,7 @@ from reviewboard.accounts.models import Profile
 from reviewboard.changedescs.models import ChangeDescription
 from reviewboard.diffviewer.diffutils import get_diff_files
 from reviewboard.diffviewer.forms import EmptyDiffError
+from reviewboard.diffviewer.responses import PatchResponse
 from reviewboard.reviews.errors import PermissionError
 from reviewboard.reviews.forms import UploadDiffForm, UploadScreenshotForm
 from reviewboard.reviews.models import BaseComment, Comment, DiffSet, \
@@ -833,6 +834,31 @@ class FileDiffResource(WebAPIResource):
                            'This is parsed from the diff, but is usually '
                            'not used for anything.',
         },
+        'inserted_lines': {
+            'type': int,
+            'description': 'The number of lines inserted by the diff, not '
+                           'counting changed lines. This is null if the '
+                           'diff was uploaded before lines were counted.',
+        },
+        'deleted_lines': {
+            'type': int,
+            'description': 'The number of lines deleted by the diff, not '
+                           'counting changed lines. This is null if the '
+                           'diff was uploaded before lines were counted.',
+        },
+        'changed_lines': {
+            'type': int,
+            'description': 'The number of lines changed by the diff. Each '
+                           'is a deleted line replaced by an inserted line. '
+                           'This is null if the diff was uploaded before '
+                           'lines were counted.',
+        },
+        'hunk_count': {
+            'type': int,
+            'description': 'The number of hunks in the diff. This is null '
+                           'if the diff was uploaded before lines were '
+                           'counted.',
+        },
     }
     item_child_resources = [filediff_comment_resource]
 
@@ -1039,9 +1065,8 @@ class FileDiffResource(WebAPIResource):
         except ObjectDoesNotExist:
             return DOES_NOT_EXIST
 
-        resp = HttpResponse(filediff.diff, mimetype='text/x-patch')
         filename = '%s.patch' % urllib.quote(filediff.source_file)
-        resp['Content-Disposition'] = 'inline; filename=%s' % filename
+        resp = PatchResponse(request, [filediff.diff], filename)
         set_last_modified(resp, filediff.diffset.timestamp)
 
         return resp
@@ -1068,7 +1093,8 @@ class FileDiffResource(WebAPIResource):
         payload = {
             'diff_data': {
                 'binary': f['binary'],
-                'chunks': f['chunks'],
+                'chunks': [dict(chunk, lines=list(chunk['lines']))
+                           for chunk in f['chunks']],
                 'num_changes': f['num_changes'],
                 'changed_chunk_indexes': f['changed_chunk_indexes'],
                 'new_file': f['newfile'],
@@ -1267,6 +1293,30 @@ class DiffResource(WebAPIResource):
             'type': 'reviewboard.webapi.resources.RepositoryResource',
             'description': 'The repository that the diff is applied against.',
         },
+        'inserted_lines': {
+            'type': int,
+            'description': 'The total number of lines inserted by the '
+                           'file diffs. This is null if any of them '
+                           'were uploaded before lines were counted.',
+        },
+        'deleted_lines': {
+            'type': int,
+            'description': 'The total number of lines deleted by the '
+                           'file diffs. This is null if any of them '
+                           'were uploaded before lines were counted.',
+        },
+        'changed_lines': {
+            'type': int,
+            'description': 'The total number of lines changed by the '
+                           'file diffs. This is null if any of them '
+                           'were uploaded before lines were counted.',
+        },
+        'hunk_count': {
+            'type': int,
+            'description': 'The total number of hunks in the file diffs. '
+                           'This is null if any of them were uploaded '
+                           'before lines were counted.',
+        },
     }
     item_child_resources = [filediff_resource]
 
@@ -1351,9 +1401,6 @@ class DiffResource(WebAPIResource):
             return DOES_NOT_EXIST
 
         tool = review_request.repository.get_scmtool()
-        data = tool.get_parser('').raw_diff(diffset)
-
-        resp = HttpResponse(data, mimetype='text/x-patch')
 
         if diffset.name == 'diff':
             filename = 'bug%s.patch' % \
@@ -1361,7 +1408,9 @@ class DiffResource(WebAPIResource):
         else:
             filename = diffset.name
 
-        resp['Content-Disposition'] = 'inline; filename=%s' % filename
+        resp = PatchResponse(request,
+                             tool.get_parser('').iter_raw_diff(diffset),
+                             filename)
         set_last_modified(resp, diffset.timestamp)
 
         return resp
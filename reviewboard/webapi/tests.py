@@ -3830,6 +3830,10 @@ class DiffResourceTests(BaseWebAPITestCase):
         f.close()
 
         self.assertEqual(rsp['stat'], 'ok')
+        self.assertEqual(rsp['diff']['inserted_lines'], 3)
+        self.assertEqual(rsp['diff']['deleted_lines'], 1)
+        self.assertEqual(rsp['diff']['changed_lines'], 0)
+        self.assertEqual(rsp['diff']['hunk_count'], 1)
 
     def test_post_diffs_with_missing_data(self):
         """Testing the POST review-requests/<id>/diffs/ API with Invalid Form Data"""